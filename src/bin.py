@@ -1,38 +1,430 @@
 #!/usr/bin/python3
 """ Read output data from qtd.py and place into bins.
+
+    Reads qtd.py data files a chunk at a time, computes the decay time
+    (STOP2 - STOP1) of every pulse pair, and adds it to a fixed-width
+    histogram, so memory use doesn't depend on how much data there is.
+
+    Handles both the binary .qtd event files (see qtdfile.py)
+    and the older text .txt files with one line of registers per event,
+    either of them possibly compressed (.zst, .xz or .gz, see datafiles.py).
+
+        bin.py /mnt/qtd/data/*.qtd
+        bin.py --save part1.npz day1/*.qtd
+        bin.py --merge part1.npz part2.npz --print
+        bin.py --jobs 4 /mnt/qtd/data/*.qtd
+        bin.py --index /mnt/qtd/bin_index.sqlite /mnt/qtd/data/*.qtd
+
+    With --index, the histogram and header of each file are kept in an
+    SQLite database, and files whose size and modification time haven't
+    changed since the last run are not read again.
+
+    The default binning matches the TeachSpin muon lifetime apparatus:
+    20 nS bins over a 20 uS window.
 """
 
-__version__ = '0.0'
+__version__ = '0.1'
 
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import gzip
+import io
+import json
+import lzma
+import os
+import sqlite3
+import subprocess
 import sys
-import seaborn as sns
-
-# Read all the data from the files.
-argv = sys.argv[1:]
-#print(len(argv), "files to process")
-# Create enough room to hold perfect data.
-decay_times = [0] * (100000 * len(argv))
-n = 0
-for name in argv:
-    with open(name) as f:
-        for line in f:
-            words = line.split()
-            s = words[0]
-            if not s.isdigit():
+
+import numpy as np
+
+import tdc7201
+import qtdfile
+
+BIN_WIDTH = 20e-9	# seconds
+WINDOW = 20e-6	# seconds
+CHUNK = 1 << 16	# events read at a time
+CLOCK_PERIOD = 1.0 / 8000000	# EVM on-board oscillator, for text files
+N_RESULTS = qtdfile.N_RESULTS
+
+
+class Histogram():
+    """Fixed-width histogram of decay times, plus counts of measurement results."""
+
+    def __init__(self, bin_width=BIN_WIDTH, window=WINDOW):
+        self.bin_width = bin_width
+        self.window = window
+        self.n_bins = int(round(window / bin_width))
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        self.underflow = 0	# decay times below 0
+        self.overflow = 0	# decay times at or above the window
+        self.results = np.zeros(N_RESULTS, dtype=np.int64)	# measure() status codes
+        self.files = 0
+
+    def edges(self):
+        """Bin edges in seconds (n_bins + 1 of them)."""
+        return np.arange(self.n_bins + 1) * self.bin_width
+
+    def add(self, decay_times):
+        """Add an array of decay times (in seconds)."""
+        index = np.floor_divide(decay_times, self.bin_width)
+        inside = (index >= 0) & (index < self.n_bins)
+        self.counts += np.bincount(index[inside].astype(np.intp), minlength=self.n_bins)
+        self.underflow += int(np.count_nonzero(index < 0))
+        self.overflow += int(np.count_nonzero(index >= self.n_bins))
+
+    def merge(self, other):
+        """Add another histogram (with the same binning) into this one."""
+        if other.n_bins != self.n_bins or other.bin_width != self.bin_width:
+            raise ValueError("Can't merge histograms with different binning")
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        self.results += other.results
+        self.files += other.files
+        return self
+
+    def total(self):
+        """Number of decay times in the window."""
+        return int(self.counts.sum())
+
+    def save(self, name):
+        """Save to a .npz file, for merging later."""
+        np.savez(name, bin_width=self.bin_width, window=self.window,
+                 counts=self.counts, underflow=self.underflow, overflow=self.overflow,
+                 results=self.results, files=self.files)
+
+    @classmethod
+    def load(cls, name):
+        """Read a histogram written by save()."""
+        with np.load(name) as data:
+            hist = cls(float(data["bin_width"]), float(data["window"]))
+            hist.counts[:] = data["counts"]
+            hist.underflow = int(data["underflow"])
+            hist.overflow = int(data["overflow"])
+            hist.results[:] = data["results"]
+            hist.files = int(data["files"])
+        return hist
+
+
+def decay_times(regs, config1, config2, clock_period):
+    """Decay times (STOP2 - STOP1, in seconds) of the pulse pairs in a batch of raw registers."""
+    (_, pulses, tofs) = tdc7201.compute_tofs_batch(regs, config1, config2, clock_period)
+    pairs = pulses == 2
+    return tofs[pairs, 1] - tofs[pairs, 0]
+
+
+COMPRESSED = (".zst", ".xz", ".gz")
+
+
+@contextlib.contextmanager
+def open_data(name):
+    """Open a data file for reading as bytes, decompressing it on the fly if needed."""
+    if name.endswith(".zst"):
+        # No zstd in the standard library, so use the command line tool.
+        with subprocess.Popen(["zstd", "-d", "-c", "-q", name], stdout=subprocess.PIPE) as proc:
+            yield proc.stdout
+    elif name.endswith(".xz"):
+        with lzma.open(name, 'rb') as data_file:
+            yield data_file
+    elif name.endswith(".gz"):
+        with gzip.open(name, 'rb') as data_file:
+            yield data_file
+    else:
+        with open(name, 'rb') as data_file:
+            yield data_file
+
+
+def _read_header(name, data_file):
+    """Read and check the header of a binary event file from an open stream,
+       leaving the stream at the first record.
+    """
+    header = np.frombuffer(data_file.read(qtdfile.HEADER_SIZE)[:qtdfile.HEADER_DTYPE.itemsize],
+                           dtype=qtdfile.HEADER_DTYPE)
+    if len(header) != 1 or header["magic"][0] != qtdfile.MAGIC:
+        raise ValueError(name + " is not a QTD binary event file")
+    header = header[0]
+    if header["record_size"] != qtdfile.RECORD_SIZE:
+        raise ValueError(name + " has unsupported record size " + str(header["record_size"]))
+    data_file.read(int(header["header_size"]) - qtdfile.HEADER_SIZE)
+    return header
+
+
+def _read_records(data_file, chunk):
+    """Yield records a chunk at a time from an open stream."""
+    while True:
+        block = data_file.read(chunk * qtdfile.RECORD_SIZE)
+        # Ignore a partly written last record.
+        block = block[:len(block) - len(block) % qtdfile.RECORD_SIZE]
+        if not block:
+            return
+        yield np.frombuffer(block, dtype=qtdfile.RECORD_DTYPE)
+
+
+def read_qtd(name, chunk=CHUNK):
+    """Yield (regs, config, clock_period) a chunk at a time from a binary event file.
+       Also returns the header fields (as a dict) when done.
+    """
+    if name.endswith(COMPRESSED):
+        # Can't memmap a compressed file, so decompress it as a stream.
+        with open_data(name) as data_file:
+            header = _read_header(name, data_file)
+            return (yield from _decode(header, _read_records(data_file, chunk)))
+    (header, records) = qtdfile.open_events(name)
+    chunks = (records[start:start+chunk] for start in range(0, len(records), chunk))
+    return (yield from _decode(header, chunks))
+
+
+def _decode(header, chunks):
+    """Yield (regs, config, clock_period) for each chunk of records,
+       and return the header fields as a dict.
+    """
+    config = header["config"].tolist()
+    clock_period = float(header["clock_period"]) or CLOCK_PERIOD
+    for records in chunks:
+        yield (qtdfile.decode_regs(records), config, clock_period)
+    return {"time": float(header["start_time"]),
+            "batch": int(header["batch"]),
+            "config": config,
+            "results": header["results"].tolist(),
+           }
+
+
+def _bracketed(line):
+    """The list of ints between [ and ] in a line, or None."""
+    start = line.find('[')
+    end = line.find(']', start)
+    if start < 0 or end < 0:
+        return None
+    try:
+        return [int(word) for word in line[start+1:end].split(',')]
+    except ValueError:
+        return None
+
+
+def read_text(name, chunk=CHUNK, clock_period=CLOCK_PERIOD):
+    """Yield (regs, config, clock_period) a chunk at a time from a text data file.
+       Also returns the header fields and the "Tot" results (as a dict) when done.
+    """
+    info = {"time": None, "batch": None, "config": None, "results": None}
+    config = None
+    rows = []
+    with open_data(name) as raw, io.TextIOWrapper(raw) as data_file:
+        for line in data_file:
+            words = line.split(None, 1)
+            if not words:
                 continue
-            try:
-                t = float(words[-1])
-            except ValueError:
+            if words[0].isdigit():
+                # An event: measurement number, then the 24-bit registers.
+                regs = _bracketed(line)
+                if regs is None or config is None:
+                    continue
+                if len(regs) == 12:
+                    # Older files don't have CALIBRATION2,
+                    # but it is very nearly CALIBRATION1 * calibration periods.
+                    cal_pers = (2, 10, 20, 40)[(config[1] & tdc7201.TDC7201._CF2_CALIBRATION_PERIODS) >> 6]
+                    regs.append(regs[11] * cal_pers)
+                if len(regs) != qtdfile.N_REGS:
+                    continue
+                rows.append(regs)
+                if len(rows) >= chunk:
+                    yield (np.array(rows, dtype=np.uint32), config, clock_period)
+                    rows = []
+            elif words[0] == "Config":
+                config = _bracketed(line)
+                info["config"] = config
+            elif words[0] == "Tot":
+                info["results"] = _bracketed(line)
+            elif words[0] in ("Time", "Batch") and len(words) > 1:
+                try:
+                    info[words[0].lower()] = float(words[1].lstrip(': '))
+                except ValueError:
+                    pass
+    if rows:
+        yield (np.array(rows, dtype=np.uint32), config, clock_period)
+    return info
+
+
+def bin_file(name, hist, chunk=CHUNK, clock_period=CLOCK_PERIOD):
+    """Add all the pulse pairs in one data file to a histogram.
+       Returns the file's header fields and results, as a dict.
+    """
+    with open_data(name) as f:
+        binary = f.read(len(qtdfile.MAGIC)) == qtdfile.MAGIC
+    if binary:
+        reader = read_qtd(name, chunk)
+    else:
+        reader = read_text(name, chunk, clock_period)
+    while True:
+        try:
+            (regs, config, period) = next(reader)
+        except StopIteration as done:
+            info = done.value
+            break
+        hist.add(decay_times(regs, config[0], config[1], period))
+    if info["results"] is not None:
+        hist.results[:len(info["results"])] += info["results"]
+    hist.files += 1
+    return info
+
+
+def bin_files(names, bin_width=BIN_WIDTH, window=WINDOW, clock_period=CLOCK_PERIOD):
+    """Histogram a list of data files. Runs in a worker process for --jobs."""
+    hist = Histogram(bin_width, window)
+    for name in names:
+        bin_file(name, hist, clock_period=clock_period)
+    return hist
+
+
+def bin_each(names, bin_width=BIN_WIDTH, window=WINDOW, clock_period=CLOCK_PERIOD):
+    """Histogram each of a list of data files separately.
+       Returns a list of (name, histogram, header fields) for the index.
+    """
+    partials = []
+    for name in names:
+        hist = Histogram(bin_width, window)
+        info = bin_file(name, hist, clock_period=clock_period)
+        partials.append((name, hist, info))
+    return partials
+
+
+def bin_parallel(names, hist, jobs, clock_period=CLOCK_PERIOD, index=None):
+    """Histogram data files in a pool of jobs processes, merging into hist.
+       Each worker returns one partial histogram for its share of the files
+       (or, if there is an index to update, one per file).
+    """
+    # A few shards per worker, so one slow shard doesn't leave the others idle.
+    n_shards = min(len(names), 4 * jobs)
+    shards = [names[i::n_shards] for i in range(n_shards)]
+    worker = bin_files if index is None else bin_each
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        partials = [pool.submit(worker, shard, hist.bin_width, hist.window, clock_period)
+                    for shard in shards]
+        for partial in partials:
+            if index is None:
+                hist.merge(partial.result())
                 continue
-            decay_times[n] = t
-            n += 1
+            for (name, file_hist, info) in partial.result():
+                index.store(name, file_hist, info, clock_period)
+                hist.merge(file_hist)
+    return hist
+
+
+class Index():
+    """Per-file histograms and header fields, kept in an SQLite database
+       so that files which haven't changed needn't be read again.
+    """
+
+    def __init__(self, name):
+        self._db = sqlite3.connect(name)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS files (
+                                name TEXT PRIMARY KEY,
+                                size INTEGER, mtime REAL,
+                                time REAL, batch INTEGER, config TEXT,
+                                bin_width REAL, window REAL, clock_period REAL,
+                                counts BLOB, underflow INTEGER, overflow INTEGER,
+                                results TEXT)""")
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, name, bin_width, window, clock_period):
+        """Return the cached histogram for a file, or None if it is new or changed."""
+        stat = os.stat(name)
+        row = self._db.execute("""SELECT counts, underflow, overflow, results FROM files
+                                  WHERE name = ? AND size = ? AND mtime = ?
+                                  AND bin_width = ? AND window = ? AND clock_period = ?""",
+                               (os.path.abspath(name), stat.st_size, stat.st_mtime,
+                                bin_width, window, clock_period)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        hist = Histogram(bin_width, window)
+        hist.counts[:] = np.frombuffer(row[0], dtype=np.int64)
+        hist.underflow = row[1]
+        hist.overflow = row[2]
+        results = json.loads(row[3])
+        if results is not None:
+            hist.results[:len(results)] = results
+        hist.files = 1
+        return hist
+
+    def store(self, name, hist, info, clock_period):
+        """Remember the histogram and header fields of one file."""
+        stat = os.stat(name)
+        self._db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                         (os.path.abspath(name), stat.st_size, stat.st_mtime,
+                          info["time"], info["batch"], json.dumps(info["config"]),
+                          hist.bin_width, hist.window, clock_period,
+                          hist.counts.tobytes(), hist.underflow, hist.overflow,
+                          json.dumps(info["results"])))
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Histogram the decay times in qtd.py data files.")
+    parser.add_argument("files", nargs='*', help=".qtd or .txt data files")
+    parser.add_argument("--bin-width", type=float, default=BIN_WIDTH, help="bin width in S")
+    parser.add_argument("--window", type=float, default=WINDOW, help="histogram range in S")
+    parser.add_argument("--clock", type=float, default=1/CLOCK_PERIOD,
+                        help="TDC7201 clock in Hz, for text files")
+    parser.add_argument("--merge", nargs='+', default=[], metavar="NPZ",
+                        help="partial histograms (from --save) to add in")
+    parser.add_argument("--save", metavar="NPZ", help="save the histogram here")
+    parser.add_argument("--print", action="store_true", help="print the histogram")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="worker processes (0 means one per CPU)")
+    parser.add_argument("--index", metavar="DB",
+                        help="SQLite file of already processed files, to skip them")
+    args = parser.parse_args(argv)
 
-print("Got", n, "data points.")
+    hist = Histogram(args.bin_width, args.window)
+    clock_period = 1 / args.clock
+    for name in args.merge:
+        hist.merge(Histogram.load(name))
+    names = args.files
+    index = None
+    if args.index:
+        index = Index(args.index)
+        names = []
+        for name in args.files:
+            cached = index.lookup(name, hist.bin_width, hist.window, clock_period)
+            if cached is None:
+                names.append(name)
+            else:
+                hist.merge(cached)
+    jobs = args.jobs or os.cpu_count()
+    if jobs > 1 and len(names) > 1:
+        bin_parallel(names, hist, jobs, clock_period, index)
+    elif index is not None:
+        for (name, file_hist, info) in bin_each(names, hist.bin_width, hist.window, clock_period):
+            index.store(name, file_hist, info, clock_period)
+            hist.merge(file_hist)
+    else:
+        for name in names:
+            bin_file(name, hist, clock_period=clock_period)
+    if index is not None:
+        print(index.hits, "files from the index,", index.misses, "read.")
+        index.close()
 
-#sns.set()
+    print("Got", hist.total(), "data points from", hist.files, "files.")
+    print("Underflow", hist.underflow, "overflow", hist.overflow)
+    print("Results:", hist.results.tolist())
+    if args.save:
+        hist.save(args.save)
+    if args.print:
+        for (edge, count) in zip(hist.edges(), hist.counts):
+            print(round(edge * 1e6, 3), count)	# bin start in uS
 
-#_ = plt.hist(DATA_HERE, bins=100)
-#_ = plt.xlabel("Time (uS)")
-#_ = plt.ylabel("N")
+    #import matplotlib.pyplot as plt
+    #_ = plt.hist(hist.edges()[:-1], bins=hist.edges(), weights=hist.counts)
+    #_ = plt.xlabel("Time (uS)")
+    #_ = plt.ylabel("N")
+    #plt.show()
 
-#plt.show()
+if __name__ == "__main__":
+    main(sys.argv[1:])
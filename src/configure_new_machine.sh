@@ -48,6 +48,7 @@ sudo python3 -m pip install twine
 sudo python3 -m pip install --upgrade spidev>=3.5
 sudo python3 -m pip install --upgrade RPi.GPIO
 sudo python3 -m pip install paho.mqtt
+sudo apt install python3-numpy
 # (optional) for compiling or debugging
 sudo python3 -m pip install guppy3
 sudo python3 -m pip install Cython
@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+""" Data file rotation and compression for qtd.py.
+
+    BatchFiles keeps one pair of data files (text log and binary events)
+    open at a time, and starts a new pair when the RotationPolicy says so:
+    after so many seconds, events, or bytes.
+
+    Closed files are handed to a Compressor, which compresses them in a
+    background thread with zstd, xz or gzip (run at low priority with nice),
+    checks that they decompress to exactly the original, and only then
+    deletes the original.
+
+    QueuedLog lets another thread (qtd.py --threaded's acquisition thread)
+    send error messages to the current data file without touching it.
+
+    Files are written through BUFFER_SIZE buffers, a typical SD card
+    erase block, so the card sees a few large sequential writes
+    instead of many small ones.
+"""
+
+__version__ = '0.1'
+
+import gzip
+import hashlib
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+BUFFER_SIZE = 4 << 20	# 4 MiB
+
+
+class RotationPolicy():
+    """When to start new data files. Any limit left as None is ignored."""
+
+    def __init__(self, max_seconds=None, max_events=None, max_bytes=None):
+        for (name, limit) in (("max_seconds", max_seconds), ("max_events", max_events),
+                              ("max_bytes", max_bytes)):
+            if limit is not None and limit <= 0:
+                raise ValueError(name + " must be positive or None, not " + str(limit))
+        self.max_seconds = max_seconds
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+
+    def due(self, seconds, events, size):
+        """True if files this old, with this many events and bytes, should be closed."""
+        return ((self.max_seconds is not None and seconds >= self.max_seconds) or
+                (self.max_events is not None and events >= self.max_events) or
+                (self.max_bytes is not None and size >= self.max_bytes))
+
+
+def _digest(stream):
+    """SHA-256 of everything read from a binary stream."""
+    sha = hashlib.sha256()
+    for block in iter(lambda: stream.read(BUFFER_SIZE), b''):
+        sha.update(block)
+    return sha.digest()
+
+
+class Compressor():
+    """Compress and verify closed files in a background thread."""
+    SUFFIX = {"zstd": ".zst", "xz": ".xz", "gzip": ".gz"}
+
+    def __init__(self, method="auto", level=None, niceness=19):
+        if method == "auto":
+            method = next((m for m in self.SUFFIX if shutil.which(m)), "gzip")
+        if method not in self.SUFFIX:
+            raise ValueError("Unknown compression method " + str(method))
+        self.method = method
+        self.suffix = self.SUFFIX[method]
+        # Without the command line tool, gzip is done in Python.
+        self.tool = shutil.which(method)
+        if self.tool is None and method != "gzip":
+            raise RuntimeError(method + " not found")
+        self.level = level
+        self.niceness = niceness
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="compressor", daemon=True)
+        self._thread.start()
+        # Counters
+        self.compressed = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self, name):
+        """Queue a closed file to be compressed."""
+        self._queue.put(name)
+
+    def stop(self, wait=True):
+        """Finish the files already queued, then stop."""
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            name = self._queue.get()
+            if name is None:
+                return
+            try:
+                self.compress(name)
+            except (OSError, subprocess.CalledProcessError) as err:
+                self.failed += 1
+                print("Couldn't compress", name + ":", err)
+
+    def compress(self, name):
+        """Compress one file, verify it, and delete the original.
+           Returns the compressed file name, or None if verification failed.
+        """
+        out = name + self.suffix
+        if self.tool:
+            command = [self.tool, "-q", "-k", "-f"]
+            if self.level is not None:
+                command.append("-" + str(self.level))
+            if self.niceness and shutil.which("nice"):
+                command = ["nice", "-n", str(self.niceness)] + command
+            subprocess.run(command + [name], check=True)
+        else:
+            with open(name, 'rb') as src, gzip.open(out, 'wb', compresslevel=self.level or 9) as dst:
+                shutil.copyfileobj(src, dst, BUFFER_SIZE)
+        # Check that it decompresses to exactly what we started with.
+        with open(name, 'rb') as src:
+            original = _digest(src)
+        if self.tool:
+            with subprocess.Popen([self.tool, "-d", "-c", out], stdout=subprocess.PIPE) as proc:
+                restored = _digest(proc.stdout)
+            ok = proc.returncode == 0 and restored == original
+        else:
+            with gzip.open(out, 'rb') as src:
+                ok = _digest(src) == original
+        if not ok:
+            self.failed += 1
+            print("Compressed", out, "does not match", name + "; keeping original.")
+            os.remove(out)
+            return None
+        self.compressed += 1
+        self.bytes_in += os.path.getsize(name)
+        self.bytes_out += os.path.getsize(out)
+        os.remove(name)
+        return out
+
+
+class QueuedLog():
+    """A write-only text "file" that only queues what is written to it,
+       so a thread that doesn't own the data files (e.g. the acquisition
+       thread) can still log to them. The thread that owns them calls
+       copy_to() with the current file.
+    """
+
+    def __init__(self):
+        self._lines = queue.SimpleQueue()
+
+    def write(self, text):
+        self._lines.put(text)
+
+    def copy_to(self, log_file):
+        """Write out everything queued so far (to stdout if log_file is None)."""
+        while True:
+            try:
+                text = self._lines.get_nowait()
+            except queue.Empty:
+                return
+            if log_file:
+                log_file.write(text)
+            else:
+                print(text, end='')
+
+
+class BatchFiles():
+    """The current pair of data files, rotated according to a RotationPolicy.
+       opener(start_time, number) must return (text file, qtdfile.EventWriter),
+       either of which may be None if it couldn't be opened.
+       Files are opened when first needed, so no empty files are left behind.
+    """
+
+    def __init__(self, opener, policy, compressor=None, n_results=14):
+        self.opener = opener
+        self.policy = policy
+        self.compressor = compressor
+        self.n_results = n_results
+        self.number = 0	# files opened so far
+        self.data_file = None
+        self.event_file = None
+        self.start = None	# None when no files are open
+        self.events = 0
+        self.results = [0] * n_results
+        self.cum_results = [0] * n_results
+
+    def open(self):
+        """Open the next pair of files, unless they are already open."""
+        if self.start is not None:
+            return
+        self.number += 1
+        self.start = time.time()
+        self.events = 0
+        self.results = [0] * self.n_results
+        (self.data_file, self.event_file) = self.opener(self.start, self.number)
+
+    def log_file(self):
+        """The text file for the next measurements (e.g. for measure_many(log_file=))."""
+        self.open()
+        return self.data_file
+
+    def size(self):
+        """Bytes written to the current files so far.
+           Text still in the text file's small encoding buffer (a few kB)
+           isn't counted; asking for it would flush the whole file buffer.
+        """
+        size = 0
+        if self.data_file:
+            # The binary layer's tell() includes its buffer, without flushing it.
+            size += self.data_file.buffer.tell()
+        if self.event_file:
+            size += self.event_file.size()
+        return size
+
+    def write(self, records):
+        """Write some MEASUREMENT_DTYPE records, rotating files as needed.
+           Only pulse pairs and more (status 2 to 5) are kept in the event file,
+           but all status codes are counted.
+        """
+        max_events = self.policy.max_events
+        while len(records):
+            self.open()
+            if max_events is not None:
+                take = records[:max_events - self.events]
+            else:
+                take = records
+            records = records[len(take):]
+            status = take["status"]
+            counts = np.bincount(status, minlength=self.n_results)
+            for i in range(self.n_results):
+                self.results[i] += int(counts[i])
+            if self.event_file:
+                keep = (status >= 2) & (status <= 5)
+                self.event_file.write(take["regs"][keep], status[keep])
+            self.events += len(take)
+            size = self.size() if self.policy.max_bytes is not None else 0
+            if self.policy.due(time.time() - self.start, self.events, size):
+                self.close()
+
+    def close(self):
+        """Write the totals, close the files, and queue them for compression."""
+        if self.start is None:
+            return
+        self.start = None
+        for i in range(self.n_results):
+            self.cum_results[i] += self.results[i]
+        names = []
+        if self.event_file:
+            self.event_file.close(self.results)
+            names.append(self.event_file.name)
+            self.event_file = None
+        if self.data_file:
+            self.data_file.write('Tot : ' + str(self.results) + "\n")
+            self.data_file.write('Cum : ' + str(self.cum_results) + "\n")
+            self.data_file.close()
+            names.append(self.data_file.name)
+            self.data_file = None
+        if self.compressor:
+            for name in names:
+                self.compressor.add(name)
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+""" Running decay-time statistics for qtd.py.
+
+    Fed with the raw registers of each group of measurements as they
+    come in, keeps (in constant memory):
+    - a histogram of decay times (see bin.py),
+    - the count, mean and variance of the decay times in the window
+      (Welford's method, merged a batch at a time),
+    - a quick lifetime estimate from the mean alone, and
+    - a maximum-likelihood fit of lifetime and background to the histogram
+      (see lifetime.py), redone whenever fit() is called.
+
+        stats = DecayStats(tdc.reg1[0], tdc.reg1[1], tdc.clockPeriod)
+        stats.add(batch["regs"][batch["status"] == 2])
+        ...
+        stats.fit()
+        publisher.publish(topic="QTD/VDDG/tdc7201/decay", payload=json.dumps(stats.summary()))
+"""
+
+__version__ = '0.1'
+
+import math
+import time
+
+import numpy as np
+
+import bin as binning
+import lifetime
+
+
+def truncated_tau(mean, window):
+    """Lifetime of an exponential whose mean, when cut off at window, is mean.
+       Returns None if there is no such lifetime (mean is window/2 or more).
+    """
+    if not 0 < mean < window / 2:
+        return None
+    # The mean of the cut-off exponential, tau - window/(exp(window/tau) - 1),
+    # increases with tau, so bisect.
+    low = mean
+    high = 1000 * window
+    for _ in range(100):
+        tau = (low + high) / 2
+        x = window / tau
+        cut_mean = tau - window / math.expm1(x) if x < 700 else tau
+        if cut_mean < mean:
+            low = tau
+        else:
+            high = tau
+    return (low + high) / 2
+
+
+class DecayStats():
+    """Decay-time histogram, moments and lifetime estimates, updated incrementally."""
+
+    def __init__(self, config1, config2, clock_period,
+                 bin_width=binning.BIN_WIDTH, window=binning.WINDOW):
+        self.config1 = config1
+        self.config2 = config2
+        self.clock_period = clock_period
+        self.hist = binning.Histogram(bin_width, window)
+        self.start = time.time()
+        # Welford running moments of the decay times in the window.
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        # Latest maximum-likelihood fit.
+        self._theta = None
+        self.tau = None
+        self.tau_error = None
+        self.background = None	# per bin
+        self.fits = 0
+
+    def add(self, regs):
+        """Add the raw registers (n x 13) of some measurements.
+           Only pulse pairs are used.
+        """
+        if not len(regs):
+            return
+        times = binning.decay_times(regs, self.config1, self.config2, self.clock_period)
+        self.hist.add(times)
+        times = times[(times >= 0) & (times < self.hist.window)]
+        n = len(times)
+        if not n:
+            return
+        # Merge this batch's moments into the running ones (Chan et al.).
+        mean = times.mean()
+        m2 = float(np.sum((times - mean) ** 2))
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self._m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+
+    def variance(self):
+        """Sample variance of the decay times in the window."""
+        if self.count < 2:
+            return None
+        return self._m2 / (self.count - 1)
+
+    def fit(self):
+        """Fit lifetime and background to the histogram so far.
+           Starts from the last fit, so this is usually only a few iterations.
+           Returns True if the fit converged.
+        """
+        if self.hist.total() < 10:
+            return False
+        (theta, errors, _, _, converged) = lifetime.fit_batch(
+            self.hist.counts[None, :], self.hist.bin_width, theta=self._theta)
+        self.fits += 1
+        if not converged[0]:
+            self._theta = None	# Start afresh next time.
+            return False
+        self._theta = theta
+        (_, self.tau, self.background) = theta[0].tolist()
+        self.tau_error = float(errors[0, 1])
+        return True
+
+    def summary(self):
+        """The current statistics as a dict (times in uS), e.g. for MQTT."""
+        elapsed = time.time() - self.start
+        variance = self.variance()
+        tau_mean = truncated_tau(self.mean, self.hist.window) if self.count else None
+
+        def us(seconds):
+            return None if seconds is None else round(float(seconds) * 1e6, 4)
+
+        summary = {"decays": self.count,
+                   "elapsed": round(elapsed, 1),
+                   "mean": us(self.mean),
+                   "std": us(math.sqrt(variance)) if variance is not None else None,
+                   "tau_mean": us(tau_mean),
+                   "tau": us(self.tau),
+                   "tau_error": us(self.tau_error),
+                   "background_per_bin": self.background,
+                   "background_rate": None,
+                  }
+        if self.background is not None and elapsed > 0:
+            # Background pulse pairs per second, over the whole window.
+            summary["background_rate"] = self.background * self.hist.n_bins / elapsed
+        return summary
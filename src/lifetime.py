@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+""" Fit the muon lifetime to a histogram of decay times.
+
+    Uses the same model as Teachspin/gd.m (and, with --fast, gd3.m/gd4.m):
+    the expected number of decays in bin k (of width b) is
+
+        nu + n*p*(1-p)**k [+ nf*pf*(1-pf)**k]
+
+    where p = 1 - exp(-b/tau) and pf = 1 - exp(-b/tauf),
+    i.e. n muons with lifetime tau, a flat background of nu per bin,
+    and optionally nf faster decays (pions, kaons) with lifetime tauf.
+
+    Instead of least squares by gradient descent, this maximizes the
+    Poisson likelihood of the bin counts with Newton's method,
+    using analytic first and second derivatives
+    (damped Levenberg-Marquardt style when far from the minimum).
+    The background is kept >= 0: where the likelihood would push it
+    negative, it is held at 0 and the other parameters are fitted.
+    It usually converges in a few iterations (a few tens with --fast). The uncertainties are
+    from the inverse of the Hessian at the minimum.
+
+    Input is a histogram saved by "bin.py --save", or a text file with
+    one bin count per line (like the Teachspin data.txt files).
+
+        lifetime.py hist.npz
+        lifetime.py --fast --bin-width 20e-9 Teachspin/bootstrap/data.txt
+        lifetime.py --bootstrap 300 --jobs 4 hist.npz
+
+    --bootstrap replaces Teachspin/bootstrap/resample.perl:
+    it draws all the resampled histograms at once (as multinomial counts
+    over the bins), fits them in batches, and prints the spread of tau
+    and its confidence intervals. Resamples whose fit did not converge
+    are counted and left out, rather than recorded as NaN.
+
+    Requires numpy.
+"""
+
+__version__ = '0.1'
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import sys
+
+import numpy as np
+
+BIN_WIDTH = 20e-9	# seconds, for text files
+TAU = 2.2e-6	# seconds, initial guess for the muon lifetime
+TAU_FAST = 30e-9	# seconds, initial guess for the fast component
+PARAMS = ("n", "tau", "nu", "nf", "tauf")
+
+
+def load_counts(name, bin_width=BIN_WIDTH):
+    """Return (counts, bin_width) from a bin.py .npz file or a text file of counts."""
+    if name.endswith(".npz"):
+        with np.load(name) as data:
+            return (data["counts"].astype(np.float64), float(data["bin_width"]))
+    return (np.loadtxt(name, ndmin=1), bin_width)
+
+
+def _exponential(tau, k, b):
+    """p*(1-p)**k for p = 1 - exp(-b/tau), and its first and second
+       derivatives with respect to tau. tau is (fits x 1), k is (bins).
+    """
+    s = b / tau
+    here = np.exp(-s * k)
+    there = np.exp(-s * (k + 1))
+    f = here - there	# = (1 - exp(-s)) * exp(-s*k)
+    f_s = (k + 1) * there - k * here
+    f_ss = k * k * here - (k + 1) * (k + 1) * there
+    s_t = -b / (tau * tau)
+    s_tt = 2 * b / (tau * tau * tau)
+    return (f, f_s * s_t, f_ss * s_t * s_t + f_s * s_tt)
+
+
+def _model(theta, k, b):
+    """Expected counts mu (fits x bins), and the first (fits x params x bins)
+       and second (fits x params x params x bins) derivatives of mu.
+    """
+    (m, n_params) = theta.shape
+    jac = np.empty((m, n_params, len(k)))
+    hess = np.zeros((m, n_params, n_params, len(k)))
+    n = theta[:, 0:1]
+    (f, f_t, f_tt) = _exponential(theta[:, 1:2], k, b)
+    mu = theta[:, 2:3] + n * f
+    jac[:, 0] = f
+    jac[:, 1] = n * f_t
+    jac[:, 2] = 1.0
+    hess[:, 0, 1] = hess[:, 1, 0] = f_t
+    hess[:, 1, 1] = n * f_tt
+    if n_params == 5:
+        n_f = theta[:, 3:4]
+        (f, f_t, f_tt) = _exponential(theta[:, 4:5], k, b)
+        mu = mu + n_f * f
+        jac[:, 3] = f
+        jac[:, 4] = n_f * f_t
+        hess[:, 3, 4] = hess[:, 4, 3] = f_t
+        hess[:, 4, 4] = n_f * f_tt
+    return (mu, jac, hess)
+
+
+def _nll(theta, y, k, b):
+    """Poisson negative log likelihood (without the constant log(y!) term), per fit."""
+    # Lifetimes must be positive, and the background can't be negative.
+    bad = (theta[:, 1] <= 0) | (theta[:, 2] < 0)
+    if theta.shape[1] == 5:
+        bad |= theta[:, 4] <= 0
+    with np.errstate(all='ignore'):
+        (mu, _, _) = _model(np.where(bad[:, None], 1.0, theta), k, b)
+        nll = np.sum(mu - np.where(y > 0, y * np.log(mu), 0.0), axis=1)
+    nll[bad | ~np.isfinite(nll) | np.any(mu <= 0, axis=1)] = np.inf
+    return nll
+
+
+def _derivatives(theta, y, k, b):
+    """Gradient, Hessian and Fisher information of the NLL, per fit."""
+    (mu, jac, hess_mu) = _model(theta, k, b)
+    resid = 1.0 - y / mu
+    outer = jac[:, :, None, :] * jac[:, None, :, :]
+    grad = np.sum(resid[:, None, :] * jac, axis=2)
+    hess = (np.sum((y / (mu * mu))[:, None, None, :] * outer, axis=3)
+            + np.sum(resid[:, None, None, :] * hess_mu, axis=3))
+    fisher = np.sum(outer / mu[:, None, None, :], axis=3)
+    return (grad, hess, fisher)
+
+
+def _pin_background(theta, grad, hess):
+    """Hold the background nu at 0 in the fits where the likelihood
+       would rather it were negative, by taking it out of the Newton step
+       (in place). Returns which fits are pinned.
+    """
+    pinned = (theta[:, 2] <= 0) & (grad[:, 2] > 0)
+    if pinned.any():
+        grad[pinned, 2] = 0.0
+        hess[pinned, 2, :] = 0.0
+        hess[pinned, :, 2] = 0.0
+        hess[pinned, 2, 2] = 1.0
+    return pinned
+
+
+def initial_guess(y, b, fast=False, first=0):
+    """Starting parameters for fitting counts y (fits x bins), as gd4.m does it."""
+    (m, n_bins) = y.shape
+    tail = max(1, min(100, n_bins // 10))
+    nu = y[:, -tail:].mean(axis=1)
+    span = (first + n_bins) * b
+    n = (y.sum(axis=1) - nu * n_bins) / (np.exp(-first * b / TAU) - np.exp(-span / TAU))
+    n = np.maximum(n, 1.0)
+    columns = [n, np.full(m, TAU), np.maximum(nu, 1e-3)]
+    if fast:
+        columns[0] = n * 0.999
+        columns += [n / 1000, np.full(m, TAU_FAST)]
+    return np.stack(columns, axis=1)
+
+
+def fit_batch(y, bin_width=BIN_WIDTH, fast=False, first=0, theta=None,
+              max_iter=100, tol=1e-8):
+    """Fit many histograms at once.
+       y is (fits x bins) counts, starting at bin number first.
+       Returns (theta, errors, nll, iterations, converged),
+       where theta and errors are (fits x params) in the order of PARAMS.
+       A fit has converged if its Hessian is positive definite
+       and the Newton decrement is below tol; if not, its errors are NaN.
+       The background nu is kept >= 0; if it ends up at 0, its error is NaN.
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    (m, n_bins) = y.shape
+    k = np.arange(first, first + n_bins, dtype=np.float64)
+    b = bin_width
+    if theta is None:
+        theta = initial_guess(y, b, fast, first)
+    theta = np.array(theta, dtype=np.float64)
+    theta[:, 2] = np.maximum(theta[:, 2], 0.0)
+    n_params = theta.shape[1]
+    nll = _nll(theta, y, k, b)
+    damping = np.full(m, 1e-3)
+    converged = np.zeros(m, dtype=bool)
+    iterations = np.zeros(m, dtype=int)
+    eye = np.eye(n_params)
+    for _ in range(max_iter):
+        active = ~converged
+        if not active.any():
+            break
+        t = theta[active]
+        ya = y[active]
+        (grad, hess, fisher) = _derivatives(t, ya, k, b)
+        _pin_background(t, grad, hess)
+        # Converged?
+        positive = np.linalg.eigvalsh(hess)[:, 0] > 0
+        step = np.zeros_like(t)
+        step[positive] = np.linalg.solve(hess[positive], -grad[positive][:, :, None])[:, :, 0]
+        decrement = -np.sum(grad * step, axis=1) / 2
+        done = positive & (decrement < tol)
+        # Otherwise take a damped Newton step, and keep it if it helps.
+        scale = np.diagonal(fisher, axis1=1, axis2=2)
+        # A parameter with no effect (e.g. tauf when nf is 0) would make this singular.
+        scale = np.where(scale > 0, scale, 1.0)
+        damped = hess + damping[active][:, None, None] * scale[:, :, None] * eye
+        try:
+            step = np.linalg.solve(damped, -grad[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            step = -grad / scale
+        trial = t + step
+        trial[:, 2] = np.maximum(trial[:, 2], 0.0)	# Stop at the nu = 0 boundary.
+        trial_nll = _nll(trial, ya, k, b)
+        better = (trial_nll <= nll[active]) & ~done
+        index = np.flatnonzero(active)
+        theta[index[better]] = trial[better]
+        nll[index[better]] = trial_nll[better]
+        d = damping[index]
+        damping[index] = np.where(better, np.maximum(d / 10, 1e-12), np.minimum(d * 10, 1e12))
+        iterations[index[~done]] += 1
+        converged[index[done]] = True
+    # Uncertainties from the Hessian at the minimum.
+    errors = np.full(theta.shape, np.nan)
+    if converged.any():
+        (grad, hess, _) = _derivatives(theta[converged], y[converged], k, b)
+        pinned = _pin_background(theta[converged], grad, hess)
+        covariance = np.linalg.inv(hess)
+        with np.errstate(invalid='ignore'):	# NaN if too ill-conditioned
+            errors[converged] = np.sqrt(np.diagonal(covariance, axis1=1, axis2=2))
+        errors[np.flatnonzero(converged)[pinned], 2] = np.nan
+    return (theta, errors, nll, iterations, converged)
+
+
+class Fit():
+    """The result of fitting one histogram."""
+
+    def __init__(self, theta, errors, nll, iterations, converged):
+        self.theta = theta
+        self.names = PARAMS[:len(theta)]
+        self.values = dict(zip(self.names, theta.tolist()))
+        self.errors = dict(zip(self.names, errors.tolist()))
+        self.nll = float(nll)
+        self.iterations = int(iterations)
+        self.converged = bool(converged)
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __str__(self):
+        parts = []
+        for name in self.names:
+            (value, error) = (self.values[name], self.errors[name])
+            if name.startswith("tau"):
+                # Lifetimes in nS, as in the Teachspin scripts.
+                (value, error) = (value * 1e9, error * 1e9)
+            if name == "nu" and value == 0 and np.isnan(error):
+                parts.append(name + "=0 (pinned at 0)")	# Background fit ran into nu >= 0.
+            else:
+                parts.append(name + "=" + format(value, ".6g") + " +- " + format(error, ".3g"))
+        status = "converged" if self.converged else "NOT CONVERGED"
+        return (", ".join(parts) + " (tau in nS), " + status +
+                " after " + str(self.iterations) + " iterations")
+
+
+def fit(counts, bin_width=BIN_WIDTH, fast=False, first=0):
+    """Fit one histogram (counts in bins first, first+1, ...). Returns a Fit."""
+    counts = np.asarray(counts, dtype=np.float64)[first:]
+    result = fit_batch(counts[None, :], bin_width, fast, first)
+    return Fit(*(r[0] for r in result))
+
+
+def _fit_resamples(y, bin_width, fast, first, theta):
+    """Fit one batch of resamples. Runs in a worker process for --jobs."""
+    (theta, _, _, _, converged) = fit_batch(y, bin_width, fast, first, theta)
+    return (theta, converged)
+
+
+def bootstrap(counts, resamples=300, bin_width=BIN_WIDTH, fast=False, first=0,
+              seed=None, jobs=1, batch=100):
+    """Fit resamples of a histogram, drawn as multinomial counts over its bins.
+       Returns (theta, converged): the fitted parameters of each resample
+       (resamples x params, in the order of PARAMS) and whether each fit converged.
+    """
+    counts = np.asarray(counts, dtype=np.float64)[first:]
+    total = int(counts.sum())
+    rng = np.random.default_rng(seed)
+    y = rng.multinomial(total, counts / total, size=resamples).astype(np.float64)
+    # Start every resample from the fit to the original histogram.
+    start = fit(np.concatenate((np.zeros(first), counts)), bin_width, fast, first)
+    if not start.converged:
+        raise ValueError("Fit to the original histogram did not converge")
+    batches = [y[i:i+batch] for i in range(0, resamples, batch)]
+    work = [(b, bin_width, fast, first, np.tile(start.theta, (len(b), 1))) for b in batches]
+    if jobs > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_fit_resamples, *zip(*work)))
+    else:
+        results = [_fit_resamples(*w) for w in work]
+    theta = np.concatenate([r[0] for r in results])
+    converged = np.concatenate([r[1] for r in results])
+    return (theta, converged)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Fit the muon lifetime to a decay-time histogram.")
+    parser.add_argument("histogram", help=".npz from bin.py --save, or text file of counts")
+    parser.add_argument("--bin-width", type=float, default=BIN_WIDTH,
+                        help="bin width in S, for text files")
+    parser.add_argument("--fast", action="store_true",
+                        help="also fit a fast (pion/kaon) component, as gd3.m and gd4.m do")
+    parser.add_argument("--first", type=int, default=0,
+                        help="ignore bins before this one")
+    parser.add_argument("--bootstrap", type=int, default=0, metavar="N",
+                        help="also fit N resampled histograms")
+    parser.add_argument("--seed", type=int, help="random seed for --bootstrap")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="worker processes for --bootstrap")
+    parser.add_argument("--output", help="write each --bootstrap fit to this file")
+    args = parser.parse_args(argv)
+
+    (counts, bin_width) = load_counts(args.histogram, args.bin_width)
+    print("Fitting", int(counts.sum()), "decays in", len(counts), "bins of", bin_width, "S.")
+    result = fit(counts, bin_width, args.fast, args.first)
+    print(result)
+    if not args.bootstrap:
+        return result
+
+    (theta, converged) = bootstrap(counts, args.bootstrap, bin_width, args.fast, args.first,
+                                   args.seed, args.jobs)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(" ".join(PARAMS[:theta.shape[1]]) + " converged\n")
+            for (row, ok) in zip(theta, converged):
+                out.write(" ".join(format(v, ".9g") for v in row) + " " + str(int(ok)) + "\n")
+    failed = int(np.count_nonzero(~converged))
+    print(args.bootstrap, "resamples,", args.bootstrap - failed, "converged.")
+    if failed:
+        print("WARNING:", failed, "fits did NOT converge and are left out.")
+    tau = theta[converged, 1] * 1e9	# nS
+    if len(tau) < 2:
+        print("Not enough converged fits for statistics.")
+        return result
+    print("tau mean", format(tau.mean(), ".6g"), "nS, standard deviation", format(tau.std(ddof=1), ".3g"), "nS")
+    for level in (68.27, 95.45):
+        (low, high) = np.percentile(tau, [(100 - level) / 2, (100 + level) / 2])
+        print(str(level) + "% interval:", format(low, ".6g"), "to", format(high, ".6g"), "nS")
+    return result
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+""" Non-blocking MQTT publishing for qtd.py and pi_stats.py.
+
+    publish() only puts the message in a queue and returns;
+    a background thread does all the network I/O,
+    so a slow or missing broker can never hold up the caller.
+
+        publisher = Publisher("test.mosquitto.org")
+        publisher.start()
+        publisher.publish(topic="QTD/VDDG/tdc7201/runstate", payload="ON")
+        ...
+        publisher.stop()
+
+    - Only the latest message for each topic is kept while waiting to be sent,
+      so a topic updated faster than the network can take it costs nothing.
+    - The queue holds at most max_queue topics; beyond that the oldest
+      message is dropped (and counted).
+    - If the connection is lost (or never made), the thread reconnects,
+      waiting twice as long after each failure, up to max_backoff seconds.
+    - While offline, messages can be spooled to a local file (spool_file),
+      which is sent in order when the connection comes back.
+
+    To test without the internet, run a local broker
+    (e.g. "mosquitto -p 1883") and use Publisher("localhost"),
+    or set the QTD_MQTT_SERVER environment variable for qtd.py and pi_stats.py.
+"""
+
+__version__ = '0.1'
+
+import json
+import os
+import socket
+import threading
+import time
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+#MQTT_SERVER_NAME = "mqtt.eclipse.org"
+MQTT_SERVER_NAME = os.environ.get("QTD_MQTT_SERVER", "test.mosquitto.org")
+
+
+class Publisher():
+    """Queue MQTT messages and send them from a background thread."""
+
+    def __init__(self,
+                 server=MQTT_SERVER_NAME,
+                 port=1883,
+                 keepalive=600,
+                 max_queue=1000,	# Most topics waiting to be sent
+                 spool_file=None,	# Save messages here while offline
+                 max_spool=10000000,	# Most bytes to spool
+                 min_backoff=1.0,	# First reconnect delay, in seconds
+                 max_backoff=300.0,	# Longest reconnect delay, in seconds
+                 poll=0.1,	# How often to check for new messages, in seconds
+                 client=None,	# Anything with the paho.mqtt.client.Client interface
+                ):
+        if client is None:
+            if mqtt is None:
+                raise RuntimeError("paho.mqtt not available")
+            client = mqtt.Client()
+        self.server = server
+        self.port = port
+        self.keepalive = keepalive
+        self.max_queue = max_queue
+        self.spool_file = spool_file
+        self.max_spool = max_spool
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.poll = poll
+        self._client = client
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        # topic -> (payload, qos, retain), oldest first.
+        self._queue = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.connected = False
+        self.backoff = min_backoff
+        # Counters
+        self.published = 0	# messages handed to the client
+        self.coalesced = 0	# messages replaced by a newer one for the same topic
+        self.dropped = 0	# messages lost because the queue or spool was full
+        self.spooled = 0	# messages written to the spool file
+        self.reconnects = 0	# failed connection attempts
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """Queue a message. Never blocks on the network."""
+        with self._lock:
+            if self._queue.pop(topic, None) is not None:
+                self.coalesced += 1
+            self._queue[topic] = (payload, qos, retain)
+            if len(self._queue) > self.max_queue:
+                del self._queue[next(iter(self._queue))]
+                self.dropped += 1
+
+    def start(self):
+        """Start the background thread, which connects to the broker."""
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="mqtt", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=2.0):
+        """Try to send what is queued (for up to timeout seconds), then disconnect."""
+        deadline = time.time() + timeout
+        while self._queue and self.connected and time.time() < deadline:
+            time.sleep(self.poll)
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(max(0.0, deadline - time.time()) + self.poll)
+        # Keep anything still unsent for next time.
+        self._spool(self._take())
+        try:
+            self._client.disconnect()
+        except (socket.error, OSError):
+            pass
+
+    def stats(self):
+        """Counters as a dict."""
+        return {"connected": self.connected,
+                "queued": len(self._queue),
+                "published": self.published,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "spooled": self.spooled,
+                "reconnects": self.reconnects,
+               }
+
+    # Everything below runs in the background thread.
+
+    def _on_connect(self, mqtt_client, userdata, flags, result_code):
+        """MQTT callback for when the client receives a CONNACK response from the server."""
+        print("Connected to", self.server, "with result code", result_code)
+        self.connected = (result_code == 0)
+        # Any subscribes should go here, so they get re-subscribed on a reconnect.
+
+    def _on_disconnect(self, mqtt_client, userdata, result_code):
+        """MQTT callback for when the client is disconnected from the server."""
+        print("MQTT disconnected with code", result_code, ". Will reconnect.")
+        self.connected = False
+
+    def _take(self):
+        """Remove and return all queued messages, oldest first."""
+        with self._lock:
+            messages = list(self._queue.items())
+            self._queue.clear()
+        return messages
+
+    def _connect(self):
+        """Try to (re)connect once. Returns True if it worked."""
+        try:
+            self._client.connect(self.server, self.port, self.keepalive)
+        except (socket.error, OSError) as err:
+            self.reconnects += 1
+            print("Couldn't connect to MQTT server", self.server + ":", err,
+                  "- retrying in", self.backoff, "S.")
+            return False
+        self.connected = True
+        self.backoff = self.min_backoff
+        return True
+
+    def _spool(self, messages):
+        """Save messages to the spool file, if there is one and it isn't full."""
+        if not messages:
+            return
+        if self.spool_file is not None:
+            try:
+                size = os.path.getsize(self.spool_file)
+            except OSError:
+                size = 0
+            try:
+                with open(self.spool_file, 'a') as spool:
+                    for (topic, (payload, qos, retain)) in messages:
+                        line = json.dumps([topic, payload, qos, retain], default=str) + '\n'
+                        if size + len(line) > self.max_spool:
+                            self.dropped += 1
+                            continue
+                        spool.write(line)
+                        size += len(line)
+                        self.spooled += 1
+                return
+            except OSError as err:
+                print("Couldn't write MQTT spool file", self.spool_file + ":", err)
+        # Nowhere to put them but back in the queue, behind anything newer.
+        with self._lock:
+            for (topic, message) in messages:
+                if topic not in self._queue:
+                    self._queue[topic] = message
+
+    def _unspool(self):
+        """Send everything in the spool file, in order, then delete it.
+           Returns False if the connection was lost part way.
+        """
+        if self.spool_file is None or not os.path.exists(self.spool_file):
+            return True
+        with open(self.spool_file) as spool:
+            lines = spool.readlines()
+        os.remove(self.spool_file)
+        for (n, line) in enumerate(lines):
+            try:
+                (topic, payload, qos, retain) = json.loads(line)
+            except ValueError:
+                continue	# Partly written line from a crash.
+            if not self._send(topic, payload, qos, retain):
+                # Put back what wasn't sent.
+                with open(self.spool_file, 'w') as spool:
+                    spool.writelines(lines[n:])
+                return False
+        return True
+
+    def _send(self, topic, payload, qos, retain):
+        """Hand one message to the client. Returns False if the connection is gone."""
+        info = self._client.publish(topic=topic, payload=payload, qos=qos, retain=retain)
+        if info.rc != 0:	# MQTT_ERR_SUCCESS
+            self.connected = False
+            return False
+        self.published += 1
+        return True
+
+    def _run(self):
+        stopping = self._stopping
+        while not stopping.is_set():
+            if not self.connected:
+                self._spool(self._take())
+                if not self._connect():
+                    stopping.wait(self.backoff)
+                    self.backoff = min(2 * self.backoff, self.max_backoff)
+                    continue
+                if not self._unspool():
+                    continue
+            messages = self._take()
+            for (n, (topic, (payload, qos, retain))) in enumerate(messages):
+                if not self._send(topic, payload, qos, retain):
+                    self._spool(messages[n:])
+                    break
+            try:
+                # Service the network (keepalives, acks, callbacks).
+                if self._client.loop(timeout=self.poll) != 0:	# MQTT_ERR_SUCCESS
+                    self.connected = False
+            except (socket.error, OSError):
+                self.connected = False
@@ -5,12 +5,12 @@ import time
 import os
 import signal
 import sys
-import socket
-import paho.mqtt.client as mqtt
+from mqtt_publisher import Publisher
 
 # Handle ^C keyboard interrupt.
 def sigint_handler(sig, frame):
     """Exit as gracefully as possible."""
+    publisher.stop()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, sigint_handler)
@@ -61,26 +61,9 @@ except ValueError:
     ads1115 = None
 
 # MQTT stuff.
-#MQTT_SERVER_NAME = "mqtt.eclipse.org"
-MQTT_SERVER_NAME = "test.mosquitto.org"
-
-def on_connect(mqtt_client, userdata, flags, result_code):
-    """MQTT callback for when the client receives a CONNACK response from the server."""
-    print("Connected to", MQTT_SERVER_NAME, "with result code", result_code)
-    # Any subscribes should go here, so they get re-subscribed on a reconnect.
-
-def on_disconnect(mqtt_client, userdata, rc):
-    print("MQTT disconnected with code", rc, ". Attempting to reconnect.")
-    try:
-        mqttc.reconnect()
-    except socket.error:
-        print("Reconnect failed, exiting.")
-        sys.exit(0)
-
-mqttc = mqtt.Client()
-mqttc.on_connect = on_connect
-mqttc.on_disconnect = on_disconnect
-mqttc.connect(MQTT_SERVER_NAME, 1883, 300)
+# Messages are sent from a background thread, so a broker outage can't stall us.
+publisher = Publisher(spool_file="/mnt/qtd/pi_stats_mqtt_spool.jsonl")
+publisher.start()
 
 def publish_uname():
     """Publish uname() data to the MQTT server."""
@@ -91,11 +74,11 @@ def publish_uname():
     sysname = uname.sysname
     release = uname.release
     version = uname.version
-    mqttc.publish(topic="QTD/VDDG/"+nodename+"/nodename",
+    publisher.publish(topic="QTD/VDDG/"+nodename+"/nodename",
                    payload=nodename, retain=True)
-    mqttc.publish(topic="QTD/VDDG/"+nodename+"/machine",
+    publisher.publish(topic="QTD/VDDG/"+nodename+"/machine",
                    payload=machine, retain=True)
-    mqttc.publish(topic="QTD/VDDG/"+nodename+"/OS",
+    publisher.publish(topic="QTD/VDDG/"+nodename+"/OS",
                    payload=sysname+" "+release+" "+version, retain=True)
 
 cpu_temp = None
@@ -118,7 +101,7 @@ def publish_cpu_temp(f_name="/sys/class/thermal/thermal_zone0/temp"):
             #print("Averaged temp =", cpu_temp/1000)
         rounded = round(cpu_temp/1000, 1)
         #print("CPU temp =", rounded)
-    mqttc.publish(topic="QTD/VDGG/CPU/cpu_temp", payload=rounded)
+    publisher.publish(topic="QTD/VDGG/CPU/cpu_temp", payload=rounded)
 
 def publish_gpu_temp(cmd="vcgencmd measure_temp"):
     """Publish the GPU temperature to the MQTT server."""
@@ -131,7 +114,7 @@ def publish_gpu_temp(cmd="vcgencmd measure_temp"):
     else:
         #print("GPU temp =", gpu_temp)
         pass
-    mqttc.publish(topic="QTD/VDGG/CPU/gpu_temp", payload=gpu_temp)
+    publisher.publish(topic="QTD/VDGG/CPU/gpu_temp", payload=gpu_temp)
 
 def publish_os_name():
     """Publish the OS name to the MQTT server."""
@@ -152,7 +135,7 @@ def publish_os_name():
         print("Couldn't open", fname)
         os_name += "XXXX-XX-XX"
     #print("OS name =", os_name)
-    mqttc.publish(topic="QTD/VDDG/CPU/os_name", payload=os_name, retain=True)
+    publisher.publish(topic="QTD/VDDG/CPU/os_name", payload=os_name, retain=True)
 
 def publish_cpu_info(f_name="/proc/cpuinfo"):
     """Publish the Raspberry Pi type name to the MQTT server."""
@@ -168,7 +151,7 @@ def publish_cpu_info(f_name="/proc/cpuinfo"):
             if len(hw_pair) >= 2:
                 topic = "QTD/VDDG/CPU/"+hw_pair[0]
                 #print(topic)
-                mqttc.publish(topic=topic, payload=" ".join(hw_pair[2:]), retain=True)
+                publisher.publish(topic=topic, payload=" ".join(hw_pair[2:]), retain=True)
 
 def publish_disk_space(fs="/",name="root"):
     """Publish filesystem fullness to the MQTT server."""
@@ -186,7 +169,7 @@ def publish_disk_space(fs="/",name="root"):
         print("Running", cmd, "failed.")
     #except ValueError:
         #pass
-    mqttc.publish(topic="QTD/VDGG/CPU/"+name, payload=str(full_pct))
+    publisher.publish(topic="QTD/VDGG/CPU/"+name, payload=str(full_pct))
 
 def publish_load_avg(cmd="uptime"):
     """Publish the load average to the MQTT server."""
@@ -199,7 +182,7 @@ def publish_load_avg(cmd="uptime"):
     else:
         #print("Load average =", load)
         pass
-    mqttc.publish(topic="QTD/VDGG/CPU/load", payload=load)
+    publisher.publish(topic="QTD/VDGG/CPU/load", payload=load)
 
 def publish_voltages():
     if ads1115 is None:
@@ -207,19 +190,19 @@ def publish_voltages():
         return None
     try:
         v = voltage5v0.voltage	# May throw OSError if i2c bus problem.
-        mqttc.publish(topic="QTD/VDGG/CPU/5v0", payload='{:.5f}'.format(v))
+        publisher.publish(topic="QTD/VDGG/CPU/5v0", payload='{:.5f}'.format(v))
     except OSError:
         # Measurement failed due to bus error?
         print("5v0 measurement failed due to OSError.")
     try:
         v = voltage3v7.voltage	# May throw OSError if i2c bus problem.
-        mqttc.publish(topic="QTD/VDGG/CPU/3v7", payload='{:.5f}'.format(v))
+        publisher.publish(topic="QTD/VDGG/CPU/3v7", payload='{:.5f}'.format(v))
     except OSError:
         # Measurement failed due to bus error?
         print("3v7 measurement failed due to OSError.")
     try:
         v = voltage3v3.voltage	# May throw OSError if i2c bus problem.
-        mqttc.publish(topic="QTD/VDGG/CPU/3v3", payload='{:.5f}'.format(v))
+        publisher.publish(topic="QTD/VDGG/CPU/3v3", payload='{:.5f}'.format(v))
     except OSError:
         # Measurement failed due to bus error?
         print("3v3 measurement failed due to OSError.")
@@ -229,7 +212,6 @@ publish_os_name()
 publish_cpu_info()
 
 while True:
-    mqttc.loop()
     publish_cpu_temp()
     publish_load_avg()
     publish_disk_space()
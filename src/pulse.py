@@ -1,13 +1,16 @@
 #!/usr/bin/python3
 
 """ Create simulated muon decay pulses for qtd.py to consume.
+
+    The pulse trains (muon decays plus a flat background) are drawn all
+    at once beforehand (see tdc7201.stimulus), so the loop below only
+    has to write them out to the STOP pin.
 """
 
-import time
-import random
 import RPi.GPIO as GPIO
+from tdc7201.stimulus import StimulusPool
 
-__version__ = '0.2'
+__version__ = '0.3'
 
 GPIO.setmode(GPIO.BOARD)        # Use header pin numbers, not GPIO numbers.
 GPIO.setwarnings(False)
@@ -21,27 +24,21 @@ TRIG = 7	# GPIO  4 = header pin  7
 GPIO.setup(STOP, GPIO.OUT, initial=GPIO.LOW)
 #GPIO.setup(TRIG, GPIO.IN)
 
-n_stop = 3
-upper_limit = 1 << 33
-assert upper_limit > 1 << n_stop*2
-while(True):
+TICK = 0.000001	# Approximate time per GPIO.output() call, in seconds
+GAP = 20	# Ticks of low between trains (replaces time.sleep(0.00002))
+
+# Only trains with at least 2 pulses, as before.
+pool = StimulusPool(tick=TICK, decay_fraction=1.0)
+trains = [train + (0,) * GAP for train in pool.trains if sum(train) >= 2]
+print(len(trains), "pulse trains, mean decay time", pool.decay_times().mean(), "S")
+output = GPIO.output
+while True:
 #    GPIO.wait_for_edge(TRIG, GPIO.RISING)
 #    # Make a nice double-wide START pulse with a little space after TRIG.
 #    GPIO.output(START, GPIO.LOW)
 #    GPIO.output(START, GPIO.HIGH)
 #    GPIO.output(START, GPIO.HIGH)
 #    GPIO.output(START, GPIO.LOW)
-    # Send 0 to NSTOP pulses.
-    # Spread them out a little ... 32 bits * density 1/16 => expected number 2
-    r = 0
-    while r == 0 or (r & (r-1)) == 0:
-        r = random.randrange(upper_limit) & random.randrange(upper_limit)
-        r &= random.randrange(upper_limit) & random.randrange(upper_limit)
-#    # ... and make sure each pulse is at least 2 ticks wide.
-#    r |= r << 1
-#    # Note that this DOES NOT ensure it will stay low for at least 2 ticks.
-    while r > 0:
-        GPIO.output(STOP, r & 1)
-        r >>= 1
-    GPIO.output(STOP, 0)
-    time.sleep(0.00002)
+    for train in trains:
+        for level in train:
+            output(STOP, level)
@@ -6,16 +6,24 @@ import os
 import resource
 import signal
 import sys
-import socket	# just for exception handling
 import json
-import paho.mqtt.client as mqtt
+import numpy
 import tdc7201
+from tdc7201.tuning import ParameterTuner
+import qtdfile
+import datafiles
+from mqtt_publisher import Publisher
+from decaystats import DecayStats
 
 
 # Handle ^C keyboard interrupt.
 def sigint_handler(sig, frame):
     """Exit as gracefully as possible."""
     print('\nCaught SIGINT')
+    # In threaded mode, stop measuring and let the consumers finish
+    # before the chip is turned off and the files are closed under them.
+    if acq is not None:
+        acq.stop()
     payload = "SIGINT - interrupted (probably by keyboard ^C)"
     try:
         tdc.cleanup()
@@ -23,38 +31,38 @@ def sigint_handler(sig, frame):
         pass
     else:
         payload = "OFF"
-    mqttc.publish(topic="QTD/VDDG/tdc7201/runstate", payload=payload)
+    publisher.publish(topic="QTD/VDDG/tdc7201/runstate", payload=payload)
+    publisher.stop()
+    try:
+        batch_files.close()
+        print("Waiting for data files to be compressed.")
+        compressor.stop()
+    except NameError:
+        pass
     sys.exit(0)
 
+acq = None	# The Acquisition, in threaded mode
 signal.signal(signal.SIGINT, sigint_handler)
 
+# With --emulate, run against the software chip model instead of real hardware.
+EMULATE = "--emulate" in sys.argv[1:]
+# With --threaded, measure in a background thread, and write files and
+# publish results from other threads, instead of between batches.
+THREADED = "--threaded" in sys.argv[1:]
+# With --pingpong, alternate measurements between the two sides of the chip.
+PINGPONG = "--pingpong" in sys.argv[1:]
+# With --stages, time each stage of every measurement, and report percentiles per batch.
+STAGE_TIMING = "--stages" in sys.argv[1:]
+# With --tune, pick the measurement parameters that give the most pulse pairs per second,
+# and re-tune every TUNE_INTERVAL seconds as the background changes.
+TUNE = "--tune" in sys.argv[1:]
+TUNE_INTERVAL = 3600
 
-# MQTT stuff.
-#MQTT_SERVER_NAME = "mqtt.eclipse.org"
-MQTT_SERVER_NAME = "test.mosquitto.org"
-
-def on_connect(mqtt_client, userdata, flags, result_code):
-    """MQTT callback for when the client receives a CONNACK response from the server."""
-    print("Connected to", MQTT_SERVER_NAME, "with result code", result_code)
-    # Any subscribes should go here, so they get re-subscribed on a reconnect.
 
-def on_disconnect(mqtt_client, userdata, rc):
-    """MQTT callback for when the client is disconnected from the server."""
-    print("MQTT disconnected with code", rc, ". Attempting to reconnect.")
-    try:
-        mqttc.reconnect()
-    except socket.error:
-        print("Reconnect failed, exiting.")
-        sys.exit(0)
-
-mqttc = mqtt.Client()
-mqttc.on_connect = on_connect
-mqttc.on_disconnect = on_disconnect
-try:
-    mqttc.connect(MQTT_SERVER_NAME, 1883, 600)
-except socket.gaierror:
-    print("ERROR: getaddrinfo() failed. Couldn't connect to MQTT server", MQTT_SERVER_NAME+".")
-    print("MQTT status logging will not work!!!")
+# MQTT stuff.
+# Messages are sent from a background thread, so the network never holds up measuring.
+publisher = Publisher(spool_file="/mnt/qtd/qtd_mqtt_spool.jsonl")
+publisher.start()
 
 def publish_tdc7201_driver():
     """Publish the version number of the TDC7201 driver to the MQTT server."""
@@ -70,9 +78,14 @@ def publish_tdc7201_driver():
         except IOError:
             driver = "unknown"
     print("TDC7201 driver version =", driver)
-    mqttc.publish(topic="QTD/VDGG/tdc7201/driver", payload=driver)
+    publisher.publish(topic="QTD/VDGG/tdc7201/driver", payload=driver)
 
-tdc = tdc7201.TDC7201()	# Create TDC object with SPI interface.
+if EMULATE:
+    from tdc7201.emulator import TDC7201Chip
+    chip = TDC7201Chip()
+    tdc = tdc7201.TDC7201(spi=chip.SpiDev(), gpio=chip.gpio, spi2=chip.SpiDev(), clock=chip.clock)
+else:
+    tdc = tdc7201.TDC7201()	# Create TDC object with SPI interface.
 
 # Set RPi pin directions and default values for non-SPI signals.
 # Pin assignments should stay the same for entire run.
@@ -80,7 +93,7 @@ tdc = tdc7201.TDC7201()	# Create TDC object with SPI interface.
 tdc.initGPIO()
 
 # Setting and checking clock speed.
-tdc.set_SPI_clock_speed(25000000)	# 25 MHz is spec max
+tdc.set_SPI_clock_speed(25000000)	# 25 MHz is spec max; tune_spi_clock() may change it
 
 # Internal timing
 now = time.time()
@@ -91,8 +104,45 @@ publish_tdc7201_driver()
 # Turn the chip on and configure it.
 tdc.on()
 NUM_STOP = 3	# We check against this later.
-tdc.configure(side=1, meas_mode=2, num_stop=NUM_STOP, clock_cntr_stop=0, timeout=0.000165, calibration2_periods=40)
-mqttc.publish(topic="QTD/VDDG/tdc7201/runstate", payload="ON")
+CONFIG = dict(meas_mode=2, num_stop=NUM_STOP, clock_cntr_stop=0, timeout=0.000165, calibration2_periods=40)
+if PINGPONG:
+    tdc.configure(side=2, **CONFIG)
+tdc.configure(side=1, **CONFIG)
+publisher.publish(topic="QTD/VDDG/tdc7201/runstate", payload="ON")
+
+# Run the SPI clock as fast as this board reliably allows.
+# The emulated chip has no board to remember, so don't save its result.
+# Only the emulator gets fake pulses; real hardware is timed on its real input.
+spi_speed = tdc.tune_spi_clock(path=None if EMULATE else tdc7201.SPI_CALIBRATION_FILE,
+                               simulate=EMULATE)
+publisher.publish(topic="QTD/VDDG/tdc7201/spi_speed", payload=str(spi_speed))
+
+def tune_parameters():
+    """Search for the configuration with the best valid pulse pair rate, and use it."""
+    global CONFIG, NUM_STOP
+    CONFIG = tuner.tune()
+    NUM_STOP = CONFIG["num_stop"]
+    for result in tuner.results:
+        print("Trial", result["config"], ":", round(result["pairs_per_sec"]), "pairs/S,",
+              round(result["error_rate"], 4), "errors per measurement")
+    print("Using", CONFIG, "(score", round(tuner.score), "pairs/S)")
+    publisher.publish(topic="QTD/VDDG/tdc7201/config", payload=json.dumps(CONFIG))
+
+if TUNE:
+    tuner = ParameterTuner(tdc, CONFIG, sides=(1, 2) if PINGPONG else (1,), interval=TUNE_INTERVAL)
+    tune_parameters()
+    if THREADED:
+        # The acquisition thread owns the chip, so there's no safe time to re-tune.
+        print("WARNING: --tune only re-tunes in the serial loop; tuning once at startup.")
+
+# Pick the fastest way to wait for interrupts on this Pi.
+# As for the SPI clock, only the emulator gets fake pulses.
+wait_cal = tdc.calibrate_interrupt_wait(simulate=EMULATE)
+print("Pi model:", wait_cal["model"])
+for (poll, rate) in wait_cal["rates"].items():
+    print("INT poll time", poll, "S:", round(rate), "measurements/S")
+print("Using INT poll time", tdc.interrupt_poll_time, "S.")
+publisher.publish(topic="QTD/VDDG/tdc7201/int_poll_time", payload=str(tdc.interrupt_poll_time))
 
 # Make sure our internal copy of the register state is up to date.
 #print("Reading chip side #1 register state:")
@@ -101,7 +151,18 @@ tdc.read_regs()
 
 batches = -1	# number of batches, negative means run forever
 ITERS = 100000 # measurements per batch
-mqttc.publish(topic="QTD/VDDG/tdc7201/batchsize", payload=str(ITERS))
+# Start new data files after this many seconds, measurements, or bytes
+# (None means no limit).
+ROTATE_SECONDS = None
+ROTATE_EVENTS = ITERS
+ROTATE_BYTES = None
+publisher.publish(topic="QTD/VDDG/tdc7201/batchsize", payload=str(ITERS))
+if STAGE_TIMING:
+    if THREADED or PINGPONG:
+        # The stage timestamps belong to the measuring thread, and pingpong isn't instrumented.
+        print("WARNING: --stages only works in the plain serial loop; ignoring it.")
+    else:
+        tdc.start_stage_timing(ITERS)
 #RESULT_NAME = ("0", "1", "2", "3", "4", "5",
 #               "No calibration", "INT1 fall timeout", "TRIG1 fall timeout",
 #               "INT1 early", "TRIG1 rise timeout", "START_MEAS active",
@@ -109,49 +170,149 @@ mqttc.publish(topic="QTD/VDDG/tdc7201/batchsize", payload=str(ITERS))
 cum_results = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
 result_list = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
 
-now = time.time()
-while batches != 0:
-    print("batches =", batches)
-    mqttc.loop()
-    # Measure average time per measurement.
-    then = now
-    timestamp = time.strftime("%Y%m%d%H%M%S")
+# Running decay-time statistics, published every STATS_INTERVAL seconds.
+STATS_INTERVAL = 60
+decay_stats = DecayStats(tdc.reg1[tdc.CONFIG1], tdc.reg1[tdc.CONFIG2], tdc.clockPeriod)
+last_stats = time.time()
+
+def update_decay_stats(records):
+    """Add pulse pairs to the running statistics, and publish them when it's time."""
+    global last_stats
+    decay_stats.add(records["regs"][records["status"] == 2])
+    if time.time() - last_stats >= STATS_INTERVAL:
+        last_stats = time.time()
+        decay_stats.fit()
+        summary = decay_stats.summary()
+        print("Decay statistics:", summary)
+        publisher.publish(topic="QTD/VDDG/tdc7201/decay", payload=json.dumps(summary))
+
+def open_batch_files(then, batch_number):
+    """Open the text and binary data files for one batch."""
+    timestamp = time.strftime("%Y%m%d%H%M%S", time.localtime(then))
     #print(timestamp)
-    data_fname = '/mnt/qtd/data/' + timestamp + ".txt"
+    # The text file gets the header, error messages, and totals;
+    # the events themselves go into a binary file (see qtdfile.py).
+    base = '/mnt/qtd/data/' + timestamp
+    # Files can now rotate more than once a second.
+    if any(os.path.exists(base + ".txt" + suffix) for suffix in ("", ".zst", ".xz", ".gz")):
+        base += "_" + str(batch_number)
+    data_fname = base + ".txt"
+    event_fname = base + ".qtd"
     try:
-        data_file = open(data_fname,'w')
+        data_file = open(data_fname, 'w', buffering=datafiles.BUFFER_SIZE)
         data_file.write("QTD experiment data file\n")
         data_file.write("Time : " + str(then) + "\n")
         data_file.write("Date : " + timestamp + "\n")
-        data_file.write("Batch : " + str(abs(batches)) + "\n")	# NOT CORRECT for batches > 0 !
+        data_file.write("Batch : " + str(batch_number) + "\n")
         data_file.write("Batch_size : " + str(ITERS) + "\n")
-        data_file.write("Config : " + str(tdc.reg1[0:12]) + "\n")
+        data_file.write("Config : " + str(tdc.reg1[0:12].tolist()) + "\n")
+        if tdc.stage_timing:
+            # The "Stages" line after each batch has these percentiles, in uS.
+            data_file.write("Stage_percentiles : " + json.dumps({"stages": tdc.STAGES,
+                                                                 "percentiles": tdc.STAGE_PERCENTILES}) + "\n")
     except (IOError, OSError):
         print("Couldn't open", data_fname, "for writing.")
         #tdc.cleanup()
         #sys.exit()
         data_file = None
+    try:
+        event_file = qtdfile.EventWriter(event_fname, tdc.reg1[0:10], batch=batch_number,
+                                         start_time=then, clock_period=tdc.clockPeriod or 0.0,
+                                         buffering=datafiles.BUFFER_SIZE)
+    except (IOError, OSError):
+        print("Couldn't open", event_fname, "for writing.")
+        event_file = None
+    return (data_file, event_file)
+
+# Closed data files are compressed (and checked) in the background, at low priority.
+compressor = datafiles.Compressor()
+print("Compressing data files with", compressor.method)
+batch_files = datafiles.BatchFiles(open_batch_files,
+                                   datafiles.RotationPolicy(max_seconds=ROTATE_SECONDS,
+                                                            max_events=ROTATE_EVENTS,
+                                                            max_bytes=ROTATE_BYTES),
+                                   compressor, n_results=len(result_list))
+
+def publish_recoveries():
+    """Publish how often the chip had to be reset (ERROR 12), and how long that took."""
+    payload = json.dumps({"count": tdc.recoveries,
+                          "seconds": round(tdc.recovery_time, 6),
+                          "last": round(tdc.last_recovery_time, 6)})
+    publisher.publish(topic="QTD/VDDG/tdc7201/recoveries", payload=payload)
+
+def run_threaded():
+    """Run forever with acquisition, disk and MQTT in separate threads."""
+    global acq
+    from tdc7201.acquisition import Acquisition
+    # The data files belong to the disk thread, so the acquisition thread's
+    # error messages are queued, and copied into the current file from there.
+    error_log = datafiles.QueuedLog()
+    acq = Acquisition(tdc, simulate=True, log_file=error_log, pingpong=PINGPONG)
+    # Disk: lossless, so every measurement lands in exactly one batch file.
+    def write_to_disk(records):
+        error_log.copy_to(batch_files.log_file())
+        batch_files.write(records)
+    acq.add_consumer("disk", write_to_disk)
+    # MQTT and console: lossy, they only need a statistically fair sample.
+    window = {"start": time.time(), "results": [0] * len(result_list)}
+    def publish_stats(records):
+        counts = numpy.bincount(records["status"], minlength=len(result_list))
+        for i in range(len(result_list)):
+            window["results"][i] += int(counts[i])
+            cum_results[i] += int(counts[i])
+        now = time.time()
+        if sum(window["results"]) >= ITERS:
+            PAYLOAD = json.dumps(window["results"])
+            print(PAYLOAD)
+            publisher.publish(topic="QTD/VDDG/tdc7201/batch", payload=PAYLOAD)
+            pulse_pair_rate = window["results"][2] / (now - window["start"])
+            publisher.publish(topic="QTD/VDDG/tdc7201/p2ps", payload=pulse_pair_rate)
+            publish_recoveries()
+            stats = acq.stats()
+            publisher.publish(topic="QTD/VDDG/tdc7201/dropped", payload=stats["dropped"])
+            publisher.publish(topic="QTD/VDDG/tdc7201/overruns", payload=json.dumps(stats["overruns"]))
+            print(cum_results)
+            print(pulse_pair_rate, "valid measurements per second,",
+                  stats["dropped"], "dropped,", stats["overruns"], "overruns")
+            window["start"] = now
+            window["results"] = [0] * len(result_list)
+    acq.add_consumer("mqtt", publish_stats, lossy=True)
+    # Decay statistics: lossless, but cheap.
+    acq.add_consumer("decay", update_decay_stats)
+    acq.start()
+    while True:
+        time.sleep(1.0)
+
+if THREADED:
+    run_threaded()
+
+now = time.time()
+while batches != 0:
+    print("batches =", batches)
+    # Measure average time per measurement.
+    then = now
     #result_list = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-    for m in range(ITERS):
-        m_str = str(m) + ' '
-        result = tdc.measure(simulate=True, error_prefix=m_str, log_file=data_file)
-        result_list[result] += 1
-        if result==2:
-            # Record results in microseconds
-            #decay = 1000000 * (tdc.tof2 - tdc.tof1)
-            # Record raw register data, so we can analyze differently later if needed,
-            # as well as the computed delay between STOP1 and STOP2.
-            #tof_line = m_str + str(tdc.reg1[0x10:0x1C]) + ' ' + str(decay) + '\n'
-            tof_line = m_str + str(tdc.reg1[0x10:0x1C]) + '\n'
-            if data_file:
-                data_file.write(tof_line)
-        elif result > NUM_STOP and result <= 5:
-            print("ERROR: Too Many Pulses:", result, str(tdc.reg1[0x10:0x1D]))
-    if data_file:
-        data_file.write('Tot : ' + str(result_list) + "\n")
+    # Run the whole batch inside the driver, then look at the results.
+    if PINGPONG:
+        batch = tdc.measure_pingpong(ITERS, simulate=True, log_file=batch_files.log_file())
+    else:
+        batch = tdc.measure_many(ITERS, simulate=True, log_file=batch_files.log_file())
+    status = batch["status"]
+    result_list[:] = numpy.bincount(status, minlength=len(result_list)).tolist()
+    if tdc.stage_timing:
+        stage_times = json.dumps(tdc.stage_percentiles())
+        if batch_files.data_file:
+            batch_files.data_file.write("Stages : " + stage_times + "\n")
+        publisher.publish(topic="QTD/VDDG/tdc7201/stages", payload=stage_times)
+    # Record raw register data, so we can analyze differently later if needed.
+    # Keep pulse pairs, and also anything with too many pulses.
+    batch_files.write(batch)
+    update_decay_stats(batch)
+    for m in numpy.flatnonzero((status > NUM_STOP) & (status <= 5)):
+        print("ERROR: Too Many Pulses:", status[m], str(batch["regs"][m].tolist()))
     PAYLOAD = json.dumps(result_list)
     print(PAYLOAD)
-    mqttc.publish(topic="QTD/VDDG/tdc7201/batch", payload=PAYLOAD)
+    publisher.publish(topic="QTD/VDDG/tdc7201/batch", payload=PAYLOAD)
     now = time.time()
     DURATION = now - then
     #print(ITERS, "measurements in", DURATION, "seconds")
@@ -161,20 +322,33 @@ while batches != 0:
     # MQTT "payload" = entire message, but
     # node-red "payload" = field inside message.
     # It's confusing.
-    mqttc.publish(topic="QTD/VDDG/tdc7201/p2ps", payload=pulse_pair_rate)
+    publisher.publish(topic="QTD/VDDG/tdc7201/p2ps", payload=pulse_pair_rate)
+    publish_recoveries()
     for i in range(len(result_list)):
         cum_results[i] += result_list[i]
         result_list[i] = 0
-    if data_file:
-        data_file.write('Cum : ' + str(cum_results) + "\n")
-        data_file.close()
-        data_file = None
     print(cum_results)
     #print('Memory usage: %s (kb)' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
     print(pulse_pair_rate, "valid measurements per second")
 
+    if TUNE and tuner.due():
+        tune_parameters()
+        # Start new files, so each one has a single configuration in its header.
+        batch_files.close()
+        decay_stats.config1 = tdc.reg1[tdc.CONFIG1]
+        decay_stats.config2 = tdc.reg1[tdc.CONFIG2]
+        # The best INT poll time depends on the timeout.
+        tdc.calibrate_interrupt_wait(simulate=EMULATE)
+        print("Using INT poll time", tdc.interrupt_poll_time, "S.")
+        now = time.time()	# Don't count tuning time against the next batch.
+
     batches -= 1
 
 # Turn the chip off.
 tdc.off()
-mqttc.publish(topic="QTD/VDDG/tdc7201/runstate", payload="OFF")
+publisher.publish(topic="QTD/VDDG/tdc7201/runstate", payload="OFF")
+publisher.stop()
+batch_files.close()
+compressor.stop()
+print(compressor.compressed, "files compressed from", compressor.bytes_in,
+      "to", compressor.bytes_out, "bytes,", compressor.failed, "failed.")
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+""" Binary event files for the QTD experiment.
+
+    A file is a fixed-size header followed by fixed-width records,
+    all little-endian, so it can be read with np.memmap():
+
+    Header (HEADER_SIZE bytes, zero padded):
+        magic		4 bytes, b"QTD1"
+        version		uint16
+        header_size	uint16
+        record_size	uint16
+        batch		uint32, batch number
+        start_time	float64, time.time() when the batch started
+        clock_period	float64, TDC7201 clock period in seconds
+        config		10 x uint8, TDC7201 registers CONFIG1 to CLOCK_CNTR_STOP_MASK_L
+        results		14 x uint32, counts of each measure() status code,
+                        filled in when the file is closed
+
+    Record (RECORD_SIZE bytes):
+        regs		13 x 3 bytes, 24-bit registers TIME1 to CALIBRATION2
+        status		uint8, the measure() status code
+
+    Records are only ever appended; the header is rewritten on close().
+"""
+
+__version__ = '0.1'
+
+import numpy as np
+
+MAGIC = b"QTD1"
+VERSION = 1
+HEADER_SIZE = 128
+N_REGS = 13	# TIME1 (0x10) through CALIBRATION2 (0x1C)
+N_RESULTS = 14	# measure() status codes 0-13
+
+HEADER_DTYPE = np.dtype([("magic", "S4"),
+                         ("version", "<u2"),
+                         ("header_size", "<u2"),
+                         ("record_size", "<u2"),
+                         ("batch", "<u4"),
+                         ("start_time", "<f8"),
+                         ("clock_period", "<f8"),
+                         ("config", "u1", (10,)),
+                         ("results", "<u4", (N_RESULTS,)),
+                        ])
+assert HEADER_DTYPE.itemsize <= HEADER_SIZE
+
+RECORD_DTYPE = np.dtype([("regs", "u1", (N_REGS, 3)),
+                         ("status", "u1"),
+                        ])
+RECORD_SIZE = RECORD_DTYPE.itemsize
+
+
+def pack_records(regs, status):
+    """Convert 24-bit register values (n x 13) and status codes (n) to records."""
+    regs = np.asarray(regs, dtype="<u4")
+    records = np.empty(len(regs), dtype=RECORD_DTYPE)
+    # Keep the low 3 bytes of each little-endian 32-bit word.
+    records["regs"] = regs.view(np.uint8).reshape(len(regs), N_REGS, 4)[:, :, :3]
+    records["status"] = status
+    return records
+
+
+def decode_regs(records):
+    """Return the 24-bit registers of some records as an (n x 13) uint32 array."""
+    raw = records["regs"].astype(np.uint32)
+    return raw[:, :, 0] | (raw[:, :, 1] << 8) | (raw[:, :, 2] << 16)
+
+
+class EventWriter():
+    """Write one batch of events to a binary file."""
+
+    def __init__(self, name, config, batch=0, start_time=0.0, clock_period=0.0, buffering=-1):
+        self.header = np.zeros(1, dtype=HEADER_DTYPE)
+        self.header["magic"] = MAGIC
+        self.header["version"] = VERSION
+        self.header["header_size"] = HEADER_SIZE
+        self.header["record_size"] = RECORD_SIZE
+        self.header["batch"] = batch
+        self.header["start_time"] = start_time
+        self.header["clock_period"] = clock_period
+        self.header["config"] = list(config)[:10]
+        self.records = 0
+        self.name = name
+        self._file = open(name, 'wb', buffering=buffering)
+        self._write_header()
+
+    def _write_header(self):
+        self._file.write(self.header.tobytes().ljust(HEADER_SIZE, b'\0'))
+
+    def write(self, regs, status):
+        """Append events, given their registers (n x 13) and status codes."""
+        records = pack_records(regs, status)
+        self._file.write(records.tobytes())
+        self.records += len(records)
+
+    def size(self):
+        """Bytes written so far."""
+        return HEADER_SIZE + self.records * RECORD_SIZE
+
+    def close(self, results=None):
+        """Fill in the status code counts (if given) and close the file."""
+        if results is not None:
+            self.header["results"] = results
+            self._file.seek(0)
+            self._write_header()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_header(name):
+    """Read the header of a binary event file, as a numpy record."""
+    header = np.fromfile(name, dtype=HEADER_DTYPE, count=1)
+    if len(header) != 1 or header["magic"][0] != MAGIC:
+        raise ValueError(name + " is not a QTD binary event file")
+    return header[0]
+
+
+def open_events(name):
+    """Return (header, records) for a binary event file, without reading the records."""
+    header = read_header(name)
+    offset = int(header["header_size"])
+    if header["record_size"] != RECORD_SIZE:
+        raise ValueError(name + " has unsupported record size " + str(header["record_size"]))
+    # An empty memmap is an error, so handle files with no records specially.
+    with open(name, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+    if size <= offset:
+        return (header, np.zeros(0, dtype=RECORD_DTYPE))
+    records = np.memmap(name, dtype=RECORD_DTYPE, mode='r', offset=offset,
+                        shape=((size - offset) // RECORD_SIZE,))
+    return (header, records)
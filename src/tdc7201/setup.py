@@ -13,6 +13,8 @@ setup(name='tdc7201',
       long_description_content_type='text/markdown',
       long_description=long_description,
       install_requires=["RPi.GPIO>=0.5","spidev>=3.5"],
+      # numpy is only needed for measure_many().
+      extras_require={"numpy": ["numpy"]},
       # also requires "time", "sys", and "random",
       # but those are all built-in.
       classifiers=[
@@ -15,22 +15,120 @@
 
     Written and tested on a Raspberry Pi 3B+ and Raspberry Pi Zero W,
     but should work on any model with a 2x20 pin header..
+
+    For testing and benchmarking without hardware, the SPI and GPIO
+    backends can be replaced by the software chip model in
+    tdc7201.emulator.
 """
 # pylint: disable=E1101
 
 import time
+# math for rounding wait times up to whole mS
+import math
 # sys for exit()
 import sys
+# io for discarding error messages during calibration
+import io
+# json and os for saving calibration results
+import json
+import os
+# array for the internal copy of the chip registers
+from array import array
 # random for creating stimuli for testing
 import random
-import RPi.GPIO as GPIO
-# Needs to be 0.5.1 or later for interrupts to work.
-# This code was written and tested on 0.6.3.
-# print("RPi.GPIO version =", GPIO.VERSION)
-import spidev
+# The hardware libraries only exist (or only work) on a Raspberry Pi.
+# Without them, you must pass emulated backends to TDC7201().
+try:
+    import RPi.GPIO as GPIO
+    # Needs to be 0.5.1 or later for interrupts to work.
+    # This code was written and tested on 0.6.3.
+    # print("RPi.GPIO version =", GPIO.VERSION)
+except (ImportError, RuntimeError):
+    GPIO = None
+try:
+    import spidev
+except ImportError:
+    spidev = None
+# numpy is only needed for the batch (many measurements at once) methods.
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 __version__ = '0.11.3'	# Use SemVer style version numbers
 
+# Record layout for batches of raw measurements (see measure_many()).
+# regs[i] holds 24-bit register MINREG24+i, i.e. TIME1 through CALIBRATION2.
+if np is not None:
+    MEASUREMENT_DTYPE = np.dtype([("timestamp", "<f8"),	# time.time() at completion, 0.0 if status > 5
+                                  ("status", "u1"),	# same codes as measure()
+                                  ("side", "u1"),	# which side of the chip measured
+                                  ("regs", "<u4", (13,)),	# raw result registers
+                                 ])
+else:
+    MEASUREMENT_DTYPE = None
+
+
+def pi_model():
+    """Return the Raspberry Pi model name, or None if not on a Pi."""
+    try:
+        with open("/proc/device-tree/model") as model_file:
+            return model_file.read().rstrip('\0\n')
+    except OSError:
+        return None
+
+
+def pi_serial():
+    """Return the Raspberry Pi serial number, or None if not on a Pi."""
+    try:
+        with open("/proc/device-tree/serial-number") as serial_file:
+            return serial_file.read().rstrip('\0\n')
+    except OSError:
+        return None
+
+
+# Where tune_spi_clock() keeps the best SPI clock speed for each board.
+SPI_CALIBRATION_FILE = os.path.expanduser("~/.tdc7201_spi_clock.json")
+
+
+def compute_tofs_batch(regs, config1, config2, clock_period):
+    """Compute Time-Of-Flights for a whole batch of measurements at once.
+       regs is an (n x 13) array of raw 24-bit registers TIME1 through CALIBRATION2,
+       as in MEASUREMENT_DTYPE["regs"] or qtdfile.decode_regs().
+       config1 and config2 are the CONFIG1 and CONFIG2 register values
+       the batch was measured with.
+       Returns (norm_lsb, pulses, tofs), where norm_lsb and pulses have
+       one entry per measurement and tofs is (n x 5) seconds.
+       As in TDC7201.compute_tofs(), a TOF is 0 if that pulse was not seen,
+       and pulses is 6 if there was no calibration.
+    """
+    if np is None:
+        raise RuntimeError("compute_tofs_batch() requires numpy")
+    regs = np.asarray(regs, dtype=np.float64)
+    if regs.ndim == 1:
+        regs = regs.reshape(1, -1)
+    time_n = regs[:, 0:11:2]	# TIME1 .. TIME6
+    count_n = regs[:, 1:10:2]	# CLOCK_COUNT1 .. CLOCK_COUNT5
+    cal_pers = (2, 10, 20, 40)[(config2 & TDC7201._CF2_CALIBRATION_PERIODS) >> 6]
+    cal_count = (regs[:, 12] - regs[:, 11]) / (cal_pers - 1)
+    calibrated = cal_count != 0
+    norm_lsb = np.zeros(len(regs))
+    np.divide(clock_period, cal_count, out=norm_lsb, where=calibrated)
+    if (config1 & TDC7201._CF1_MEAS_MODE) == TDC7201._CF1_MM2:
+        avg = 1 << ((config2 & TDC7201._CF2_AVG_CYCLES) >> 3)
+        seen = (time_n[:, 1:] != 0) | (count_n != 0)
+        tofs = (norm_lsb[:, None] * (time_n[:, :1] - time_n[:, 1:])
+                + count_n * (clock_period / avg))
+    else:
+        # According to manual, needs no adjustment for averaging.
+        seen = time_n[:, :5] != 0
+        tofs = norm_lsb[:, None] * time_n[:, :5]
+    tofs[~seen] = 0.0
+    pulses = np.count_nonzero(tofs, axis=1)
+    pulses[~calibrated] = 6	# No calibration, therefore can't compute timing.
+    return (norm_lsb, pulses, tofs)
+
+
 # Map of EVM board header pinout.
 # "." means No Connect, parentheses mean probably optional.
 #      +3.3V  1	 21 .		 (DTG_TRIG) 40	20 GND
@@ -199,26 +297,113 @@ class TDC7201():
     # Which one you are talking to depends on the chip select!
     # Within spidev, you need to close one side and then open the other to switch.
 
-    # TDC7201 clock, for calculating actual TOFs
-    clockFrequency = None		# 8 MHz for EVM clock
-    clockPeriod = None			# 125 nS for EVM clock
-
+    _INT_SLACK = 0.000010	# Allowance for GPIO latency when timing out on INT, in S
+    _CONFIG_RETRIES = 5	# Attempts at writing the configuration, see write_config()
+    _CONFIG_BACKOFF = 0.0001	# First wait after a failed attempt, in S
+    # Power-up timing (see on()).
+    _RESET_TIME = 0.000001	# No specified minimum, but be safe
+    _SPI_READY_TIME = 0.0001
+    _LDO_SETTLE_TIME = 0.0015
+    # Stages of a measurement, as timed by start_stage_timing():
+    # TRIG1 and START_MEAS, START and STOP pulses (only when simulating),
+    # waiting for INT1, reading the results over SPI, and counting pulses.
+    STAGES = ("trigger", "pulses", "interrupt", "read", "count")
+    STAGE_PERCENTILES = (50, 90, 99, 99.9)
     _minSPIspeed = 50000
     _maxSPIspeed = 25000000
-
-
-    def __init__(self):
+    _absMaxSPIspeed = 33300000	# highest seen to work at all
+    # SPI clock speeds tried by calibrate_spi_clock(): the Pi divides a 250 MHz
+    # core clock by an even number, so only some speeds are really available.
+    SPI_SPEEDS = (10416667, 12500000, 15625000, 20833333, 25000000, 31250000)
+    # Test bytes for spi_errors(). Overclocking errors look like
+    # read_value = write_value | (write_value >> 1), so use isolated 1 bits.
+    _SCRATCH_PATTERNS = (0b10101010, 0b01010101, 0b10000001, 0b01000010,
+                         0b00100100, 0b00011000, 0b11111111, 0b00000000)
+
+    # Fixed set of instance variables: smaller objects, and faster attribute access.
+    __slots__ = ("_gpio", "_spi", "_spis",
+                 "reg", "_reg_bytes", "_reg", "_reg_b", "side", "chip_select",
+                 "clockFrequency", "clockPeriod", "ext_clock_frequency",
+                 "spi_timing", "spi_transactions", "spi_ns",
+                 "stage_timing", "stage_ns", "stage_count",
+                 # Pin assignments, see initGPIO()
+                 "sclk", "miso", "mosi", "cs1", "cs2", "enable", "osc_enable",
+                 "trig1", "int1", "trig2", "int2", "start", "stop",
+                 # Settings from configure()
+                 "meas_mode", "cal_pers", "interrupt_wait_time", "interrupt_timeout",
+                 # How to wait for INT, see wait_for_interrupt()
+                 "interrupt_poll_time", "clock",
+                 # STOP pulse trains for simulate=True, see tdc7201.stimulus
+                 "stimulus",
+                 # Wedged-chip recovery, see recover()
+                 "_config_images", "recoveries", "recovery_time", "last_recovery_time",
+                 # Results from compute_tofs()
+                 "cal_count", "norm_lsb", "tof1", "tof2", "tof3", "tof4", "tof5",
+                )
+
+    def __init__(self, spi=None, gpio=None, spi2=None, clock=None):
+        # Backends for SPI and GPIO.
+        # Default to the real hardware (spidev and RPi.GPIO),
+        # but anything with the same interface will do,
+        # for example the chip model in tdc7201.emulator.
+        if gpio is None:
+            if GPIO is None:
+                raise RuntimeError("RPi.GPIO not available")
+            gpio = GPIO
+        self._gpio = gpio
+        if spi is None:
+            if spidev is None:
+                raise RuntimeError("spidev not available")
+            spi = spidev.SpiDev()
         # Instance variables
-        self._spi = spidev.SpiDev()
+        self._spi = spi
+        # Separate SPI handles for each side, once open_both_sides() is called.
+        self._spis = [None, None, spi2]
+        # Internal copy of the chip registers, a compact array per side.
+        # self.reg[0] is unused, so that side numbers can be indexes.
         self.reg = [None for i in range(3)]
-        self.reg[1] = [None for i in range(self.MAXREG24+1)]
-        self.reg[2] = [None for i in range(self.MAXREG24+1)]
+        self.reg[1] = array('I', [0]) * (self.MAXREG24+1)
+        self.reg[2] = array('I', [0]) * (self.MAXREG24+1)
+        # Byte-level views of the same memory, for read_regs24().
+        self._reg_bytes = [None, memoryview(self.reg[1]).cast('B'), memoryview(self.reg[2]).cast('B')]
+        # TDC7201 clock, for calculating actual TOFs
+        self.clockFrequency = None	# 8 MHz for EVM clock
+        self.clockPeriod = None		# 125 nS for EVM clock
         self.ext_clock_frequency = None
+        # SPI transaction counters, for measure_many().
+        # Timing each transaction costs a little, so it is off by default.
+        self.spi_timing = False
+        self.spi_transactions = 0
+        self.spi_ns = 0	# total nanoseconds spent in timed transactions
+        # Per-stage timestamps, see start_stage_timing(). Off by default.
+        self.stage_timing = False
+        self.stage_ns = None
+        self.stage_count = 0	# measurements recorded in stage_ns
+        # Waiting for INT: spin-poll this many seconds before falling back
+        # to wait_for_edge(). 0 means always use wait_for_edge().
+        self.interrupt_poll_time = 0.0
+        self.interrupt_wait_time = 1	# in mS, set by configure()
+        self.interrupt_timeout = 0.001	# in S, set by configure()
+        # Clock used to time the polling; the emulator supplies its own.
+        if clock is None:
+            clock = time.perf_counter
+        self.clock = clock
+        # Pool of STOP pulse trains for simulated measurements.
+        # None means make a default one when first needed.
+        self.stimulus = None
+        # Last verified configuration burst for each side, for recover().
+        self._config_images = [None, None, None]
+        self.recoveries = 0
+        self.recovery_time = 0.0	# total seconds spent in recover()
+        self.last_recovery_time = 0.0
         # Open SPI to side 1 of the chip
         # Later we should write routines.
         try:
             self._spi.open(0, 0)	# Open SPI port 0, RPi CS0 = chip CS1.
             self.side = 1	# chip side 1 = RPi side 0
+            # Shortcuts to the current side's registers, to save double indexing.
+            self._reg = self.reg[1]
+            self._reg_b = self._reg_bytes[1]
         except FileNotFoundError:
             print("Unable to open SPI device. Is SPI enabled?")
             print("You can use 'lsmod | grep spi' to check if any SPI kernel modules are loaded.")
@@ -260,12 +445,46 @@ class TDC7201():
             print("Setting 3-wire to False")
             self._spi.threewire = False
 
+    @property
+    def reg1(self):
+        """Internal copy of the side 1 chip registers."""
+        return self.reg[1]
+
     def set_side(self, side):
         # For now, unless side has changed, don't do anything.
         if side != self.side:
-            self._spi.close()
-            self._spi.open(0, side-1)	# RPi CS0 = chip CS1, RPi CS1 = chip CS2.
+            if self._spis[1] is not None:
+                # Both sides are open; just switch handles.
+                self._spi = self._spis[side]
+            else:
+                self._spi.close()
+                self._spi.open(0, side-1)	# RPi CS0 = chip CS1, RPi CS1 = chip CS2.
             self.side = side
+            self._reg = self.reg[side]
+            self._reg_b = self._reg_bytes[side]
+
+    def open_both_sides(self):
+        """Keep SPI open to both sides of the chip at once,
+           so that set_side() doesn't need to close and reopen spidev.
+        """
+        if self._spis[1] is not None:
+            return
+        self.set_side(1)
+        spi2 = self._spis[2]
+        if spi2 is None:
+            if spidev is None:
+                raise RuntimeError("spidev not available")
+            spi2 = spidev.SpiDev()
+        spi2.open(0, 1)	# RPi CS1 = chip CS2.
+        spi2.max_speed_hz = self._spi.max_speed_hz
+        spi2.mode = self._spi.mode
+        spi2.bits_per_word = self._spi.bits_per_word
+        self._spis[1] = self._spi
+        self._spis[2] = spi2
+
+    def snapshot(self):
+        """Return a copy of the current side's internal register copy."""
+        return self._reg[:]	# one memcpy
 
     def initGPIO(self,
                  enable=12,	# GPIO 18 = header pin 12
@@ -337,8 +556,8 @@ class TDC7201():
 
            Unused signals may be set to None to save a pin.
         """
-        GPIO.setmode(GPIO.BOARD)	# Use header pin numbers, not GPIO numbers.
-        GPIO.setwarnings(False)
+        self._gpio.setmode(self._gpio.BOARD)	# Use header pin numbers, not GPIO numbers.
+        self._gpio.setwarnings(False)
         #print("Initializing Raspberry Pi pin directions for tdc7201 driver.")
         print("Initializing tdc7201 driver.")
 
@@ -381,7 +600,7 @@ class TDC7201():
         self.enable = enable # remember it
         if enable is not None:
             reserve_pin("ENABLE", enable)
-            GPIO.setup(enable, GPIO.OUT, initial=GPIO.LOW)
+            self._gpio.setup(enable, self._gpio.OUT, initial=self._gpio.LOW)
             if verbose:
                 print("Set ENABLE to output on pin", enable)
                 print("Reset asserted (ENABLE = low) on pin", enable)
@@ -391,9 +610,9 @@ class TDC7201():
         # Both chip selects must start out HIGH (inactive).
         # Not sure we can do that through GPIO lib though.
         # For intial tests, disable side 2.
-        #GPIO.setup(self.cs1, GPIO.OUT, initial=GPIO.HIGH)
+        #self._gpio.setup(self.cs1, self._gpio.OUT, initial=self._gpio.HIGH)
         # Permanently (?) turn off SPI on side #2.
-        #GPIO.setup(self.cs2, GPIO.OUT, initial=GPIO.HIGH)
+        #self._gpio.setup(self.cs2, self._gpio.OUT, initial=self._gpio.HIGH)
 
         # Start the on-board clock generator running.
         # May not be necessary if you supply an external clock.
@@ -401,7 +620,7 @@ class TDC7201():
         if osc_enable is not None:
             # Need an option to set OSC_ENABLE low and use external clock.
             reserve_pin("OSC_ENABLE", osc_enable)
-            GPIO.setup(osc_enable, GPIO.OUT, initial=GPIO.HIGH)
+            self._gpio.setup(osc_enable, self._gpio.OUT, initial=self._gpio.HIGH)
             self.clockFrequency = 8000000			# 8 MHz
             self.clockPeriod = 1.0 / self.clockFrequency	# 125 nS
             if verbose:
@@ -414,7 +633,7 @@ class TDC7201():
         self.trig1 = trig1 # remember it
         if trig1 is not None:
             reserve_pin("TRIG1", trig1)
-            GPIO.setup(trig1, GPIO.IN)
+            self._gpio.setup(trig1, self._gpio.IN)
             if verbose:
                 print("Set TRIG1 to input on pin", trig1)
         else:
@@ -424,7 +643,7 @@ class TDC7201():
         reserve_pin("INT1", int1)
         self.int1 = int1 # remember it
         if int1 is not None:
-            GPIO.setup(int1, GPIO.IN)
+            self._gpio.setup(int1, self._gpio.IN)
             if verbose:
                 print("Set INT1 to input on pin", int1)
         else:
@@ -436,7 +655,7 @@ class TDC7201():
         self.trig2 = trig2 # remember it
         reserve_pin("TRIG2", trig2)
         if trig2 is not None:
-            GPIO.setup(trig2, GPIO.IN)
+            self._gpio.setup(trig2, self._gpio.IN)
             if verbose:
                 print("Set TRIG2 to input on pin", trig2)
         else:
@@ -446,7 +665,7 @@ class TDC7201():
         self.int2 = int2 # remember it
         if int2 is not None:
             reserve_pin("INT2", int2)
-            GPIO.setup(int2, GPIO.IN)
+            self._gpio.setup(int2, self._gpio.IN)
             if verbose:
                 print("Set INT2 to input on pin", int2)
         else:
@@ -457,7 +676,7 @@ class TDC7201():
         self.start = start # remember it
         if start is not None:
             reserve_pin("START", start)
-            GPIO.setup(start, GPIO.OUT, initial=GPIO.LOW)
+            self._gpio.setup(start, self._gpio.OUT, initial=self._gpio.LOW)
             if verbose:
                 print("Set START to output (low) on pin", start)
         else:
@@ -466,16 +685,26 @@ class TDC7201():
         self.stop = stop # remember it
         if stop is not None:
             reserve_pin("STOP", stop)
-            GPIO.setup(stop, GPIO.OUT, initial=GPIO.LOW)
+            self._gpio.setup(stop, self._gpio.OUT, initial=self._gpio.LOW)
             if verbose:
                 print("Set STOP to output (low) on pin", stop, ".")
         else:
             print("WARNING: STOP pin is not assigned. Simulating STOP signals will not work.")
 
+    def prepare_stimulus(self):
+        """Draw the default STOP pulse trains for simulate=True, if there are none yet.
+           This takes a while (and several MB), so it is only done when a simulated
+           measurement is first asked for, and never between START and STOP.
+           Call it before timing simulated measurements.
+        """
+        if self.stimulus is None and self.stop is not None and np is not None:
+            from .stimulus import StimulusPool
+            self.stimulus = StimulusPool()
+
     def off(self):
         """Close SPI, turn TDC7201 off, and wait for reset to take effect."""
         print("Turning off tdc7201.")
-        GPIO.output(self.enable, GPIO.LOW)
+        self._gpio.output(self.enable, self._gpio.LOW)
         # There is no specified minimum reset time,
         # but let's wait at least a microsecond to be safe.
         time.sleep(0.000001)
@@ -485,13 +714,13 @@ class TDC7201():
         now = time.time()
         print("tdc7201 enabled at", now)
         # Turn on chip enable.
-        GPIO.output(self.enable, GPIO.HIGH)
+        self._gpio.output(self.enable, self._gpio.HIGH)
         # Wait for chip to settle.
         # SPI available in 0.1 mS.
         # LDO is mostly settled (within 0.3%) in 0.3 mS,
         # fully settled in 1.5 mS.
-        # Might be better to use the time configuring.
-        time.sleep(0.0015)
+        # recover() uses this time to restore the configuration.
+        time.sleep(self._LDO_SETTLE_TIME)
 
     def configure(self,
            side=1,	# Which side of the chip to configure
@@ -538,20 +767,6 @@ class TDC7201():
                 meas_mode = 1
             self.reg[side][self.CONFIG1] = cf1_state
         self.meas_mode = meas_mode
-        # Write+read occasionally fails when SPI is overclocked.
-        # That is, the value you read back is not what you wrote.
-        # Repeat until success.
-        # Should usually only take 1 attempt, although there are
-        # sometimes clusters of failures immediately after on().
-        self.write8(self.CONFIG1, cf1_state)
-        cf1_read = self.read8(self.CONFIG1)
-        if cf1_read == 0 and cf1_state != 0:
-            print("Are you sure the TDC7201 is connected to the Pi's SPI interface?")
-            self.exit()
-        while cf1_read != cf1_state:
-            print("Failed to set CONFIG1.", format(cf1_state, "08b"), "=>", format(cf1_read, "08b"))
-            self.write8(self.CONFIG1, cf1_state)
-            cf1_read = self.read8(self.CONFIG1)
 
         # Configuration register 2
         if retain_state:
@@ -626,14 +841,6 @@ class TDC7201():
                 cf2_state |= self._CF2_NSTOP_1
                 print(num_stop, "is not a valid number of stop pulses, defaulting to 1.")
             self.reg[side][self.CONFIG2] = cf2_state
-        # Writing occasionally fails. Repeat until success.
-        # Should usually only take 1 attempt.
-        self.write8(self.CONFIG2, cf2_state)
-        cf2_read = self.read8(self.CONFIG2)
-        while cf2_read != cf2_state:
-            print("Failed to set CONFIG2.", format(cf2_state, "08b"), "=>", format(cf2_read, "08b"))
-            self.write8(self.CONFIG2, cf2_state)
-            cf2_read = self.read8(self.CONFIG2)
 
         # Interrupt mask
         if retain_state:
@@ -647,13 +854,10 @@ class TDC7201():
                 # error?
                 im_state = 0
             self.reg[side][self.INT_MASK] = im_state
-        self.write8(self.INT_MASK, im_state)
-        # Writing occasionally fails. Repeat until success.
-        # Should usually only take 1 attempt.
-        self.write8(self.INT_MASK, im_state)
-        while self.read8(self.INT_MASK) != im_state:
-            print("Failed to set INT_MASK.")
-            self.write8(self.INT_MASK, im_state)
+            # Not configurable, so leave the coarse counter overflow at its HW reset default.
+            self.reg[side][self.COARSE_CNTR_OVF] = 0xFFFF
+            self.reg[side][self.COARSE_CNTR_OVF_H] = 0xFF
+            self.reg[side][self.COARSE_CNTR_OVF_L] = 0xFF
 
         # CLOCK_CNTR_STOP
         if retain_state:
@@ -666,12 +870,6 @@ class TDC7201():
                 print("clock_cntr_stop", clock_cntr_stop, "too large, using", self.reg[side][self.CLOCK_CNTR_STOP_MASK])
             self.reg[side][self.CLOCK_CNTR_STOP_MASK_H] = (clock_cntr_stop >> 8) & 0xFF
             self.reg[side][self.CLOCK_CNTR_STOP_MASK_L] = clock_cntr_stop & 0xFF
-        self.write16(self.CLOCK_CNTR_STOP_MASK_H, clock_cntr_stop)
-        # Writing occasionally fails. Repeat until success.
-        # Should usually only take 1 attempt.
-        while self.read16(self.CLOCK_CNTR_STOP_MASK_H) != clock_cntr_stop:
-            print("Failed to set CLOCK_CNTR_STOP_MASK.")
-            self.write16(self.CLOCK_CNTR_STOP_MASK_H, clock_cntr_stop)
 
         # Set overflow timeout.
         if retain_state:
@@ -702,14 +900,102 @@ class TDC7201():
         self.reg[side][self.CLOCK_CNTR_OVF] = ovf
         self.reg[side][self.CLOCK_CNTR_OVF_H] = (ovf >> 8) & 0xFF
         self.reg[side][self.CLOCK_CNTR_OVF_L] = ovf & 0xFF
-        self.write16(self.CLOCK_CNTR_OVF_H, ovf)
-        # Writing occasionally fails. Repeat until success.
-        # Should usually only take 1 attempt.
-        while self.read16(self.CLOCK_CNTR_OVF_H) != ovf:
-            print("Failed to set CLOCK_CNTR_OVF_H.")
-            self.write16(self.CLOCK_CNTR_OVF_H, ovf)
+        # Send the whole register image to the chip at once, and check it.
+        self.write_config()
         # Calculate interrupt wait time here, because it doesn't change over batches.
         self.interrupt_wait_time = 1 + int(self.clockPeriod * self.reg[side][self.CLOCK_CNTR_OVF] * 1000)	# in mS
+        # wait_for_edge() only does whole mS, but polling can time out exactly.
+        self.interrupt_timeout = self.clockPeriod * self.reg[side][self.CLOCK_CNTR_OVF] + self._INT_SLACK
+
+    def write_config(self, retries=_CONFIG_RETRIES, backoff=_CONFIG_BACKOFF):
+        """Write the internal copy of all the 8-bit registers (CONFIG1 through
+           CLOCK_CNTR_STOP_MASK_L) to the current side in one auto-increment burst,
+           clearing INT_STATUS, then check them with a single read_regs8().
+           Write+read occasionally fails when SPI is overclocked (the value you
+           read back is not what you wrote), especially right after on(),
+           so retry up to retries times, waiting backoff S (doubling) in between.
+           Raises RuntimeError if every register reads back as zero (chip off or
+           not connected), or if it still fails after retries attempts.
+           Returns the number of attempts needed.
+        """
+        reg = self._reg
+        image = [reg[i] & 0xFF for i in range(self.MINREG8, self.MAXREG8+1)]
+        image[self.INT_STATUS] = 0b00011111	# Write a 1 to each bit to clear it.
+        burst = bytes([self.MINREG8|self._WRITE|self._AI] + image)
+        for attempt in range(1, retries+1):
+            self._spi.writebytes2(burst)
+            self.read_regs8()
+            bad = [i for i in range(self.MINREG8, self.MAXREG8+1)
+                   if i != self.INT_STATUS and reg[i] != image[i]]
+            if not bad:
+                # Remember it, so recover() can restore it quickly.
+                self._config_images[self.side] = burst
+                return attempt
+            dead = not any(reg[self.MINREG8:self.MAXREG8+1])
+            if not dead:
+                print("Failed to set", ", ".join(self.REGNAME[i] + " " + format(image[i], "08b") +
+                                                 " => " + format(reg[i], "08b") for i in bad))
+            # read_regs8() overwrote the internal copy; put back what we want.
+            for i in bad:
+                reg[i] = image[i]
+            for (pair, high) in ((self.COARSE_CNTR_OVF, self.COARSE_CNTR_OVF_H),
+                                 (self.CLOCK_CNTR_OVF, self.CLOCK_CNTR_OVF_H),
+                                 (self.CLOCK_CNTR_STOP_MASK, self.CLOCK_CNTR_STOP_MASK_H)):
+                reg[pair] = (reg[high] << 8) | reg[high+1]
+            if dead:
+                # Nothing reads back at all, so retrying won't help.
+                raise RuntimeError("TDC7201 side " + str(self.side) + " reads back all zeros;"
+                                   " is it on, and connected to the Pi's SPI interface?")
+            time.sleep(backoff)
+            backoff *= 2
+        raise RuntimeError("Couldn't configure TDC7201 side " + str(self.side) +
+                           " after " + str(retries) + " attempts")
+
+    def recover(self):
+        """Reset a wedged chip, and restore the last verified configuration of each side.
+           Instead of off(), on() and configure(retain_state=True), which sleep
+           and print, this takes one SPI burst and one read per side, sent while
+           the LDO is still settling. It falls back to write_config() (with retries)
+           if the quick check fails.
+           Counts recoveries, and their time in last_recovery_time and recovery_time.
+        """
+        perf_counter = time.perf_counter
+        begin = perf_counter()
+        gpio = self._gpio
+        gpio.output(self.enable, gpio.LOW)
+        while perf_counter() - begin < self._RESET_TIME:
+            pass
+        gpio.output(self.enable, gpio.HIGH)
+        enabled = perf_counter()
+        # Registers can be written as soon as SPI is available,
+        # well before the LDO settles enough for accurate measurements.
+        while perf_counter() - enabled < self._SPI_READY_TIME:
+            pass
+        side = self.side
+        for s in (1, 2):
+            burst = self._config_images[s]
+            if burst is None:
+                continue
+            self.set_side(s)
+            self._spi.writebytes2(burst)
+            self.read_regs8()
+            reg = self._reg
+            if any(reg[i] != burst[i+1] for i in range(self.MINREG8, self.MAXREG8+1)
+                   if i != self.INT_STATUS):
+                # Put the internal copy back, then do it the slow way.
+                for i in range(self.MINREG8, self.MAXREG8+1):
+                    if i != self.INT_STATUS:
+                        reg[i] = burst[i+1]
+                self.write_config()
+        self.set_side(side)
+        # Sleep only for whatever is left of the settling time.
+        remaining = self._LDO_SETTLE_TIME - (perf_counter() - enabled)
+        if remaining > 0:
+            time.sleep(remaining)
+        self.last_recovery_time = perf_counter() - begin
+        self.recovery_time += self.last_recovery_time
+        self.recoveries += 1
+        return self.last_recovery_time
 
     def write8(self, reg, val):
         """Write one 8-bit register."""
@@ -753,14 +1039,14 @@ class TDC7201():
         """Read all 8-bit registers, using auto-increment feature."""
         result8 = self._spi.xfer(self.REG8_TUPLE_WITH_PADDING)
         # First (0th) byte is always 0, rest are desired values.
-        self.reg[self.side][0:self.MAXREG8] = result8[1:]
+        self._reg[0:self.MAXREG8+1] = array('I', result8[1:])
         # 16-bit combinations
-        self.reg[self.side][self.COARSE_CNTR_OVF] = (
-            (self.reg[self.side][self.COARSE_CNTR_OVF_H] << 8) | self.reg[self.side][self.COARSE_CNTR_OVF_L])
-        self.reg[self.side][self.CLOCK_CNTR_OVF] = (
-            (self.reg[self.side][self.CLOCK_CNTR_OVF_H] << 8) | self.reg[self.side][self.CLOCK_CNTR_OVF_L])
-        self.reg[self.side][self.CLOCK_CNTR_STOP_MASK] = (
-            (self.reg[self.side][self.CLOCK_CNTR_STOP_MASK_H] << 8) | self.reg[self.side][self.CLOCK_CNTR_STOP_MASK_L])
+        self._reg[self.COARSE_CNTR_OVF] = (
+            (self._reg[self.COARSE_CNTR_OVF_H] << 8) | self._reg[self.COARSE_CNTR_OVF_L])
+        self._reg[self.CLOCK_CNTR_OVF] = (
+            (self._reg[self.CLOCK_CNTR_OVF_H] << 8) | self._reg[self.CLOCK_CNTR_OVF_L])
+        self._reg[self.CLOCK_CNTR_STOP_MASK] = (
+            (self._reg[self.CLOCK_CNTR_STOP_MASK_H] << 8) | self._reg[self.CLOCK_CNTR_STOP_MASK_L])
 
     REG24_TUPLE_WITH_PADDING = (MINREG24|_AI,
                                0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
@@ -768,15 +1054,34 @@ class TDC7201():
                                0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
                                0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
                                0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00)
+    # Where the low, middle, and high bytes of each 24-bit register live
+    # in the byte view of a little-endian array of 32-bit ints.
+    _FAST_UNPACK = (sys.byteorder == 'little') and (array('I').itemsize == 4)
+    _REG24_LO = slice(4*MINREG24, 4*(MAXREG24+1), 4)
+    _REG24_MID = slice(4*MINREG24+1, 4*(MAXREG24+1), 4)
+    _REG24_HI = slice(4*MINREG24+2, 4*(MAXREG24+1), 4)
     def read_regs24(self):
         """Read all 24-bit chip registers, using auto-increment feature."""
         result24 = self._spi.xfer(self.REG24_TUPLE_WITH_PADDING)
+        if self._FAST_UNPACK:
+            # Data comes in MSB first, after a leading 0 byte.
+            # Scatter each byte straight into place in the register array,
+            # three strided copies instead of a Python loop over 13 registers.
+            # The top byte of each register is always 0.
+            # (This is about 40% faster than the loop below;
+            # unpacking with numpy is slower still, due to call overhead.)
+            data = bytes(result24)
+            reg_bytes = self._reg_b
+            reg_bytes[self._REG24_LO] = data[3::3]
+            reg_bytes[self._REG24_MID] = data[2::3]
+            reg_bytes[self._REG24_HI] = data[1::3]
+            return
         i = 1	# First (0th) byte is always 0, rest are desired values.
         for reg in range(self.MINREG24, self.MAXREG24+1):
             # Data comes in MSB first.
-            self.reg[self.side][reg] = (result24[i] << 16) | (result24[i+1] << 8) | result24[i+2]
+            self._reg[reg] = (result24[i] << 16) | (result24[i+1] << 8) | result24[i+2]
             # Unfortunately, the built in method is MUCH slower.
-            #self.reg[self.side][reg] = int.from_bytes(result24[i:i+2],byteorder='big')
+            #self._reg[reg] = int.from_bytes(result24[i:i+2],byteorder='big')
             i += 3
 
     def read_regs(self):
@@ -792,56 +1097,58 @@ class TDC7201():
     def print_regs1(self):
         """Print out all the (copies of the) register values."""
         for reg in range(self.MINREG8, self.MAXREG8+1):
-            print(self.REGNAME[reg], hex(self.reg[self.side][reg]))
+            print(self.REGNAME[reg], hex(self._reg[reg]))
         # Use combined registers for brevity.
         for reg in range(self.COARSE_CNTR_OVF, self.CLOCK_CNTR_STOP_MASK+1):
-            print(self.REGNAME[reg], self.reg[self.side][reg])
+            print(self.REGNAME[reg], self._reg[reg])
         for reg in range(self.MINREG24, self.MAXREG24+1):
-            print(self.REGNAME[reg], self.reg[self.side][reg])
+            print(self.REGNAME[reg], self._reg[reg])
 
     def tof_mm1(self, time_n):
         """Compute a Time-Of-Flight assuming measurement mode 1."""
         #assert self.meas_mode == self._CF1_MM1
         # Compute time-of-flight from START to a STOP.
-        if self.reg[self.side][time_n]:
-            return self.norm_lsb*self.reg[self.side][time_n]
+        if self._reg[time_n]:
+            return self.norm_lsb*self._reg[time_n]
         return 0
 
     def tof_mm2(self, time1, time_n, count, avg):
         """Compute a Time-Of-Flight assuming measurement mode 2."""
         #assert self.meas_mode == self._CF1_MM2
         # Compute time-of-flight given Measurement Mode 2 data for two adjacent stops.
-        if self.reg[self.side][time_n] or self.reg[self.side][count]:
-            return self.norm_lsb*(self.reg[self.side][time1]-self.reg[self.side][time_n]) + \
-                   (self.reg[self.side][count]/avg)*self.clockPeriod
+        if self._reg[time_n] or self._reg[count]:
+            return self.norm_lsb*(self._reg[time1]-self._reg[time_n]) + \
+                   (self._reg[count]/avg)*self.clockPeriod
         return 0
 
     def count_pulses(self):
         """Count how many pulses we got, without computing TOFs."""
+        reg = self._reg
         pulses = 0
-        if self.meas_mode == self._CF1_MM1:
+        if self.meas_mode == 1:
             for time_n in (self.TIME1,self.TIME2,self.TIME3,self.TIME4,self.TIME5):
-                if self.reg[self.side][time_n]:
+                if reg[time_n]:
                     pulses += 1
                 else:
                     return(pulses)
-        elif self.meas_mode == self._CF1_MM2:
+        elif self.meas_mode == 2:
             for time_n in (self.TIME1,self.TIME2,self.TIME3,self.TIME4,self.TIME5):
                 clock_count_n = time_n + 1
-                #if self.reg[self.side][time_n] or self.reg[self.side][clock_count_n]:
-                if self.reg[self.side][clock_count_n]:
+                #if reg[time_n] or reg[clock_count_n]:
+                if reg[clock_count_n]:
                     pulses += 1
                 else:
                     return(pulses)
         else:
             print("count_pulses(): Illegal measurement mode", self.meas_mode)
             return(6)	# "Couldn't compute TOFs" error
+        return(pulses)	# All 5 seen.
 
     # Check if we got any pulses and calculate the TOFs.
     def compute_tofs(self):
         """Compute all the Time-Of-Flights."""
         #print("Computing TOFs.")
-        self.cal_count = ((self.reg[self.side][self.CALIBRATION2] - self.reg[self.side][self.CALIBRATION1])
+        self.cal_count = ((self._reg[self.CALIBRATION2] - self._reg[self.CALIBRATION1])
                           / (self.cal_pers - 1))
         #print("cal_count:", self.cal_count)
         if self.cal_count == 0:
@@ -851,7 +1158,7 @@ class TDC7201():
         #print("clockPeriod:", self.clockPeriod)
         #print("norm_lsb:", self.norm_lsb)
         pulses = 0
-        if self.meas_mode == self._CF1_MM1:
+        if self.meas_mode == 1:
             # According to manual, needs no adjustment for averaging.
             self.tof1 = self.tof_mm1(self.TIME1)
             #print("TOF1 =", self.tof1)
@@ -865,9 +1172,9 @@ class TDC7201():
             pulses += bool(self.tof4)
             self.tof5 = self.tof_mm1(self.TIME5)
             pulses += bool(self.tof5)
-        elif self.meas_mode == self._CF1_MM2:
+        elif self.meas_mode == 2:
             # Average cycles
-            log_avg = (self.reg[self.side][self.CONFIG2] & self._CF2_AVG_CYCLES) >> 3
+            log_avg = (self._reg[self.CONFIG2] & self._CF2_AVG_CYCLES) >> 3
             #print("log_avg =", log_avg)
             avg = 1 << log_avg
             #print("avg =", avg)
@@ -914,7 +1221,7 @@ class TDC7201():
             # Write a 1 to each set bit to clear it.
             self.write8(self.INT_STATUS, int_stat)
             int_stat = self.read8(self.INT_STATUS)
-            self.reg[self.side][self.INT_STATUS] = int_stat # Update internal copy.
+            self._reg[self.INT_STATUS] = int_stat # Update internal copy.
             if verbose:
                 print("After clearing we got", bin(int_stat))
         else:
@@ -927,8 +1234,19 @@ class TDC7201():
            Prepend error_prefix to every error message.
            If log_file is given, write errors there, else print them.
         """
+        if simulate and self.stimulus is None:
+            self.prepare_stimulus()
+        # Stage timestamps go in the next free row of stage_ns, if any.
+        stages = self.stage_timing
+        if stages:
+            perf_counter_ns = time.perf_counter_ns
+            stage_ns = self.stage_ns
+            row = self.stage_count * (len(self.STAGES) + 1)
+            stages = row < len(stage_ns)
+            if stages:
+                stage_ns[row] = perf_counter_ns()
 #        # Check GPIO state doesn't indicate a measurement is happening.
-#        if not GPIO.input(self.int1):
+#        if not self._gpio.input(self.int1):
 #            err_str = error_prefix + "ERROR 13: INT1 already active (low)."
 #            if log_file:
 #                log_file.write(err_str+'\n')
@@ -940,12 +1258,12 @@ class TDC7201():
         # TRIG should be low if rising-edge, high if falling-edge.
         # Don't check this is trig1 is set to None.
         if self.trig1:
-            trig_falling = (self.reg[self.side][self.CONFIG1] & self._CF1_TRIGG_EDGE) > 0
+            trig_falling = (self._reg[self.CONFIG1] & self._CF1_TRIGG_EDGE) > 0
             trig_error = False
-            if GPIO.input(self.trig1) and not trig_falling:
+            if self._gpio.input(self.trig1) and not trig_falling:
                 err_str = error_prefix + "ERROR 12: TRIG1 should be low."
                 trig_error = True
-            elif not GPIO.input(self.trig1) and trig_falling:
+            elif not self._gpio.input(self.trig1) and trig_falling:
                 err_str = error_prefix + "ERROR 12: TRIG1 should be high."
                 trig_error = True
             if trig_error:
@@ -956,12 +1274,10 @@ class TDC7201():
                 # This is a very serious error that means the chip is wedged.
                 # Clearing the status register does NOT fix it.
                 # Only hope is to reset the chip.
-                self.off()
-                self.on()
-                self.configure(retain_state=True)
+                self.recover()
                 return 12
         # To start measurement, need to set START_MEAS in TDCx_CONFIG1 register.
-        cf1_state = self.reg[self.side][self.CONFIG1]
+        cf1_state = self._reg[self.CONFIG1]
         # All error 11s follow an error 7 in the previous measurement.
         # If we can fix the error 7s, these should disappear too.
 #        # First read current value.
@@ -987,13 +1303,13 @@ class TDC7201():
         if self.trig1:
             err_str = None
             if trig_falling:
-                if GPIO.input(self.trig1):	# Don't wait for a falling edge if it's already low!
-                    channel = GPIO.wait_for_edge(self.trig1, GPIO.FALLING, timeout=1)
+                if self._gpio.input(self.trig1):	# Don't wait for a falling edge if it's already low!
+                    channel = self._gpio.wait_for_edge(self.trig1, self._gpio.FALLING, timeout=1)
                     if channel is None:
                         err_str = error_prefix + "ERROR 10: Timed out waiting for TRIG1 to fall."
             else:
-                if not GPIO.input(self.trig1):	# Don't wait for a rising edge if it's already high!
-                    channel = GPIO.wait_for_edge(self.trig1, GPIO.RISING, timeout=1)
+                if not self._gpio.input(self.trig1):	# Don't wait for a rising edge if it's already high!
+                    channel = self._gpio.wait_for_edge(self.trig1, self._gpio.RISING, timeout=1)
                     if channel is None:
                         err_str = error_prefix + "ERROR 10: Timed out waiting for TRIG1 to rise."
             if err_str:
@@ -1004,7 +1320,7 @@ class TDC7201():
                 return 10
 # NEVER HAPPENS
         # Check that INT1 is inactive (high) as expected.
-        if not GPIO.input(self.int1):
+        if not self._gpio.input(self.int1):
             err_str = error_prefix + "ERROR 9: INT1 is active (low) too early!"
             if log_file:
                 log_file.write(err_str+'\n')
@@ -1016,50 +1332,432 @@ class TDC7201():
 
         # Last chance to check registers before sending START pulse?
         #print(tdc.REGNAME[tdc.CONFIG2], ":", hex(tdc.read8(tdc.CONFIG2)))
+        if stages:
+            stage_ns[row+1] = perf_counter_ns()
         if simulate:
-            if self.start is not None:
-                # We got a trigger, so issue a START pulse.
-                GPIO.output(self.start, GPIO.HIGH)
-                #time.sleep(0.000000005)
-                GPIO.output(self.start, GPIO.LOW)
-                #print("Generated START pulse.")
-            # former error 8 code:
-            # We used to wait here for TRIG to return to inactive state,
-            # but the chip spec doesn't specify the timing of that behavior.
-            # Deleted that check. Hope it's OK.
-            if self.stop is not None:
-                # Send 0 to NSTOP pulses. FOR TESTING ONLY.
-                n_stop = (self.reg[self.side][self.CONFIG2] & self._CF2_NUM_STOP) + 1
-                upper_limit = 1 << n_stop*2
-                r = random.randrange(upper_limit)
-                while r > 0:
-                    GPIO.output(self.stop, r & 1)
-                    r >>= 1
-                GPIO.output(self.stop, 0)
-        # wait_for_edge() is more power-efficient but slightly slower than polling in a Python loop.
-        # Also note that the int(...) part will often be 0.
-        if GPIO.input(self.int1):	# Don't wait for an edge if it's already low!
-            #delay = int(self.clockPeriod * self.reg[self.side][self.CLOCK_CNTR_OVF] * 1000) + 1	# in mS
-            channel = GPIO.wait_for_edge(self.int1, GPIO.FALLING, timeout=self.interrupt_wait_time)
-            if channel is None:
-                err_str = error_prefix + "ERROR 7: Timed out waiting for INT1."
-                if log_file:
-                    log_file.write(err_str+'\n')
-                else:
-                    print(err_str)
-                return 7
+            self._simulate_pulses()
+        if stages:
+            stage_ns[row+2] = perf_counter_ns()
+        if not self.wait_for_interrupt(self.int1):
+            err_str = error_prefix + "ERROR 7: Timed out waiting for INT1."
+            if log_file:
+                log_file.write(err_str+'\n')
+            else:
+                print(err_str)
+            return 7
+        if stages:
+            stage_ns[row+3] = perf_counter_ns()
 
         # Read everything in and see what we got.
         #print("Reading chip side #1 register state:")
         self.read_regs24()
+        if stages:
+            stage_ns[row+4] = perf_counter_ns()
         #return_code = self.compute_tofs()
         return_code = self.count_pulses()
+        if stages:
+            stage_ns[row+5] = perf_counter_ns()
+            self.stage_count += 1
         #self.clear_status()	# clear interrupts
         return return_code # 0-5 for number of pulses (< NSTOP implies timeout),
                            # 6 if unable to compute TOFs
                            # 7,10,12 for early-return errors above
                            # 8-9,11,13 currently disabled because not needed
 
+    def wait_for_interrupt(self, pin):
+        """Wait for an INT pin to go active (low). Returns False on timeout.
+           Spin-polls for up to interrupt_poll_time seconds first, then falls
+           back to wait_for_edge() for the rest of interrupt_wait_time mS
+           (less the polling time, rounded up to whole mS, but at least 1 mS).
+           If the poll time covers the whole measurement (interrupt_timeout),
+           there is no fallback.
+        """
+        gpio_input = self._gpio.input
+        if not gpio_input(pin):	# Don't wait for an edge if it's already low!
+            return True
+        poll = self.interrupt_poll_time
+        wait = self.interrupt_wait_time
+        if poll > 0:
+            # Polling is faster than wait_for_edge(), and can time out in less
+            # than a mS, but keeps a CPU core busy.
+            clock = self.clock
+            timeout = self.interrupt_timeout
+            begin = clock()
+            deadline = begin + min(poll, timeout)
+            while clock() < deadline:
+                if not gpio_input(pin):
+                    return True
+            if poll >= timeout:
+                return not gpio_input(pin)
+            # Don't wait longer in total than without polling.
+            wait = max(1, wait - math.ceil((clock() - begin) * 1000))
+        return self._gpio.wait_for_edge(pin, self._gpio.FALLING, timeout=wait) is not None
+
+    def calibrate_interrupt_wait(self, n=1000, poll_times=None, simulate=False):
+        """Find the interrupt_poll_time that gives the most good measurements
+           (status 0-5) per second, by running n measurements with each.
+           Only send fake START and STOP pulses (simulate=True) with the emulator;
+           on real hardware, calibrate on the real signals.
+           Must be called after configure().
+           Sets interrupt_poll_time, and returns a dict of results.
+        """
+        if poll_times is None:
+            poll_times = (0.0, 0.000025, 0.000050, 0.000100, self.interrupt_timeout)
+        if simulate:
+            self.prepare_stimulus()	# Not inside the first timed run.
+        clock = self.clock
+        rates = {}
+        for poll in poll_times:
+            self.interrupt_poll_time = poll
+            begin = clock()
+            batch = self.measure_many(n, simulate=simulate, log_file=io.StringIO())
+            elapsed = clock() - begin
+            good = int((batch["status"] <= 5).sum())
+            rates[poll] = good / elapsed if elapsed > 0 else 0.0
+        best = max(rates, key=rates.get)
+        self.interrupt_poll_time = best
+        return {"model": pi_model(),
+                "interrupt_poll_time": best,
+                "rates": rates,
+               }
+
+    def start_stage_timing(self, capacity=100000):
+        """Record time.perf_counter_ns() at the start and at the end of each of the STAGES
+           of every successful measure() or measure_many() measurement,
+           in a preallocated array with room for capacity measurements.
+           Once it is full, no more are recorded until stage_percentiles() resets it.
+        """
+        self.stage_ns = array('q', bytes(8 * (len(self.STAGES) + 1) * capacity))
+        self.stage_count = 0
+        self.stage_timing = True
+
+    def stop_stage_timing(self):
+        """Stop recording stage timestamps. The hooks then cost only a local test each."""
+        self.stage_timing = False
+
+    def stage_percentiles(self, percentiles=STAGE_PERCENTILES, reset=True):
+        """Percentiles of the time spent in each stage (in uS),
+           over the measurements recorded since the last reset.
+           Returns a dict with the number of measurements ("n"), the percentiles,
+           and a list of times for each stage (None if nothing was recorded).
+        """
+        if np is None:
+            raise RuntimeError("stage_percentiles() requires numpy")
+        width = len(self.STAGES) + 1
+        n = self.stage_count
+        summary = {"n": n, "percentiles": list(percentiles)}
+        if n:
+            stamps = np.frombuffer(self.stage_ns, dtype=np.int64, count=n*width).reshape(n, width)
+            durations = np.diff(stamps, axis=1) / 1000.0
+        for (k, stage) in enumerate(self.STAGES):
+            summary[stage] = np.percentile(durations[:, k], percentiles).round(3).tolist() if n else None
+        if reset:
+            self.stage_count = 0
+        return summary
+
+    def _simulate_pulses(self):
+        """Send out a START pulse and some STOP pulses. FOR TESTING ONLY."""
+        if self.start is not None:
+            # We got a trigger, so issue a START pulse.
+            self._gpio.output(self.start, self._gpio.HIGH)
+            #time.sleep(0.000000005)
+            self._gpio.output(self.start, self._gpio.LOW)
+            #print("Generated START pulse.")
+        # former error 8 code:
+        # We used to wait here for TRIG to return to inactive state,
+        # but the chip spec doesn't specify the timing of that behavior.
+        # Deleted that check. Hope it's OK.
+        if self.stop is not None:
+            if self.stimulus is not None:
+                # Muon decays and background, precomputed.
+                output = self._gpio.output
+                stop = self.stop
+                for level in self.stimulus.next_train():
+                    output(stop, level)
+                return
+            # Without numpy, send 0 to NSTOP pulses.
+            n_stop = (self._reg[self.CONFIG2] & self._CF2_NUM_STOP) + 1
+            upper_limit = 1 << n_stop*2
+            r = random.randrange(upper_limit)
+            while r > 0:
+                self._gpio.output(self.stop, r & 1)
+                r >>= 1
+            self._gpio.output(self.stop, 0)
+
+    def measure_many(self, n, simulate=False, log_file=None):
+        """Run n measurements in a tight loop.
+           Returns a numpy structured array of MEASUREMENT_DTYPE,
+           one record per attempt, with the same status codes as measure().
+           The raw registers are only meaningful where status is 0-5.
+           Error messages are prefixed with the measurement number,
+           and written to log_file if given, else printed.
+        """
+        if np is None:
+            raise RuntimeError("measure_many() requires numpy")
+        if simulate:
+            self.prepare_stimulus()
+        # Hoist everything out of the loop that doesn't change.
+        gpio = self._gpio
+        gpio_input = gpio.input
+        wait_for_edge = gpio.wait_for_edge
+        # SPI fast path: arming is write-only, so send it from an immutable buffer
+        # with writebytes2() (no list built, none returned), and read results with
+        # xfer2(), which does the whole transfer in one ioctl with CS held low.
+        writebytes2 = self._spi.writebytes2
+        xfer2 = self._spi.xfer2
+        timing = self.spi_timing
+        perf_counter_ns = time.perf_counter_ns
+        transactions = 0
+        spi_ns = 0
+        now = time.time
+        trig1 = self.trig1
+        int1 = self.int1
+        reg = self._reg
+        trig_falling = (reg[self.CONFIG1] & self._CF1_TRIGG_EDGE) > 0
+        if trig_falling:
+            trig_edge = gpio.FALLING
+            trig_wait = "ERROR 10: Timed out waiting for TRIG1 to fall."
+        else:
+            trig_edge = gpio.RISING
+            trig_wait = "ERROR 10: Timed out waiting for TRIG1 to rise."
+        wait_for_interrupt = self.wait_for_interrupt
+        cf1_write = reg[self.CONFIG1] | self._CF1_START_MEAS
+        start_cmd = bytes((self.CONFIG1|self._WRITE, cf1_write))
+        # The chip takes one command (read or write, starting address) per transaction,
+        # so reading results and arming the next measurement can't share one.
+        # But when the status needs clearing, that can ride along with arming,
+        # as an auto-increment write of CONFIG1, CONFIG2 (unchanged) and INT_STATUS.
+        start_clear_cmd = bytes((self.CONFIG1|self._WRITE|self._AI, cf1_write,
+                                 reg[self.CONFIG2], 0b00011111))
+        clear = False
+        read_cmd = self.REG24_TUPLE_WITH_PADDING
+        n_regs = self.MAXREG24 - self.MINREG24 + 1
+        # Keep the whole transfer, including the leading 0 byte, so there is no slicing.
+        n_bytes = 3 * n_regs + 1
+        # Stage timestamps go in successive rows of stage_ns, while there is room.
+        stages = self.stage_timing
+        if stages:
+            stage_ns = self.stage_ns
+            width = len(self.STAGES) + 1
+            first_row = row = self.stage_count * width
+            stages = row < len(stage_ns)
+
+        def report(i, message):
+            err_str = str(i) + ' ' + message
+            if log_file:
+                log_file.write(err_str+'\n')
+            else:
+                print(err_str)
+
+        # Per-event results go into flat buffers, decoded all at once at the end.
+        status = bytearray(n)
+        stamps = [0.0] * n
+        raw = bytearray(n * n_bytes)
+        good = 0	# Any status above 5 means "not a measurement".
+        for i in range(n):
+            if stages:
+                stage_ns[row] = perf_counter_ns()
+            if trig1:
+                # TRIG should be low if rising-edge, high if falling-edge.
+                if bool(gpio_input(trig1)) != trig_falling:
+                    report(i, "ERROR 12: TRIG1 should be " + ("high." if trig_falling else "low."))
+                    # The chip is wedged. Only hope is to reset it.
+                    self.recover()
+                    status[i] = 12
+                    continue
+            if timing:
+                t = perf_counter_ns()
+            writebytes2(start_clear_cmd if clear else start_cmd)
+            if timing:
+                spi_ns += perf_counter_ns() - t
+                transactions += 1
+            clear = False
+            if trig1:
+                # Don't wait for an edge if TRIG1 is already active.
+                if bool(gpio_input(trig1)) == trig_falling:
+                    if wait_for_edge(trig1, trig_edge, timeout=1) is None:
+                        report(i, trig_wait)
+                        status[i] = 10
+                        continue
+            if not gpio_input(int1):
+                report(i, "ERROR 9: INT1 is active (low) too early!")
+                # Try to fix it, when arming the next measurement.
+                clear = True
+                status[i] = 9
+                continue
+            if stages:
+                stage_ns[row+1] = perf_counter_ns()
+            if simulate:
+                self._simulate_pulses()
+            if stages:
+                stage_ns[row+2] = perf_counter_ns()
+            if not wait_for_interrupt(int1):
+                report(i, "ERROR 7: Timed out waiting for INT1.")
+                status[i] = 7
+                continue
+            if stages:
+                stage_ns[row+3] = perf_counter_ns()
+            if timing:
+                t = perf_counter_ns()
+            raw[i*n_bytes:(i+1)*n_bytes] = xfer2(read_cmd)
+            if timing:
+                spi_ns += perf_counter_ns() - t
+                transactions += 1
+            stamps[i] = now()
+            good += 1
+            if stages:
+                stage_ns[row+4] = perf_counter_ns()
+                row += width
+                stages = row < len(stage_ns)
+        self.spi_transactions += transactions
+        self.spi_ns += spi_ns
+
+        if not self.stage_timing:
+            return self._decode_batch(status, stamps, raw, self.side)
+        # Pulses are counted for the whole batch at once,
+        # so charge each recorded measurement an equal share.
+        t = perf_counter_ns()
+        batch = self._decode_batch(status, stamps, raw, self.side)
+        recorded = (row - first_row) // width
+        if recorded:
+            share = (perf_counter_ns() - t) // good
+            rows = np.frombuffer(stage_ns, dtype=np.int64).reshape(-1, width)
+            rows = rows[first_row//width:row//width]
+            rows[:, width-1] = rows[:, width-2] + share
+            self.stage_count += recorded
+        return batch
+
+    def _decode_batch(self, status, stamps, raw, side):
+        """Turn the flat per-event buffers from a batch into a MEASUREMENT_DTYPE array.
+           status has 0 where the results were read, else an error code.
+           raw has the whole read_regs24() transfer for each event.
+           side is the side measured, or an array of it for each event.
+        """
+        n = len(status)
+        n_regs = self.MAXREG24 - self.MINREG24 + 1
+        batch = np.zeros(n, dtype=MEASUREMENT_DTYPE)
+        batch["timestamp"] = stamps
+        batch["side"] = side
+        codes = np.frombuffer(status, dtype=np.uint8)
+        # First (0th) byte is always 0, rest are desired values, MSB first.
+        data = np.frombuffer(raw, dtype=np.uint8).reshape(n, 3*n_regs + 1)[:, 1:]
+        data = data.reshape(n, n_regs, 3).astype(np.uint32)
+        regs = batch["regs"]
+        regs[...] = (data[:, :, 0] << 16) | (data[:, :, 1] << 8) | data[:, :, 2]
+        # Count pulses, as count_pulses() does, for the successful measurements.
+        if (self._reg[self.CONFIG1] & self._CF1_MEAS_MODE) == self._CF1_MM2:
+            counts = regs[:, 1:11:2]	# CLOCK_COUNT1 .. CLOCK_COUNT5
+        else:
+            counts = regs[:, 0:10:2]	# TIME1 .. TIME5
+        pulses = np.cumprod(counts != 0, axis=1).sum(axis=1)
+        batch["status"] = np.where(codes == 0, pulses, codes)
+        # Leave the internal register copy as if measure() had been called.
+        good = np.flatnonzero(codes == 0)
+        if len(good):
+            last = good[-1]
+            reg = self.reg[batch["side"][last]]
+            reg[self.MINREG24:self.MAXREG24+1] = array('I', regs[last].tolist())
+        return batch
+
+    def measure_pingpong(self, n, simulate=False, log_file=None):
+        """Run n measurements, alternating between the two sides of the chip.
+           While one side is measuring, the results of the other are read out,
+           so there is almost no dead time between measurements.
+           Both sides must have been configured identically,
+           and trig2 and int2 assigned in initGPIO().
+           Returns the same kind of array as measure_many().
+        """
+        if np is None:
+            raise RuntimeError("measure_pingpong() requires numpy")
+        if simulate:
+            self.prepare_stimulus()
+        if self.int2 is None:
+            raise RuntimeError("measure_pingpong() needs INT2")
+        # INT_STATUS is whatever each side's last measurement left, so skip it.
+        if any(self.reg[1][i] != self.reg[2][i] for i in range(self.MINREG8, self.MAXREG8+1)
+               if i != self.INT_STATUS):
+            raise RuntimeError("measure_pingpong() needs both sides configured the same")
+        self.open_both_sides()
+        gpio = self._gpio
+        gpio_input = gpio.input
+        wait_for_edge = gpio.wait_for_edge
+        wait_for_interrupt = self.wait_for_interrupt
+        now = time.time
+        reg = self.reg[1]
+        trig_falling = (reg[self.CONFIG1] & self._CF1_TRIGG_EDGE) > 0
+        trig_edge = gpio.FALLING if trig_falling else gpio.RISING
+        start_cmd = bytes((self.CONFIG1|self._WRITE, reg[self.CONFIG1] | self._CF1_START_MEAS))
+        # As in measure_many(), a stuck INT_STATUS is cleared along with the next arming.
+        start_clear_cmd = bytes((self.CONFIG1|self._WRITE|self._AI, reg[self.CONFIG1] | self._CF1_START_MEAS,
+                                 reg[self.CONFIG2], 0b00011111))
+        read_cmd = self.REG24_TUPLE_WITH_PADDING
+        n_bytes = 3 * (self.MAXREG24 - self.MINREG24 + 1) + 1
+        # Everything per side, indexed by side number.
+        writebytes2 = [None, self._spis[1].writebytes2, self._spis[2].writebytes2]
+        xfer2 = [None, self._spis[1].xfer2, self._spis[2].xfer2]
+        trig = [None, self.trig1, self.trig2]
+        intr = [None, self.int1, self.int2]
+        clear = [None, False, False]
+
+        def report(i, message):
+            err_str = str(i) + ' ' + message
+            if log_file:
+                log_file.write(err_str+'\n')
+            else:
+                print(err_str)
+
+        def arm(i, side):
+            """Start measurement i on one side. Returns 0, or an error code."""
+            pin = trig[side]
+            if pin:
+                # TRIG should be low if rising-edge, high if falling-edge.
+                if bool(gpio_input(pin)) != trig_falling:
+                    report(i, "ERROR 12: TRIG" + str(side) + " should be " +
+                           ("high." if trig_falling else "low."))
+                    # The chip is wedged. Only hope is to reset it (both sides).
+                    self.recover()
+                    return 12
+            writebytes2[side](start_clear_cmd if clear[side] else start_cmd)
+            clear[side] = False
+            if pin and bool(gpio_input(pin)) == trig_falling:
+                if wait_for_edge(pin, trig_edge, timeout=1) is None:
+                    report(i, "ERROR 10: Timed out waiting for TRIG" + str(side) + ".")
+                    return 10
+            if not gpio_input(intr[side]):
+                report(i, "ERROR 9: INT" + str(side) + " is active (low) too early!")
+                # Try to fix it, when arming this side next time.
+                clear[side] = True
+                return 9
+            if simulate:
+                self._simulate_pulses()
+            return 0
+
+        status = bytearray(n)
+        stamps = [0.0] * n
+        sides = bytearray(n)
+        raw = bytearray(n * n_bytes)
+        if n:
+            status[0] = arm(0, 1)
+        for i in range(n):
+            side = 1 + (i & 1)
+            sides[i] = side
+            # Wait for this side to finish (if it got started).
+            done = False
+            if status[i] == 0:
+                if wait_for_interrupt(intr[side]):
+                    done = True
+                    stamps[i] = now()
+                else:
+                    report(i, "ERROR 7: Timed out waiting for INT" + str(side) + ".")
+                    status[i] = 7
+            # Start the other side, then read this one while it measures.
+            if i + 1 < n:
+                status[i+1] = arm(i+1, 3 - side)
+            if done:
+                raw[i*n_bytes:(i+1)*n_bytes] = xfer2[side](read_cmd)
+        self.set_side(1)
+        return self._decode_batch(status, stamps, raw, np.frombuffer(sides, dtype=np.uint8))
+
     def set_SPI_clock_speed(self, speed, force=False):
         """Attempt to set the SPI clock speed, within chip limits."""
         # Spec max for SPI clock is 25 MHz.
@@ -1084,7 +1782,7 @@ class TDC7201():
 
         # Force=True bypasses all the sanity checks (for testing).
         if force:
-            self._spi.max_speed_hz = speed
+            self._set_spi_speed(speed)
             if speed > self._maxSPIspeed:
                 print("WARNING: forcing SPI clock speed to", speed, "Hz.")
             return
@@ -1096,7 +1794,7 @@ class TDC7201():
             speed = self._minSPIspeed
 
         # Check against maximum.
-        abs_max = 33300000	# highest seen to work at all
+        abs_max = self._absMaxSPIspeed
         safe_max = 28500000	# highest seen to work with zero write-read errors
         if speed > self._maxSPIspeed:
             if speed > abs_max:
@@ -1109,14 +1807,123 @@ class TDC7201():
             print("WARNING: SPI clock speed", speed,
                   "Hz is above maximum rated speed of", self._maxSPIspeed, "Hz.")
         print("Setting SPI clock speed to", speed/1000000.0, "MHz.")
+        self._set_spi_speed(speed)
+
+    def _set_spi_speed(self, speed):
+        """Set the SPI clock speed on every open SPI handle, without checks."""
         self._spi.max_speed_hz = speed
+        if self._spis[2] is not None:
+            self._spis[2].max_speed_hz = speed
+
+    def spi_errors(self, trials=1000):
+        """Write test patterns to the COARSE_CNTR_OVF registers of the current side
+           and read them back, trials times, at the current SPI clock speed.
+           Returns the number of mismatches.
+           This changes COARSE_CNTR_OVF, so call write_config() afterwards.
+        """
+        patterns = self._SCRATCH_PATTERNS
+        errors = 0
+        for i in range(trials):
+            high = patterns[i % len(patterns)]
+            value = (high << 8) | (~high & 0xFF)
+            self.write16(self.COARSE_CNTR_OVF_H, value)
+            if self.read16(self.COARSE_CNTR_OVF_H) != value:
+                errors += 1
+        return errors
+
+    def calibrate_spi_clock(self, speeds=SPI_SPEEDS, trials=1000, n=200, simulate=False):
+        """Find the fastest SPI clock speed with no write/readback errors.
+           Tries speeds (up to 33.3 MHz) in increasing order, running spi_errors(trials)
+           and timing n measurements at each, and stops at the first speed with any errors.
+           The timed measurements only send fake START and STOP pulses if simulate=True,
+           which is for the emulator; on real hardware they would mix with the real ones.
+           Must be called after configure().
+           Sets the SPI clock speed, and returns a dict of results
+           ("speed" is None if even the slowest speed had errors).
+        """
+        original = self._spi.max_speed_hz
+        if simulate:
+            self.prepare_stimulus()	# Not inside the first timed run.
+        clock = self.clock
+        results = {}
+        best = None
+        for speed in sorted(s for s in speeds if s <= self._absMaxSPIspeed):
+            self._set_spi_speed(speed)
+            errors = self.spi_errors(trials)
+            if not errors:
+                try:
+                    self.write_config(retries=1)
+                except RuntimeError:
+                    errors = 1
+            if errors:
+                results[speed] = {"errors": errors, "latency": None}
+                break
+            begin = clock()
+            self.measure_many(n, simulate=simulate, log_file=io.StringIO())
+            results[speed] = {"errors": 0, "latency": (clock() - begin) / n}
+            best = speed
+        self._set_spi_speed(best or original)
+        self.write_config()
+        return {"board": pi_serial(),
+                "model": pi_model(),
+                "speed": best,
+                "trials": trials,
+                "results": results,
+               }
+
+    def tune_spi_clock(self, path=SPI_CALIBRATION_FILE, trials=1000, recheck_trials=200,
+                       simulate=False):
+        """Run at the best SPI clock speed for this board.
+           If path has a saved speed for this board (by Pi serial number), and it
+           still passes spi_errors(recheck_trials), use it. Otherwise run
+           calibrate_spi_clock() and save the result. path=None means don't save.
+           Must be called after configure(). Returns the speed used.
+        """
+        board = pi_serial() or "unknown"
+        saved = {}
+        if path is not None:
+            try:
+                with open(path) as cal_file:
+                    saved = json.load(cal_file)
+            except (OSError, ValueError):
+                saved = {}
+        speed = saved.get(board, {}).get("speed")
+        if speed and speed <= self._absMaxSPIspeed:
+            self._set_spi_speed(speed)
+            errors = self.spi_errors(recheck_trials)
+            self.write_config()
+            if not errors:
+                print("Using saved SPI clock speed", speed/1000000.0, "MHz.")
+                return speed
+            print("Saved SPI clock speed", speed/1000000.0, "MHz gave", errors,
+                  "errors; recalibrating.")
+        result = self.calibrate_spi_clock(trials=trials, simulate=simulate)
+        speed = result["speed"]
+        if speed is None:
+            print("WARNING: SPI errors at every speed tried; leaving SPI clock at",
+                  self._spi.max_speed_hz/1000000.0, "MHz.")
+            return self._spi.max_speed_hz
+        print("Calibrated SPI clock speed:", speed/1000000.0, "MHz.")
+        if path is not None:
+            result["date"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            result["driver"] = __version__
+            saved[board] = result
+            try:
+                with open(path, 'w') as cal_file:
+                    json.dump(saved, cal_file, indent=1)
+            except OSError as err:
+                print("Couldn't save SPI calibration to", path + ":", err)
+        return speed
 
     def cleanup(self):
         """Turn off TDC7201, close SPI, and free up GPIO."""
         self.off()
         self._spi.close()
+        for spi in self._spis[1:]:
+            if spi is not None and spi is not self._spi:
+                spi.close()
         self.chip_select = 0
-        GPIO.cleanup()
+        self._gpio.cleanup()
 
     def exit(self):
         self.cleanup()
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+
+""" Background acquisition for the TDC7201 driver.
+
+    One thread owns the chip (SPI and GPIO) and does nothing but measure,
+    putting the raw results into a preallocated ring buffer.
+    Any number of consumers (disk, MQTT, statistics, ...) read from the ring
+    in their own threads, so slow file or network I/O no longer adds
+    dead time between measurements.
+
+        acq = Acquisition(tdc, simulate=True)
+        acq.add_consumer("disk", write_events)	# lossless
+        acq.add_consumer("stats", update_stats, lossy=True)
+        acq.start()
+        ...
+        acq.stop()
+
+    There is one writer (the acquisition thread), and each consumer only
+    moves its own read position, so no locks are needed: the positions are
+    plain ints, which Python reads and writes atomically.
+
+    If a lossless consumer falls a whole ring behind, the acquisition thread
+    drops new measurements rather than overwrite unread ones (counted in
+    Acquisition.dropped). Lossy consumers never hold up the ring; if they
+    fall behind, they skip ahead and count what they missed in
+    Consumer.overruns.
+
+    Requires numpy.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+from . import MEASUREMENT_DTYPE
+
+
+class RingBuffer():
+    """Fixed-size ring of MEASUREMENT_DTYPE records with a single writer."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.records = np.zeros(capacity, dtype=MEASUREMENT_DTYPE)
+        # Total number of records ever written. Only the writer changes this,
+        # and only after the records are in place.
+        self.head = 0
+        # Where head will be once the put() in progress is done. The writer
+        # advances this before touching any slot, so a reader can tell
+        # afterwards whether what it copied might have been overwritten
+        # (like a seqlock).
+        self.reserved = 0
+
+    def put(self, batch, limit):
+        """Append as much of batch as fits without passing position limit.
+           Returns the number of records stored.
+        """
+        n = min(len(batch), limit - self.head)
+        if n <= 0:
+            return 0
+        self.reserved = self.head + n
+        start = self.head % self.capacity
+        first = min(n, self.capacity - start)
+        self.records[start:start+first] = batch[:first]
+        if first < n:
+            self.records[:n-first] = batch[first:n]
+        self.head += n
+        return n
+
+    def get(self, position, end):
+        """Return a copy of the records from position up to (not including) end."""
+        start = position % self.capacity
+        stop = end % self.capacity
+        if start < stop or end == position:
+            return self.records[start:stop].copy()
+        return np.concatenate((self.records[start:], self.records[:stop]))
+
+
+class Consumer():
+    """A reader of the ring buffer, running in its own thread."""
+
+    def __init__(self, acquisition, name, callback, lossy=False, poll=0.05):
+        self.acquisition = acquisition
+        self.name = name
+        self.callback = callback
+        self.lossy = lossy
+        self.poll = poll	# seconds to sleep when there is nothing new
+        self.position = 0	# Next record to read.
+        self.overruns = 0	# Records skipped because we fell too far behind.
+        self.consumed = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def pending(self):
+        """Number of records written but not yet read."""
+        return self.acquisition.ring.head - self.position
+
+    def drain(self):
+        """Pass all new records to the callback. Returns how many there were."""
+        ring = self.acquisition.ring
+        head = ring.head
+        if self.lossy and head - self.position > ring.capacity:
+            self.overruns += head - self.position - ring.capacity
+            self.position = head - ring.capacity
+        if head == self.position:
+            return 0
+        records = ring.get(self.position, head)
+        if self.lossy:
+            # The writer may have lapped us while we were copying, including
+            # a put() still in progress, which has reserved but not yet published.
+            lapped = ring.reserved - self.position - ring.capacity
+            if lapped > 0:
+                self.overruns += lapped
+                records = records[lapped:]
+        self.position = head
+        self.consumed += len(records)
+        self.callback(records)
+        return len(records)
+
+    def _run(self):
+        acq = self.acquisition
+        while True:
+            running = acq._thread.is_alive()
+            if not self.drain():
+                if not running:
+                    # Producer is done and we've read everything.
+                    return
+                time.sleep(self.poll)
+
+
+class Acquisition():
+    """Run TDC7201 measurements in a dedicated thread, feeding a ring buffer."""
+
+    def __init__(self, tdc, capacity=1 << 18, chunk=1000, simulate=False, log_file=None,
+                 pingpong=False):
+        self.tdc = tdc
+        # Measure with both sides of the chip alternately?
+        if pingpong:
+            self._measure = tdc.measure_pingpong
+        else:
+            self._measure = tdc.measure_many
+        self.ring = RingBuffer(capacity)
+        self.chunk = chunk	# measurements per call to measure_many()
+        self.simulate = simulate
+        self.log_file = log_file
+        self.consumers = []
+        self.running = False
+        # Counters
+        self.measured = 0	# measurements attempted
+        self.dropped = 0	# measurements lost because the ring was full
+        self.busy_time = 0.0	# seconds spent inside measure_many()
+        self._thread = None
+
+    def add_consumer(self, name, callback, lossy=False, poll=0.05):
+        """Register callback(records) to be called with each group of new records.
+           Must be called before start().
+        """
+        consumer = Consumer(self, name, callback, lossy, poll)
+        self.consumers.append(consumer)
+        return consumer
+
+    def start(self):
+        """Start the acquisition and consumer threads."""
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name="tdc7201", daemon=True)
+        self._thread.start()
+        for consumer in self.consumers:
+            consumer._thread.start()
+
+    def stop(self, wait=True):
+        """Stop measuring; consumers finish reading what is left, then exit."""
+        self.running = False
+        if wait:
+            if self._thread is not None:
+                self._thread.join()
+            for consumer in self.consumers:
+                consumer._thread.join()
+
+    def _limit(self):
+        """How far the writer may go without overwriting unread lossless data."""
+        limit = self.ring.head + self.ring.capacity
+        for consumer in self.consumers:
+            if not consumer.lossy:
+                limit = min(limit, consumer.position + self.ring.capacity)
+        return limit
+
+    def _run(self):
+        measure = self._measure
+        ring = self.ring
+        perf_counter = time.perf_counter
+        while self.running:
+            begin = perf_counter()
+            batch = measure(self.chunk, simulate=self.simulate, log_file=self.log_file)
+            self.busy_time += perf_counter() - begin
+            stored = ring.put(batch, self._limit())
+            self.dropped += len(batch) - stored
+            self.measured += len(batch)
+
+    def stats(self):
+        """Counters as a dict, e.g. for publishing over MQTT."""
+        return {"measured": self.measured,
+                "dropped": self.dropped,
+                "busy_time": self.busy_time,
+                "overruns": {c.name: c.overruns for c in self.consumers},
+                "pending": {c.name: c.pending() for c in self.consumers},
+               }
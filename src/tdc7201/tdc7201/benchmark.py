@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+""" Throughput benchmarks for the TDC7201 driver, run against the emulator.
+
+        python3 -m tdc7201.benchmark --output bench-0.11.3.json
+        python3 -m tdc7201.benchmark --compare bench-0.11.3.json
+
+    Times measure(), read_regs24(), read_regs8(), count_pulses(),
+    compute_tofs(), measure_many(), and the body of the qtd.py batch loop,
+    in both measurement modes and for 1 to 5 STOP pulses.
+    For each, reports events (calls) per second and per-event latency
+    percentiles in uS, as JSON tagged with the driver version,
+    so that results from different versions can be compared.
+
+    Because the chip is emulated, these measure the Python cost of the
+    driver (plus the emulator), not SPI or GPIO speed. The emulator's
+    virtual clock does model SPI and GPIO costs, so the virtual event rate
+    of the measuring benchmarks is also reported.
+
+    With --compare, exits with status 1 if any benchmark got slower
+    by more than --threshold (default 10%).
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+
+import tdc7201
+from tdc7201.emulator import TDC7201Chip
+
+PERCENTILES = (50, 90, 99)
+REPEAT = 3	# Keep the fastest of this many runs, as timeit does.
+MEAS_MODES = (1, 2)
+NUM_STOPS = (1, 2, 3, 4, 5)
+
+
+def make_tdc(meas_mode, num_stop):
+    """A configured driver talking to a new emulated chip, as qtd.py --emulate sets it up."""
+    chip = TDC7201Chip()
+    # The driver is chatty while setting up.
+    with contextlib.redirect_stdout(io.StringIO()):
+        tdc = tdc7201.TDC7201(spi=chip.SpiDev(), gpio=chip.gpio, clock=chip.clock)
+        tdc.initGPIO(trig2=None, int2=None)
+        tdc.set_SPI_clock_speed(25000000)
+        tdc.on()
+        tdc.configure(side=1, meas_mode=meas_mode, num_stop=num_stop, clock_cntr_stop=0,
+                      timeout=0.000165 if meas_mode == 2 else None, calibration2_periods=40)
+    return (chip, tdc)
+
+
+def time_calls(func, n, repeat=REPEAT):
+    """Call func() n times, timing each call, and keep the fastest of repeat runs.
+       Returns a dict of calls per second and latency percentiles (uS).
+    """
+    perf_counter_ns = time.perf_counter_ns
+    stamps = np.zeros(n + 1, dtype=np.int64)
+    best = None
+    for _ in range(repeat):
+        stamps[0] = perf_counter_ns()
+        for i in range(1, n + 1):
+            func()
+            stamps[i] = perf_counter_ns()
+        if best is None or stamps[-1] - stamps[0] < best[-1] - best[0]:
+            best = stamps.copy()
+    latency = np.diff(best) / 1000.0
+    return {"n": n,
+            "events_per_sec": n / ((best[-1] - best[0]) / 1e9),
+            "latency_us": dict(zip(("p" + str(p) for p in PERCENTILES),
+                                   np.percentile(latency, PERCENTILES).round(3).tolist())),
+           }
+
+
+def time_batches(func, n, batch):
+    """Call func(batch) until at least n events have been done.
+       Latency is per event, so the percentiles are over batches.
+    """
+    calls = max(1, n // batch)
+    result = time_calls(lambda: func(batch), calls)
+    result["n"] = calls * batch
+    result["events_per_sec"] *= batch
+    result["latency_us"] = {p: round(t / batch, 3) for (p, t) in result["latency_us"].items()}
+    return result
+
+
+def bench_config(meas_mode, num_stop, n, batch):
+    """Run every benchmark for one configuration. Returns a list of result dicts."""
+    (chip, tdc) = make_tdc(meas_mode, num_stop)
+    log = io.StringIO()
+    results = []
+
+    def add(name, result, begin=None):
+        result.update(name=name, meas_mode=meas_mode, num_stop=num_stop)
+        if begin is not None and chip.now > begin:
+            # Rate the real chip and Pi could manage, as modeled by the emulator.
+            result["virtual_events_per_sec"] = round(REPEAT * result["n"] / (chip.now - begin), 1)
+        results.append(result)
+
+    begin = chip.now
+    add("measure", time_calls(lambda: tdc.measure(simulate=True, log_file=log), n), begin)
+    # The rest work on whatever the last measurement left in the chip.
+    add("read_regs24", time_calls(tdc.read_regs24, n))
+    add("read_regs8", time_calls(tdc.read_regs8, n))
+    add("count_pulses", time_calls(tdc.count_pulses, n))
+    add("compute_tofs", time_calls(tdc.compute_tofs, n))
+    begin = chip.now
+    add("measure_many",
+        time_batches(lambda k: tdc.measure_many(k, simulate=True, log_file=log), n, batch), begin)
+
+    def batch_loop(k):
+        # What qtd.py does with each batch, apart from the file and network I/O.
+        batch = tdc.measure_many(k, simulate=True, log_file=log)
+        status = batch["status"]
+        np.bincount(status, minlength=14).tolist()
+        keep = (status >= 2) & (status <= 5)
+        batch["regs"][keep].tobytes()
+        tdc7201.compute_tofs_batch(batch["regs"][status == 2], tdc.reg1[tdc.CONFIG1],
+                                   tdc.reg1[tdc.CONFIG2], tdc.clockPeriod)
+    begin = chip.now
+    add("batch_loop", time_batches(batch_loop, n, batch), begin)
+    return results
+
+
+def run(n=10000, batch=1000, meas_modes=MEAS_MODES, num_stops=NUM_STOPS):
+    """Run all the benchmarks. Returns a dict ready for json.dump()."""
+    results = []
+    for meas_mode in meas_modes:
+        for num_stop in num_stops:
+            results.extend(bench_config(meas_mode, num_stop, n, batch))
+    return {"version": tdc7201.__version__,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "node": platform.node(),
+            "results": results,
+           }
+
+
+def compare(old, new, threshold=0.1):
+    """Compare two run() results. Returns a list of (name, meas_mode, num_stop, old, new)
+       for the benchmarks whose events_per_sec fell by more than threshold.
+    """
+    def key(result):
+        return (result["name"], result["meas_mode"], result["num_stop"])
+    before = {key(result): result["events_per_sec"] for result in old["results"]}
+    slower = []
+    for result in new["results"]:
+        rate = before.get(key(result))
+        if rate and result["events_per_sec"] < rate * (1.0 - threshold):
+            slower.append(key(result) + (rate, result["events_per_sec"]))
+    return slower
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the TDC7201 driver against the emulator.")
+    parser.add_argument("-n", type=int, default=10000, help="events per benchmark")
+    parser.add_argument("--batch", type=int, default=1000,
+                        help="measurements per measure_many() call")
+    parser.add_argument("--meas-mode", type=int, choices=MEAS_MODES, action="append",
+                        help="measurement mode (default both)")
+    parser.add_argument("--num-stop", type=int, choices=NUM_STOPS, action="append",
+                        help="number of STOP pulses (default 1 to 5)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", metavar="JSON", help="earlier results to check against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fractional slowdown counted as a regression")
+    args = parser.parse_args(argv)
+
+    report = run(args.n, args.batch, args.meas_mode or MEAS_MODES, args.num_stop or NUM_STOPS)
+    for result in report["results"]:
+        print("%-13s mode %d stops %d: %10.0f events/S, p50 %8.3f uS, p99 %8.3f uS" %
+              (result["name"], result["meas_mode"], result["num_stop"],
+               result["events_per_sec"], result["latency_us"]["p50"], result["latency_us"]["p99"]))
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=1)
+    if args.compare:
+        with open(args.compare) as old_file:
+            old = json.load(old_file)
+        slower = compare(old, report, args.threshold)
+        for (name, meas_mode, num_stop, before, after) in slower:
+            print("REGRESSION:", name, "mode", meas_mode, "stops", num_stop, "fell from",
+                  round(before), "to", round(after), "events/S (version", old["version"],
+                  "->", report["version"] + ")")
+        if slower:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,524 @@
+#!/usr/bin/python3
+
+""" Software model of a TDC7201 chip on the TDC7201-ZAX-EVM board.
+
+    Provides drop-in replacements for spidev.SpiDev() and RPi.GPIO,
+    so that the driver (and programs like qtd.py) can run on any
+    computer, without a Raspberry Pi or the chip attached:
+
+        import tdc7201
+        from tdc7201.emulator import TDC7201Chip
+        chip = TDC7201Chip()
+        tdc = tdc7201.TDC7201(spi=chip.SpiDev(), gpio=chip.gpio, clock=chip.clock)
+
+    The model covers the register file (with auto-increment reads and
+    writes), CONFIG1 START_MEAS, INT_STATUS write-1-to-clear, the
+    calibration registers, and the TRIG and INT pins of both sides.
+    Measurement results are computed from the chip clock and a fixed
+    ring oscillator LSB, so they are exactly what a perfect chip would
+    report for the given STOP times.
+
+    Time does not really pass. Instead, the chip keeps a virtual clock
+    (chip.now, in seconds) which every SPI transaction and GPIO call
+    advances by a fixed cost, and waiting for an interrupt jumps it
+    forward to the end of the measurement. This makes the emulator
+    deterministic and as fast as Python allows.
+
+    Averaging (CONFIG2 AVG_CYCLES) and parity are not modeled.
+"""
+
+import math
+import random
+
+# Pin assignments; these match the defaults in TDC7201.initGPIO().
+DEFAULT_PINS = {"enable": 12,
+                "osc_enable": 16,
+                "trig1": 7,
+                "int1": 37,
+                "trig2": 11,
+                "int2": 32,
+                "start": 18,
+                "stop": 22,
+               }
+
+# Register addresses and bit masks, as in the driver.
+_AI = 0x80
+_WRITE = 0x40
+_ADDRESS = 0x3F
+CONFIG1 = 0x00
+CONFIG2 = 0x01
+INT_STATUS = 0x02
+INT_MASK = 0x03
+MAXREG8 = 0x09
+MINREG24 = 0x10
+MAXREG24 = 0x1C
+_CF1_TRIGG_EDGE = 0b00100000
+_CF1_STOP_EDGE = 0b00010000
+_CF1_START_EDGE = 0b00001000
+_CF1_MEAS_MODE = 0b00000110
+_CF1_MM2 = 0b00000010
+_CF1_START_MEAS = 0b00000001
+_IS_COMPLETE = 0b00010000
+_IS_STARTED = 0b00001000
+_IS_CLOCK_OVF = 0b00000100
+_IS_COARSE_OVF = 0b00000010
+_IS_INTERRUPT = 0b00000001
+_IM_CLOCK_OVF = 0b00000100
+_IM_COARSE_OVF = 0b00000010
+_IM_MEASUREMENT = 0b00000001
+
+# Power-on values of the 8-bit registers.
+RESET_REGS8 = (0x00,	# CONFIG1
+               0x40,	# CONFIG2 (10 calibration periods)
+               0x00,	# INT_STATUS
+               0x07,	# INT_MASK (all enabled)
+               0xFF, 0xFF,	# COARSE_CNTR_OVF
+               0xFF, 0xFF,	# CLOCK_CNTR_OVF
+               0x00, 0x00,	# CLOCK_CNTR_STOP_MASK
+              )
+
+CAL_PERIODS = (2, 10, 20, 40)
+
+# Measurement states
+IDLE = 0	# Waiting for START_MEAS
+ARMED = 1	# START_MEAS set, TRIG asserted, waiting for START
+RUNNING = 2	# START seen, collecting STOPs
+DONE = 3	# Measurement complete, INT asserted (if not masked)
+
+
+def muon_stimulus(tau=2.1969811e-6, pair_fraction=0.01, single_fraction=0.1,
+                  max_time=20e-6):
+    """Return a stimulus function producing muon-like STOP times.
+
+       Each call represents one measurement window.
+       With probability pair_fraction, a muon stops and decays,
+       giving two STOPs separated by an exponentially distributed time
+       with mean tau. With probability single_fraction there is a
+       lone STOP (a muon that passed through). Otherwise nothing.
+       Times are in seconds after START.
+    """
+    def stimulus():
+        r = random.random()
+        if r < pair_fraction:
+            first = random.uniform(0.0, 1e-6)
+            return [first, first + random.expovariate(1.0 / tau)]
+        if r < pair_fraction + single_fraction:
+            return [random.uniform(0.0, max_time)]
+        return []
+    return stimulus
+
+
+class _Side():
+    """One side (channel) of the chip: registers and measurement state."""
+
+    def __init__(self):
+        self.reg8 = bytearray(RESET_REGS8)
+        self.reg24 = [0] * (MAXREG24 - MINREG24 + 1)
+        self.state = IDLE
+        self.int_low = False	# INT pin is active low.
+        self.start_time = None
+        self.end_time = None
+        self.stops = []
+
+    def reset(self):
+        """Return to power-on state."""
+        self.reg8[:] = RESET_REGS8
+        self.reg24[:] = [0] * len(self.reg24)
+        self.state = IDLE
+        self.int_low = False
+        self.start_time = None
+        self.end_time = None
+        self.stops = []
+
+    def trig_level(self):
+        """Logic level of the TRIG pin."""
+        falling = self.reg8[CONFIG1] & _CF1_TRIGG_EDGE
+        if self.state == ARMED:
+            return 0 if falling else 1
+        return 1 if falling else 0
+
+
+class TDC7201Chip():
+    """Emulated TDC7201 plus the EVM board signals the driver uses."""
+
+    def __init__(self,
+                 clock_frequency=8000000,	# EVM on-board oscillator
+                 lsb=55e-12,	# Ring oscillator period; datasheet typical
+                 stimulus=None,	# Function returning STOP times for one START
+                 auto_start=None,	# Generate START after TRIG is asserted?
+                 start_delay=0.000002,	# Time from TRIG to automatic START
+                 pins=None,	# Header pin numbers, see DEFAULT_PINS
+                 spi_overhead=0.000010,	# Time for one SPI transaction, plus bytes
+                 gpio_time=0.0000005,	# Time for one GPIO call
+                ):
+        self.clock_frequency = clock_frequency
+        self.clock_period = 1.0 / clock_frequency
+        self.lsb = lsb
+        self.stimulus = stimulus
+        # An external START source is assumed if there is a stimulus.
+        if auto_start is None:
+            auto_start = stimulus is not None
+        self.auto_start = auto_start
+        self.start_delay = start_delay
+        self.pins = dict(DEFAULT_PINS)
+        if pins:
+            self.pins.update(pins)
+        self.spi_overhead = spi_overhead
+        self.gpio_time = gpio_time
+        self.now = 0.0
+        self.enabled = False
+        self.side = [None, _Side(), _Side()]
+        # Which signal (if any) each header pin drives or is driven by.
+        self._pin_signal = {pin: name for (name, pin) in self.pins.items() if pin is not None}
+        self._levels = {}	# Last value written to each output pin
+        self.gpio = EmulatedGPIO(self)
+        # Statistics
+        self.transactions = 0
+        self.measurements = 0
+
+    def SpiDev(self):
+        """Create a new spidev.SpiDev() lookalike connected to this chip."""
+        return EmulatedSpiDev(self)
+
+    def clock(self):
+        """The virtual time, in seconds; pass as TDC7201(clock=...)."""
+        return self.now
+
+    # Chip internals
+
+    def _enable(self, level):
+        if not (level and self.enabled):
+            self.side[1].reset()
+            self.side[2].reset()
+        self.enabled = bool(level)
+
+    def _arm(self, side):
+        """CONFIG1 START_MEAS was written."""
+        s = self.side[side]
+        s.state = ARMED
+        s.int_low = False
+        s.stops = []
+        s.reg8[INT_STATUS] = 0
+        if self.auto_start:
+            s.start_time = self.now + self.start_delay
+
+    def _start(self, side, when=None):
+        """A START edge arrived (now, or at an earlier time when)."""
+        s = self.side[side]
+        if s.state != ARMED:
+            return
+        s.state = RUNNING
+        s.start_time = self.now if when is None else when
+        s.reg8[INT_STATUS] |= _IS_STARTED
+        if self.stimulus is not None:
+            s.stops = [t for t in self.stimulus()]
+        self._schedule_end(s)
+
+    def _stop(self):
+        """A STOP edge arrived (to both sides)."""
+        for s in (self.side[1], self.side[2]):
+            if s.state == RUNNING:
+                s.stops.append(self.now - s.start_time)
+                self._schedule_end(s)
+
+    def _overflow_time(self, s):
+        """Time after START at which the measurement gives up."""
+        ovf = ((s.reg8[6] << 8) | s.reg8[7]) * self.clock_period
+        if not s.reg8[CONFIG1] & _CF1_MM2:
+            # Mode 1 also stops when the coarse counter overflows.
+            # The coarse counter increments once per 63 LSBs.
+            coarse = ((s.reg8[4] << 8) | s.reg8[5]) * 63 * self.lsb
+            ovf = min(ovf, coarse)
+        return ovf
+
+    def _schedule_end(self, s):
+        """Work out when the running measurement will finish."""
+        num_stop = (s.reg8[CONFIG2] & 0b111) + 1
+        if num_stop > 5:
+            num_stop = 1
+        mask = ((s.reg8[8] << 8) | s.reg8[9]) * self.clock_period
+        ovf = self._overflow_time(s)
+        valid = sorted(t for t in s.stops if mask <= t < ovf)
+        if len(valid) >= num_stop:
+            s.end_time = s.start_time + valid[num_stop - 1]
+        else:
+            s.end_time = s.start_time + ovf
+
+    def _update(self):
+        """Finish any measurements whose end time has passed."""
+        for side in (1, 2):
+            s = self.side[side]
+            if s.state == ARMED and self.auto_start and self.now >= s.start_time:
+                self._start(side, s.start_time)
+            if s.state == RUNNING and self.now >= s.end_time:
+                self._finish(side)
+
+    def _finish(self, side):
+        """Fill in result registers and raise the interrupt."""
+        s = self.side[side]
+        reg8 = s.reg8
+        reg24 = s.reg24
+        period = self.clock_period
+        lsb = self.lsb
+        num_stop = (reg8[CONFIG2] & 0b111) + 1
+        if num_stop > 5:
+            num_stop = 1
+        mask = ((reg8[8] << 8) | reg8[9]) * period
+        ovf = self._overflow_time(s)
+        stops = sorted(t for t in s.stops if mask <= t < ovf)[:num_stop]
+        for i in range(len(reg24)):
+            reg24[i] = 0
+        mode2 = reg8[CONFIG1] & _CF1_MM2
+        t0 = s.start_time
+        if mode2:
+            # TIME1 is START to the next clock edge,
+            # TIME(n+1) is STOPn to the next clock edge,
+            # and CLOCK_COUNTn is the clock periods between those edges.
+            start_edge = math.ceil(t0 / period) * period
+            reg24[0] = int(round((start_edge - t0) / lsb))
+            for (n, tof) in enumerate(stops):
+                stop_time = t0 + tof
+                stop_edge = math.ceil(stop_time / period) * period
+                reg24[2*n + 1] = int(round((stop_edge - start_edge) / period))
+                reg24[2*n + 2] = int(round((stop_edge - stop_time) / lsb))
+        else:
+            # TIMEn is the whole START to STOPn interval.
+            for (n, tof) in enumerate(stops):
+                reg24[2*n] = int(round(tof / lsb))
+        cal_pers = CAL_PERIODS[reg8[CONFIG2] >> 6]
+        reg24[MAXREG24 - 1 - MINREG24] = int(round(period / lsb))	# CALIBRATION1
+        reg24[MAXREG24 - MINREG24] = int(round(cal_pers * period / lsb))	# CALIBRATION2
+        status = _IS_STARTED | _IS_COMPLETE | _IS_INTERRUPT
+        int_mask = reg8[INT_MASK]
+        assert_int = int_mask & _IM_MEASUREMENT
+        if len(stops) < num_stop:
+            if mode2:
+                status |= _IS_CLOCK_OVF
+                assert_int = assert_int or int_mask & _IM_CLOCK_OVF
+            else:
+                status |= _IS_COARSE_OVF
+                assert_int = assert_int or int_mask & _IM_COARSE_OVF
+        reg8[INT_STATUS] = status
+        reg8[CONFIG1] &= ~_CF1_START_MEAS & 0xFF
+        s.state = DONE
+        s.int_low = bool(assert_int)
+        self.measurements += 1
+
+    # SPI
+
+    def transfer(self, side, data, speed):
+        """Run one SPI transaction (chip select low to high)."""
+        n = len(data)
+        self.transactions += 1
+        self.now += self.spi_overhead + (8 * n) / speed
+        if not self.enabled or n == 0:
+            return [0] * n
+        self._update()
+        s = self.side[side]
+        command = data[0]
+        auto_inc = command & _AI
+        addr = command & _ADDRESS
+        result = [0] * n
+        i = 1
+        if command & _WRITE:
+            while i < n:
+                if addr <= MAXREG8:
+                    self._write8(side, addr, data[i])
+                    i += 1
+                elif MINREG24 <= addr <= MAXREG24:
+                    if i + 2 < n:
+                        s.reg24[addr - MINREG24] = (data[i] << 16) | (data[i+1] << 8) | data[i+2]
+                    i += 3
+                else:
+                    i += 1
+                if auto_inc:
+                    addr += 1
+        else:
+            while i < n:
+                if addr <= MAXREG8:
+                    result[i] = s.reg8[addr]
+                    i += 1
+                elif MINREG24 <= addr <= MAXREG24:
+                    value = s.reg24[addr - MINREG24]
+                    # Data goes out MSB first.
+                    for shift in (16, 8, 0):
+                        if i < n:
+                            result[i] = (value >> shift) & 0xFF
+                            i += 1
+                else:
+                    i += 1
+                if auto_inc:
+                    addr += 1
+        return result
+
+    def _write8(self, side, addr, value):
+        s = self.side[side]
+        if addr == INT_STATUS:
+            # Write 1 to clear. Clearing any bit releases the INT pin.
+            cleared = value & 0x1F
+            if cleared & s.reg8[INT_STATUS]:
+                s.int_low = False
+            s.reg8[INT_STATUS] &= ~cleared & 0xFF
+        elif addr == CONFIG1:
+            s.reg8[CONFIG1] = value
+            if value & _CF1_START_MEAS:
+                self._arm(side)
+        else:
+            s.reg8[addr] = value
+
+    # GPIO
+
+    def read_pin(self, pin):
+        """Current logic level on a header pin."""
+        self.now += self.gpio_time
+        self._update()
+        name = self._pin_signal.get(pin)
+        if name == "int1":
+            return 0 if self.side[1].int_low else 1
+        if name == "int2":
+            return 0 if self.side[2].int_low else 1
+        if name == "trig1":
+            return self.side[1].trig_level()
+        if name == "trig2":
+            return self.side[2].trig_level()
+        return self._levels.get(pin, 0)
+
+    def write_pin(self, pin, value):
+        """Drive a header pin."""
+        self.now += self.gpio_time
+        value = 1 if value else 0
+        old = self._levels.get(pin, 0)
+        self._levels[pin] = value
+        name = self._pin_signal.get(pin)
+        if name == "enable":
+            self._enable(value)
+            return
+        if value == old:
+            return
+        if name == "start":
+            for side in (1, 2):
+                falling = self.side[side].reg8[CONFIG1] & _CF1_START_EDGE
+                if value != bool(falling):
+                    self._start(side)
+        elif name == "stop":
+            falling = self.side[1].reg8[CONFIG1] & _CF1_STOP_EDGE
+            if value != bool(falling):
+                self._stop()
+
+    def wait_pin(self, pin, rising, timeout):
+        """Wait until an edge, or timeout (in seconds). Returns True if edge seen."""
+        self._update()
+        name = self._pin_signal.get(pin)
+        if name in ("int1", "int2"):
+            s = self.side[int(name[-1])]
+            if rising:
+                # INT only rises when cleared over SPI, which can't happen while we wait.
+                self.now += timeout
+                return False
+            if s.state == ARMED and self.auto_start:
+                self._start(int(name[-1]), max(self.now, s.start_time))
+            if s.state == RUNNING and s.end_time - self.now <= timeout:
+                self.now = max(self.now, s.end_time)
+                self._finish(int(name[-1]))
+                return s.int_low
+            self.now += timeout
+            return False
+        if name in ("trig1", "trig2"):
+            # TRIG changes immediately when armed or started,
+            # so if it isn't at the wanted level yet, it never will be.
+            self.now += timeout
+            return False
+        self.now += timeout
+        return False
+
+
+class EmulatedSpiDev():
+    """Stand-in for spidev.SpiDev, talking to a TDC7201Chip."""
+
+    def __init__(self, chip):
+        self._chip = chip
+        self._side = None
+        self.bits_per_word = 8
+        self.cshigh = False
+        self.loop = False
+        self.lsbfirst = False
+        self.max_speed_hz = 125000000
+        self.mode = 0
+        self.threewire = False
+
+    def open(self, bus, device):
+        """RPi CE0 = chip CS1, RPi CE1 = chip CS2."""
+        if bus != 0 or device not in (0, 1):
+            raise FileNotFoundError("No such SPI device")
+        self._side = device + 1
+
+    def close(self):
+        self._side = None
+
+    def xfer(self, data):
+        if self._side is None:
+            raise OSError("SPI device not open")
+        return self._chip.transfer(self._side, data, self.max_speed_hz)
+
+    xfer2 = xfer
+
+    def writebytes(self, data):
+        self.xfer(data)
+
+    # Like spidev 3.5 and later, these accept any buffer (bytes, bytearray, ...).
+    writebytes2 = writebytes
+    xfer3 = xfer
+
+    def readbytes(self, n):
+        return self.xfer([0] * n)
+
+
+class EmulatedGPIO():
+    """Stand-in for the RPi.GPIO module, wired to a TDC7201Chip."""
+    VERSION = "emulated"
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self, chip):
+        self._chip = chip
+        self._mode = None
+
+    def setmode(self, mode):
+        self._mode = mode
+
+    def getmode(self):
+        return self._mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        if direction == self.OUT and initial is not None:
+            self._chip.write_pin(channel, initial)
+
+    def input(self, channel):
+        return self._chip.read_pin(channel)
+
+    def output(self, channel, value):
+        self._chip.write_pin(channel, value)
+
+    def wait_for_edge(self, channel, edge, bouncetime=None, timeout=None):
+        """Timeout is in mS, as in RPi.GPIO. Returns channel, or None on timeout."""
+        if timeout is None:
+            timeout = 1000
+        if self._chip.wait_pin(channel, edge == self.RISING, timeout / 1000.0):
+            return channel
+        return None
+
+    def cleanup(self, channel=None):
+        self._mode = None
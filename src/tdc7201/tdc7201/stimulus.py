@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+""" Precomputed STOP pulse trains for simulated measurements.
+
+    Generating random pulses one measurement at a time puts Python-level
+    random number calls on the critical path. Instead, a StimulusPool
+    draws a large number of pulse trains at once with numpy, and the
+    driver (measure(simulate=True)) or pulse.py just steps through them.
+
+    Each train is one measurement window. With probability decay_fraction
+    a muon stops (at a uniform time in the first arrival_window seconds)
+    and decays after an exponentially distributed time with mean tau.
+    On top of that there is a flat background of STOPs at background_rate
+    per second. So a histogram of simulated decay times should be an
+    exponential with lifetime tau on a flat background, the same shape
+    that lifetime.py fits.
+
+    STOPs are produced by bit-banging a GPIO pin, one call per tick, so
+    times are rounded down to whole ticks, and pulses closer together
+    than two ticks (high, then low) are merged, like a discriminator's
+    dead time. Set tick to the time one GPIO.output() call takes:
+
+        pool = StimulusPool(tick=0.0000005)
+        tdc.stimulus = pool
+        batch = tdc.measure_many(100000, simulate=True)
+
+    Rounding to ticks turns the decay-time histogram into a comb at
+    multiples of tick, which is fine for throughput testing but slightly
+    biases a lifetime fit. To check the analysis, drive the emulator
+    with the exact STOP times instead (and measure with simulate=False):
+
+        chip = TDC7201Chip(stimulus=pool.emulator_stimulus())
+
+    Requires numpy.
+"""
+
+import itertools
+
+import numpy as np
+
+TAU = 2.1969811e-6	# muon lifetime, seconds
+
+
+class StimulusPool():
+    """A pool of random STOP pulse trains, drawn all at once."""
+
+    def __init__(self,
+                 size=1 << 16,	# Number of trains
+                 tau=TAU,	# Mean decay time, seconds
+                 decay_fraction=0.5,	# Fraction of windows with a muon decay
+                 background_rate=1000.0,	# Background STOPs per second
+                 window=20e-6,	# Length of each train, seconds
+                 arrival_window=1e-6,	# Muons arrive this soon after START, seconds
+                 tick=0.0000005,	# Time per GPIO output call, seconds
+                 seed=None,
+                ):
+        self.size = size
+        self.tau = tau
+        self.decay_fraction = decay_fraction
+        self.background_rate = background_rate
+        self.window = window
+        self.tick = tick
+        rng = np.random.default_rng(seed)
+        # Muon stops and decays.
+        decays = np.flatnonzero(rng.random(size) < decay_fraction)
+        arrival = rng.uniform(0.0, arrival_window, len(decays))
+        decay = arrival + rng.exponential(tau, len(decays))
+        # Flat background.
+        n_background = rng.poisson(background_rate * window, size)
+        background = rng.uniform(0.0, window, int(n_background.sum()))
+        # All the STOPs, sorted by train then time, and cut off at the window.
+        train = np.concatenate((decays, decays, np.repeat(np.arange(size), n_background)))
+        times = np.concatenate((arrival, decay, background))
+        inside = times < window
+        (train, times) = (train[inside], times[inside])
+        order = np.lexsort((times, train))
+        (train, times) = (train[order], times[order])
+        bounds = np.searchsorted(train, np.arange(size + 1))
+        ticks = (times / tick).astype(np.int64).tolist()
+        times = times.tolist()
+        # Exact times, for the emulator.
+        self.times = [times[bounds[i]:bounds[i+1]] for i in range(size)]
+        # Levels to write to the STOP pin, one per tick, ending low.
+        self.trains = [self._levels(ticks[bounds[i]:bounds[i+1]]) for i in range(size)]
+        self._next = itertools.cycle(self.trains).__next__
+
+    @staticmethod
+    def _levels(ticks):
+        """Pin levels for STOPs at these ticks (sorted), merging any too close together."""
+        levels = []
+        for tick in ticks:
+            if tick > len(levels):
+                levels.extend([0] * (tick - len(levels)))
+            elif tick < len(levels):
+                continue	# Pin hasn't gone low since the last STOP.
+            levels.extend((1, 0))
+        return tuple(levels) if levels else (0,)
+
+    def next_train(self):
+        """The next train of STOP pin levels, cycling through the pool."""
+        return self._next()
+
+    def emulator_stimulus(self):
+        """A stimulus function for TDC7201Chip, cycling through the exact STOP times."""
+        return itertools.cycle(self.times).__next__
+
+    def decay_times(self):
+        """Time from the first to the second STOP of every train with two or more,
+           as the chip would report them (rounded to ticks). For checking analysis.
+        """
+        pairs = []
+        for levels in self.trains:
+            rising = [i for (i, level) in enumerate(levels) if level]
+            if len(rising) >= 2:
+                pairs.append((rising[1] - rising[0]) * self.tick)
+        return np.array(pairs)
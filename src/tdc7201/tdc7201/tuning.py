@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+""" Automatic tuning of the TDC7201 measurement parameters.
+
+    The figure of merit for QTD is the rate of valid pulse pairs
+    (status 2) per second, which depends on the overflow timeout,
+    calibration periods, number of STOPs and STOP mask as well as on
+    the (changing) background rate. A ParameterTuner runs short trial
+    batches with measure_many(), scores each configuration, and
+    configures the chip with the best one:
+
+        tuner = ParameterTuner(tdc, CONFIG)
+        config = tuner.tune()
+        ...
+        if tuner.due():
+            config = tuner.tune()
+
+    The search is coordinate-wise by default: starting from the current
+    configuration, try every value of one parameter while holding the
+    others fixed, keep the best, move on to the next parameter, and
+    repeat until a whole round brings no improvement. tune(exhaustive=True)
+    tries the whole grid instead.
+
+    score = pairs per second - error_weight * errors (status 6-13) per second
+
+    Trials are short, so scores are noisy; a new configuration has to beat
+    the current one by min_gain (a fraction) to replace it.
+
+    Note that num_stop is scored like anything else, but fewer STOPs also
+    means events with extra pulses can no longer be told apart from pairs.
+    Leave it out of the grid if that matters.
+
+    Requires numpy.
+"""
+
+import contextlib
+import io
+import itertools
+import time
+
+import numpy as np
+
+# Values tried for each configure() argument.
+GRID = {"timeout": (0.00001, 0.00002, 0.00004, 0.00008, 0.000165),	# Seconds, meas_mode 2 only
+        "calibration2_periods": (2, 10, 20, 40),
+        "num_stop": (2, 3, 4, 5),
+        "clock_cntr_stop": (0, 8, 16, 32),	# Clock periods
+       }
+ERROR_CODES = range(6, 14)	# measure() status codes that are errors
+N_RESULTS = 14
+
+
+class ParameterTuner():
+    """Find the configure() arguments that give the most valid pulse pairs per second."""
+
+    def __init__(self, tdc, config,
+                 grid=None,	# Values to try, default GRID
+                 trial_size=2000,	# Measurements per trial
+                 error_weight=1.0,	# Score cost of one error, in pairs
+                 min_gain=0.05,	# Fraction a new config must beat the current one by
+                 interval=3600,	# Seconds between re-tunes, None for never
+                 max_rounds=3,	# Coordinate search rounds
+                 sides=(1,),	# Sides of the chip to configure with the result
+                 simulate=True,
+                ):
+        self.tdc = tdc
+        self.config = dict(config)
+        if grid is None:
+            grid = dict(GRID)
+            if self.config.get("meas_mode", 2) == 1:
+                del grid["timeout"]	# Mode 1 has no use for a long timeout.
+        self.grid = grid
+        self.trial_size = trial_size
+        self.error_weight = error_weight
+        self.min_gain = min_gain
+        self.interval = interval
+        self.max_rounds = max_rounds
+        self.sides = sides
+        self.simulate = simulate
+        self.results = []	# Trials from the last tune()
+        self.score = None	# Score of self.config in the last tune()
+        self.last_tune = None	# time.time() of the last tune()
+        self.tunes = 0
+
+    def due(self, now=None):
+        """True if it's time to re-tune."""
+        if self.last_tune is None:
+            return True
+        if self.interval is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now - self.last_tune >= self.interval
+
+    def _configure(self, config, side):
+        # configure() narrates every setting; keep the console readable.
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.tdc.configure(side=side, **config)
+
+    def trial(self, config):
+        """Run one trial batch with config on the first of sides.
+           Returns a dict of the config, status counts, pairs_per_sec, error_rate and score.
+        """
+        tdc = self.tdc
+        self._configure(config, self.sides[0])
+        if self.simulate:
+            tdc.prepare_stimulus()	# Not inside the timed batch.
+        clock = tdc.clock
+        begin = clock()
+        batch = tdc.measure_many(self.trial_size, simulate=self.simulate, log_file=io.StringIO())
+        elapsed = clock() - begin
+        counts = np.bincount(batch["status"], minlength=N_RESULTS)
+        errors = int(counts[ERROR_CODES.start:ERROR_CODES.stop].sum())
+        pairs_per_sec = counts[2] / elapsed if elapsed > 0 else 0.0
+        errors_per_sec = errors / elapsed if elapsed > 0 else 0.0
+        result = {"config": dict(config),
+                  "counts": counts.tolist(),
+                  "pairs_per_sec": pairs_per_sec,
+                  "error_rate": errors / len(batch),
+                  "score": pairs_per_sec - self.error_weight * errors_per_sec,
+                 }
+        self.results.append(result)
+        return result
+
+    def _better(self, score, best):
+        return score > best + self.min_gain * abs(best)
+
+    def tune(self, exhaustive=False):
+        """Search for the best configuration, and configure every one of sides with it.
+           Returns the chosen configuration (also in self.config).
+        """
+        tdc = self.tdc
+        # Trial measurements shouldn't show up in the stage timing.
+        stages = tdc.stage_timing
+        tdc.stage_timing = False
+        self.results = []
+        tried = {}
+
+        def score(config):
+            key = tuple(sorted(config.items()))
+            if key not in tried:
+                tried[key] = self.trial(config)["score"]
+            return tried[key]
+
+        def best_of(configs):
+            return max(configs, key=score)
+
+        # The current configuration is re-measured, since the background may have changed.
+        best = dict(self.config)
+        best_score = score(best)
+        if exhaustive:
+            names = list(self.grid)
+            config = best_of(dict(best, **dict(zip(names, values)))
+                             for values in itertools.product(*self.grid.values()))
+            if self._better(score(config), best_score):
+                (best, best_score) = (config, score(config))
+        else:
+            for _ in range(self.max_rounds):
+                improved = False
+                for (name, values) in self.grid.items():
+                    config = best_of(dict(best, **{name: value}) for value in values)
+                    if self._better(score(config), best_score):
+                        (best, best_score) = (config, score(config))
+                        improved = True
+                if not improved:
+                    break
+        for side in reversed(self.sides):
+            self._configure(best, side)	# Ends on the first side.
+        tdc.stage_timing = stages
+        self.config = best
+        self.score = best_score
+        self.last_tune = time.time()
+        self.tunes += 1
+        return best
@@ -0,0 +1,89 @@
+""" Run the driver against the emulated chip, and check that
+    measure() and measure_many() agree on the same STOP pulses.
+
+        python3 -m pytest tests
+"""
+
+import contextlib
+import io
+import itertools
+
+import pytest
+
+import tdc7201
+from tdc7201.emulator import TDC7201Chip
+
+# STOP times (seconds after START) for successive measurements.
+TRAINS = ([],
+          [1e-6],
+          [1e-6, 3e-6],
+          [0.5e-6, 1e-6, 2e-6],
+          [1e-6, 2e-6, 3e-6, 4e-6],
+          [1e-6, 2e-6, 3e-6, 4e-6, 5e-6],
+          [200e-6],	# After the meas_mode 2 timeout
+         )
+
+
+def make_tdc(meas_mode, num_stop):
+    """A configured driver talking to a new emulated chip that sees TRAINS in turn."""
+    trains = itertools.cycle(TRAINS)
+    chip = TDC7201Chip(stimulus=lambda: list(next(trains)))
+    with contextlib.redirect_stdout(io.StringIO()):
+        tdc = tdc7201.TDC7201(spi=chip.SpiDev(), gpio=chip.gpio, clock=chip.clock)
+        tdc.initGPIO(trig2=None, int2=None)
+        tdc.set_SPI_clock_speed(25000000)
+        tdc.on()
+        tdc.configure(side=1, meas_mode=meas_mode, num_stop=num_stop, clock_cntr_stop=0,
+                      timeout=0.000165 if meas_mode == 2 else None, calibration2_periods=40)
+    return tdc
+
+
+@pytest.mark.parametrize("meas_mode", (1, 2))
+@pytest.mark.parametrize("num_stop", (1, 2, 3, 4, 5))
+def test_measure_many_matches_measure(meas_mode, num_stop):
+    tdc = make_tdc(meas_mode, num_stop)
+    log = io.StringIO()
+    status = [tdc.measure(log_file=log) for _ in TRAINS]
+    batch = make_tdc(meas_mode, num_stop).measure_many(len(TRAINS), log_file=log)
+    assert log.getvalue() == ""
+    assert batch["status"].tolist() == status
+    assert (batch["side"] == 1).all()
+    assert (batch["timestamp"] > 0).all()
+
+
+@pytest.mark.parametrize("meas_mode", (1, 2))
+def test_pulse_counts(meas_mode):
+    tdc = make_tdc(meas_mode, 5)
+    status = tdc.measure_many(len(TRAINS), log_file=io.StringIO())["status"].tolist()
+    # No STOPs before the timeout in meas_mode 2; in meas_mode 1 the late one still counts.
+    assert status == [0, 1, 2, 3, 4, 5, 0 if meas_mode == 2 else 1]
+
+
+@pytest.mark.parametrize("meas_mode", (1, 2))
+def test_compute_tofs_batch_matches_compute_tofs(meas_mode):
+    tdc = make_tdc(meas_mode, 5)
+    reg = tdc.reg1
+    regs = []
+    expected = []
+    for _ in TRAINS:
+        tdc.measure(log_file=io.StringIO())
+        regs.append(list(reg[tdc.MINREG24:tdc.MAXREG24+1]))
+        pulses = tdc.compute_tofs()
+        expected.append((tdc.norm_lsb, pulses, [tdc.tof1, tdc.tof2, tdc.tof3, tdc.tof4, tdc.tof5]))
+    (norm_lsb, pulses, tofs) = tdc7201.compute_tofs_batch(regs, reg[tdc.CONFIG1], reg[tdc.CONFIG2],
+                                                          tdc.clockPeriod)
+    assert pulses.tolist() == [e[1] for e in expected]
+    assert norm_lsb.tolist() == pytest.approx([e[0] for e in expected], rel=1e-12)
+    assert tofs.tolist() == [pytest.approx(e[2], rel=1e-12, abs=1e-18) for e in expected]
+    # The STOPs are 1 uS apart.
+    assert tofs[5, 1:] - tofs[5, :-1] == pytest.approx([1e-6] * 4, abs=1e-9)
+
+
+def test_compute_tofs_batch_without_calibration():
+    tdc = make_tdc(2, 5)
+    regs = [[0] * 13]
+    (norm_lsb, pulses, tofs) = tdc7201.compute_tofs_batch(regs, tdc.reg1[tdc.CONFIG1],
+                                                          tdc.reg1[tdc.CONFIG2], tdc.clockPeriod)
+    assert pulses.tolist() == [6]
+    assert norm_lsb.tolist() == [0.0]
+    assert not tofs.any()
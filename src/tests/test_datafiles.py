@@ -0,0 +1,104 @@
+""" Rotate and compress data files.
+
+        python3 -m pytest tests
+"""
+
+import gzip
+
+import numpy as np
+import pytest
+
+import datafiles
+import qtdfile
+
+# The fields of tdc7201.MEASUREMENT_DTYPE that BatchFiles uses.
+RECORD_DTYPE = np.dtype([("status", "u1"), ("regs", "<u4", (qtdfile.N_REGS,))])
+
+
+def make_records(status):
+    records = np.zeros(len(status), dtype=RECORD_DTYPE)
+    records["status"] = status
+    records["regs"] = np.arange(qtdfile.N_REGS) + 1
+    return records
+
+
+def make_batch_files(tmp_path, policy):
+    def opener(start_time, number):
+        base = str(tmp_path / ("batch" + str(number)))
+        data_file = open(base + ".txt", 'w')
+        event_file = qtdfile.EventWriter(base + ".qtd", [0] * 10, batch=number,
+                                         start_time=start_time)
+        return (data_file, event_file)
+    return datafiles.BatchFiles(opener, policy)
+
+
+@pytest.mark.parametrize("limit", ("max_seconds", "max_events", "max_bytes"))
+@pytest.mark.parametrize("value", (0, -1))
+def test_policy_rejects_nonpositive_limits(limit, value):
+    with pytest.raises(ValueError):
+        datafiles.RotationPolicy(**{limit: value})
+
+
+def test_policy_due():
+    assert not datafiles.RotationPolicy().due(1e9, 1 << 40, 1 << 40)
+    policy = datafiles.RotationPolicy(max_seconds=60, max_events=100, max_bytes=1000)
+    assert not policy.due(59, 99, 999)
+    assert policy.due(60, 0, 0)
+    assert policy.due(0, 100, 0)
+    assert policy.due(0, 0, 1000)
+
+
+def test_rotation_by_events(tmp_path):
+    files = make_batch_files(tmp_path, datafiles.RotationPolicy(max_events=100))
+    status = np.tile([0, 1, 2, 3, 7], 50)	# 250 events, 100 of them pairs and more
+    files.write(make_records(status[:30]))
+    files.write(make_records(status[30:]))
+    files.close()
+    assert files.number == 3
+    assert files.cum_results[:8] == [50, 50, 50, 50, 0, 0, 0, 50]
+    kept = 0
+    for number in (1, 2, 3):
+        name = str(tmp_path / ("batch" + str(number)))
+        (header, records) = qtdfile.open_events(name + ".qtd")
+        assert header["batch"] == number
+        assert header["results"].sum() == (100 if number < 3 else 50)
+        assert set(records["status"].tolist()) == {2, 3}
+        assert (qtdfile.decode_regs(records) == np.arange(qtdfile.N_REGS) + 1).all()
+        kept += len(records)
+        with open(name + ".txt") as f:
+            assert f.read().startswith("Tot : ")
+    assert kept == 100
+
+
+def test_rotation_by_bytes(tmp_path):
+    policy = datafiles.RotationPolicy(max_bytes=qtdfile.HEADER_SIZE + 10 * qtdfile.RECORD_SIZE)
+    files = make_batch_files(tmp_path, policy)
+    for _ in range(25):
+        files.write(make_records([2]))
+    files.close()
+    assert files.number == 3
+    sizes = [len(qtdfile.open_events(str(tmp_path / ("batch" + str(n) + ".qtd")))[1])
+             for n in (1, 2, 3)]
+    assert sizes == [10, 10, 5]
+
+
+def test_no_empty_files(tmp_path):
+    files = make_batch_files(tmp_path, datafiles.RotationPolicy(max_events=10))
+    files.write(make_records([2] * 10))
+    files.close()
+    assert files.number == 1
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["batch1.qtd", "batch1.txt"]
+
+
+def test_compress(tmp_path):
+    name = tmp_path / "batch1.txt"
+    name.write_text("Cum : [0]\n" * 1000)
+    compressor = datafiles.Compressor("gzip")
+    out = compressor.compress(str(name))
+    compressor.stop()
+    assert out == str(name) + ".gz"
+    assert not name.exists()
+    with gzip.open(out, 'rt') as f:
+        assert f.read() == "Cum : [0]\n" * 1000
+    assert compressor.compressed == 1
+    assert compressor.bytes_out < compressor.bytes_in
@@ -0,0 +1,67 @@
+""" Fit the muon lifetime to synthetic histograms.
+
+        python3 -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+import lifetime
+
+B = 20e-9	# Bin width, seconds
+K = np.arange(1000)
+
+
+def expected(n, tau, nu, nf=0.0, tauf=1.0):
+    """Mean bin counts of the fit model."""
+    def decays(tau):
+        p = 1 - np.exp(-B / tau)
+        return p * (1 - p) ** K
+    return nu + n * decays(tau) + nf * decays(tauf)
+
+
+def test_fit_recovers_tau():
+    counts = np.random.default_rng(1).poisson(expected(2e5, 2.2e-6, 20.0))
+    fit = lifetime.fit(counts, bin_width=B)
+    assert fit.converged
+    assert fit["tau"] == pytest.approx(2.2e-6, abs=4 * fit.errors["tau"])
+    assert fit.errors["tau"] < 0.02e-6
+    assert fit["nu"] == pytest.approx(20.0, abs=4 * fit.errors["nu"])
+    assert fit["n"] == pytest.approx(2e5, rel=0.02)
+
+
+def test_fit_exact_counts():
+    fit = lifetime.fit(expected(2e5, 2.2e-6, 20.0), bin_width=B)
+    assert fit.converged
+    assert fit["tau"] == pytest.approx(2.2e-6, rel=1e-6)
+    assert fit["nu"] == pytest.approx(20.0, rel=1e-6)
+
+
+@pytest.mark.parametrize(("nf", "tauf"), ((5e3, 60e-9), (2e4, 100e-9)))
+def test_fit_fast_component(nf, tauf):
+    counts = expected(2e5, 2.2e-6, 20.0, nf=nf, tauf=tauf)
+    fit = lifetime.fit(counts, bin_width=B, fast=True)
+    assert fit.converged
+    assert fit["tau"] == pytest.approx(2.2e-6, rel=1e-4)
+    assert fit["nf"] == pytest.approx(nf, rel=1e-3)
+    assert fit["tauf"] == pytest.approx(tauf, rel=1e-3)
+
+
+def test_background_pinned_at_zero():
+    counts = np.random.default_rng(2).poisson(expected(1e5, 2.2e-6, 0.0))
+    counts[-200:] = 0
+    fit = lifetime.fit(counts, bin_width=B)
+    assert fit.converged
+    assert fit["nu"] == 0.0
+    assert np.isnan(fit.errors["nu"])
+    assert "nu=0 (pinned at 0)" in str(fit)
+
+
+def test_fit_batch_matches_fit():
+    rng = np.random.default_rng(3)
+    y = rng.poisson(expected(2e5, 2.2e-6, 20.0), size=(5, len(K)))
+    (theta, errors, nll, iterations, converged) = lifetime.fit_batch(y, bin_width=B)
+    assert converged.all()
+    for i in range(len(y)):
+        fit = lifetime.fit(y[i], bin_width=B)
+        assert fit.theta.tolist() == pytest.approx(theta[i].tolist(), rel=1e-6)
@@ -0,0 +1,50 @@
+""" Write binary event files and read them back.
+
+        python3 -m pytest tests
+"""
+
+import numpy as np
+import pytest
+
+import qtdfile
+
+CONFIG = [0x83, 0x44, 0x07, 0x07, 0xFF, 0xFF, 0x05, 0x00, 0x00, 0x00]
+
+
+def test_round_trip(tmp_path):
+    name = str(tmp_path / "batch.qtd")
+    rng = np.random.default_rng(1)
+    regs = rng.integers(0, 1 << 24, size=(100, qtdfile.N_REGS), dtype=np.uint32)
+    status = rng.integers(0, qtdfile.N_RESULTS, size=100, dtype=np.uint8)
+    results = np.bincount(status, minlength=qtdfile.N_RESULTS)
+    with qtdfile.EventWriter(name, CONFIG, batch=7, start_time=1234.5,
+                             clock_period=1.25e-7) as writer:
+        writer.write(regs[:60], status[:60])
+        writer.write(regs[60:], status[60:])
+        assert writer.size() == qtdfile.HEADER_SIZE + 100 * qtdfile.RECORD_SIZE
+        writer.close(results)
+    (header, records) = qtdfile.open_events(name)
+    assert header["magic"] == qtdfile.MAGIC
+    assert header["version"] == qtdfile.VERSION
+    assert header["batch"] == 7
+    assert header["start_time"] == 1234.5
+    assert header["clock_period"] == 1.25e-7
+    assert header["config"].tolist() == CONFIG
+    assert header["results"].tolist() == results.tolist()
+    assert (qtdfile.decode_regs(records) == regs).all()
+    assert (records["status"] == status).all()
+
+
+def test_empty_file(tmp_path):
+    name = str(tmp_path / "empty.qtd")
+    qtdfile.EventWriter(name, CONFIG).close()
+    (header, records) = qtdfile.open_events(name)
+    assert len(records) == 0
+    assert not header["results"].any()
+
+
+def test_not_an_event_file(tmp_path):
+    name = tmp_path / "data.txt"
+    name.write_text("Date : 20200101000000\n")
+    with pytest.raises(ValueError):
+        qtdfile.read_header(str(name))